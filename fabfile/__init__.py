@@ -2,11 +2,22 @@ from __future__ import unicode_literals
 
 __version__ = '1.0.0'
 
-from fabric.api import env
+from fabric.api import env, task
 
-import es
-import logs
-import geoip
+from fabfile.registry import lazy_module
+
+
+es = lazy_module('es')
+logs = lazy_module('logs')
+geoip = lazy_module('geoip')
 
 
 env.use_ssh_config = True
+
+
+@task
+def refresh_inventory(region='us-west-1'):
+    """Re-fetch every cached EC2 host lookup"""
+    from fabfile import utils
+
+    utils.get_inventory(region).refresh()
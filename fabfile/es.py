@@ -5,8 +5,8 @@ from datetime import timedelta
 import logging
 import urlparse
 
-from fabric.api import task, run, env, hosts
-from fabfile.utils import schedule, find_host
+from fabric.api import task, run, env
+from fabfile.utils import schedule, lazy_role
 from fabric.decorators import roles
 
 from fabric_rundeck import cron
@@ -15,7 +15,7 @@ logger = logging.getLogger(__name__)
 
 
 @cron('0 11 * * *')
-@hosts(find_host('balanced-es-1'))
+@roles(lazy_role('balanced-es-1', single=True))
 @task
 def optimize(target='', base_url='http://localhost:9200'):
     """Optimize ES index
@@ -57,7 +57,7 @@ def optimize(target='', base_url='http://localhost:9200'):
 
 
 @cron('0 11 * * *')
-@hosts(find_host('balanced-es-1'))
+@roles(lazy_role('balanced-es-1', single=True))
 @task
 def purge_outdated(max_age_days='45'):
     """Purge outdated logs"""
@@ -4,15 +4,19 @@ import logging
 import os
 import sys
 
-from fabric.api import task, run, hosts
-from fabfile.utils import schedule, find_hosts
-from fabric.decorators import roles
+from fabric.api import task, run, abort, settings
+from fabric.context_managers import shell_env
+from fabfile.utils import schedule, find_hosts, lazy_role
+from fabric.decorators import roles, runs_once
 from fabric.operations import sudo
 
 
 from fabric_rundeck import cron
 
 from infra import awscli
+from infra.compression import EXTENSIONS, get_codec
+from infra.s3 import KeyIndex
+from infra.parallel import execute_parallel
 
 logger = logging.getLogger(__name__)
 
@@ -27,22 +31,31 @@ class ArgumentError(ValueError):
 aws = awscli._AWSCli()
 
 
-@cron('30 0 * * *')
-@hosts(*find_hosts('log-prod'))
+@roles(lazy_role('log-prod'))
 @task
 def archive(s3_bucket_name='balanced.log',
             paths='/mnt/log/',
             reap_threshold='30',
             ripe_threshold='1',
             aws_credentials=None,
-            verbose=False):
+            verbose=False,
+            jobs='1',
+            codec='gzip',
+            level='',
+            threads=''):
     """
     Archives {host}/{date} bucketed logs to S3. Thresholds are in day units.
+    Up to `jobs` logs are compressed and uploaded at once.
 
     """
     # arguments are passed as string
     reap_threshold = int(reap_threshold)
     ripe_threshold = int(ripe_threshold)
+    jobs = int(jobs)
+    codec = get_codec(
+        codec,
+        level=int(level) if level else None,
+        threads=int(threads) if threads else None)
     if not paths or not paths.split(','):
         raise ArgumentError(
             r"paths should be a string -- separated by commas "
@@ -56,20 +69,103 @@ def archive(s3_bucket_name='balanced.log',
     # assumes that there's an aws cli on the machine.
     aws.ensure_awscli_installed()
     aws.reconfigure(aws_credentials)
+    archived = aws_key_index(s3_bucket_name)
     for path in paths:
         logger.debug('getting buckets in %s', path)
-        for log in get_logs(path, reap_threshold, ripe_threshold):
+        to_archive, to_remove = [], []
+        for log in get_logs(path, reap_threshold, ripe_threshold, codec):
             if not log.ripe:
                 logger.debug('%s is not ripe, skipping', log.path)
-            elif not log.is_archived(s3_bucket_name):
-                log.archive(s3_bucket_name)
+            elif not log.is_archived(archived):
+                to_archive.append(log)
             elif log.expired:
-                logger.debug('%s is expired, removing', log.path)
-                log.remove()
+                to_remove.append(log)
+        if jobs > 1:
+            archive_logs(to_archive, s3_bucket_name, jobs, codec)
+        else:
+            for log in to_archive:
+                log.archive(s3_bucket_name)
+        for log in to_archive:
+            archived.add(log.name)
+        # only logs that were already archived before this run are reaped
+        for log in to_remove:
+            logger.debug('%s is expired, removing', log.path)
+            log.remove()
         sudo('find {path} -maxdepth 1 -type d -empty -delete'.format(
             path=path))
 
 
+@cron('30 0 * * *')
+@runs_once
+@task
+def archive_all(workers='8', timeout='7200', **kwargs):
+    """
+    Runs archive on every log-prod host at once, at most `workers` hosts at
+    a time and each for at most `timeout` seconds. Other arguments, like
+    archive's `jobs`, are passed through to archive.
+
+    """
+    report = execute_parallel(
+        archive, find_hosts('log-prod'),
+        workers=int(workers), timeout=int(timeout), kwargs=kwargs)
+    print report.summary()
+    if report.failed:
+        abort('archive failed on %s' % ', '.join(
+            host_result.host for host_result in report.failed))
+    return report
+
+
+def aws_key_index(s3_bucket):
+    """
+    Index of archive names in `s3_bucket`, one `aws s3 ls` per day prefix
+    instead of one per bucketed log.
+
+    """
+    def list_keys(prefix):
+        with settings(warn_only=True):
+            output = aws('s3 ls s3://{bucket_name}/{prefix}'.format(
+                bucket_name=s3_bucket,
+                prefix=prefix,
+            ))
+        if not output.succeeded:
+            return []
+        # lines look like "2014-06-01 00:31:12    1234 20140531_host.tar.gz"
+        return [
+            line.split()[-1] for line in output.splitlines()
+            if line.strip() and not line.split()[0] == 'PRE'
+        ]
+
+    # archive names start with YYYYMMDD
+    return KeyIndex(list_keys, prefix_len=8)
+
+
+def archive_logs(logs, s3_bucket, jobs, codec):
+    """
+    Archives `logs` with up to `jobs` tar + upload pipelines running at
+    once on the remote host. Fails if any of them failed.
+
+    """
+    if not logs:
+        return
+    script = (
+        'set -o pipefail; start=$(date +%s); '
+        'tar cf - $1 | {compress} > /tmp/$2 && '
+        'aws s3 mv /tmp/$2 s3://{bucket}/$2; '
+        'rc=$?; rm -f /tmp/$2; '
+        'echo "$2 exited $rc after $(($(date +%s) - start))s"; '
+        'exit $rc'
+    ).format(compress=codec.shell_command(), bucket=s3_bucket)
+    logger.info('archiving %s buckets, %s at a time', len(logs), jobs)
+    with shell_env(**aws.credentials):
+        run("echo {logs} | xargs -n 2 -P {jobs} bash -c '{script}' _"
+            .format(
+                logs=' '.join(
+                    '{} {}'.format(log.path, log.name) for log in logs),
+                jobs=jobs,
+                script=script,
+            ))
+
+
 def setup_logging(verbose):
     logger.setLevel(logging.WARNING)
     if verbose:
@@ -77,7 +173,8 @@ def setup_logging(verbose):
     logger.addHandler(logging.StreamHandler(sys.stderr))
 
 
-def get_logs(base_path, reap_threshold, ripe_threshold, ts_fmt='%Y-%m-%d'):
+def get_logs(base_path, reap_threshold, ripe_threshold, codec=None,
+             ts_fmt='%Y-%m-%d'):
     if not base_path.endswith('/'):
         base_path += '/'
 
@@ -107,7 +204,8 @@ def get_logs(base_path, reap_threshold, ripe_threshold, ts_fmt='%Y-%m-%d'):
             )
             continue
 
-        bl = BucketedLog(host, ts, path, reap_threshold, ripe_threshold)
+        bl = BucketedLog(host, ts, path, reap_threshold, ripe_threshold,
+                         codec)
         bucketed_logs.append(bl)
 
     bucketed_logs.sort(key=lambda bucket: bucket.ts)
@@ -119,16 +217,22 @@ class BucketedLog(object):
 
     def __init__(self, host, ts, path,
                  reap_threshold=datetime.timedelta(days=15),
-                 ripe_threshold=datetime.timedelta(days=1)):
+                 ripe_threshold=datetime.timedelta(days=1),
+                 codec=None):
         self.host = host
         self.ts = ts
         self.path = path
         self.reap_threshold = reap_threshold
         self.ripe_threshold = ripe_threshold
+        self.codec = codec or get_codec('gzip')
+
+    @property
+    def base_name(self):
+        return '_'.join([self.ts.strftime('%Y%m%d'), self.host])
 
     @property
     def name(self):
-        return '_'.join([self.ts.strftime('%Y%m%d'), self.host]) + '.tar.gz'
+        return self.base_name + self.codec.extension
 
     @property
     def expired(self):
@@ -138,14 +242,12 @@ class BucketedLog(object):
     def ripe(self):
         return self.ts < (datetime.datetime.utcnow() - self.ripe_threshold)
 
-    def is_archived(self, s3_bucket):
-        logger.debug('Is %s in bucket: %s?', self.name, s3_bucket)
-        output = aws('s3 ls s3://{bucket_name}/{name}'.format(
-            bucket_name=s3_bucket,
-            name=self.name
-        ))
-        rval = output.strip()
-        logger.debug('output: %s', rval)
+    def is_archived(self, archived):
+        # archived with any codec counts
+        rval = any(
+            self.base_name + extension in archived
+            for extension in EXTENSIONS)
+        logger.debug('Is %s archived? %s', self.name, rval)
         return rval
 
     def archive(self, s3_bucket):
@@ -154,7 +256,11 @@ class BucketedLog(object):
                                            key=os.path.basename(self.name))
 
         logger.info('tarring up %s into %s', self.path, remote_archive)
-        run('tar zcf {dest} {src}'.format(dest=remote_archive, src=self.path))
+        run('set -o pipefail; tar cf - {src} | {compress} > {dest}'.format(
+            src=self.path,
+            compress=self.codec.shell_command(),
+            dest=remote_archive,
+        ))
         logger.info('uploading %s to %s', remote_archive, s3_bucket)
         aws('s3 mv {src} {dest}'.format(src=remote_archive, dest=loc))
         logger.debug('deleting archive %s', remote_archive)
@@ -0,0 +1,126 @@
+"""
+Lazy task loading.
+
+Task modules pull in boto, requests, fabric_rundeck, etc. when imported, so
+instead of importing them the fabfile reads their source and exposes a stub
+module of `LazyTask`s carrying each task's name, docstring and cron
+schedule. The real module is only imported once one of its tasks is
+executed (or something asks for an attribute only the real task has).
+"""
+from __future__ import unicode_literals
+import ast
+import importlib
+import os
+import types
+
+from fabric.tasks import Task
+
+
+PACKAGE = __name__.rpartition('.')[0]
+
+
+class TaskSpec(object):
+
+    def __init__(self, module_name, name, doc=None, cron=None):
+        self.module_name = module_name
+        self.name = name
+        self.doc = doc
+        self.cron = cron
+
+    def __repr__(self):
+        return '<TaskSpec {}.{}>'.format(self.module_name, self.name)
+
+
+def _decorator_name(decorator):
+    if isinstance(decorator, ast.Call):
+        decorator = decorator.func
+    if isinstance(decorator, ast.Name):
+        return decorator.id
+    if isinstance(decorator, ast.Attribute):
+        return decorator.attr
+    return None
+
+
+def _cron_spec(decorator):
+    if decorator.args:
+        return ast.literal_eval(decorator.args[0])
+    return dict(
+        (keyword.arg, ast.literal_eval(keyword.value))
+        for keyword in decorator.keywords
+    )
+
+
+def scan(module_name):
+    """
+    Returns the module docstring and a `TaskSpec` per ``@task`` decorated
+    function in fabfile/`module_name`.py, without importing it.
+    """
+    path = os.path.join(os.path.dirname(__file__), module_name + '.py')
+    with open(path, 'r') as fo:
+        tree = ast.parse(fo.read(), path)
+    specs = []
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef):
+            continue
+        names = [_decorator_name(d) for d in node.decorator_list]
+        if 'task' not in names:
+            continue
+        cron = None
+        for decorator in node.decorator_list:
+            if (isinstance(decorator, ast.Call) and
+                    _decorator_name(decorator) == 'cron'):
+                cron = _cron_spec(decorator)
+        specs.append(TaskSpec(
+            module_name, node.name, ast.get_docstring(node), cron))
+    return ast.get_docstring(tree), specs
+
+
+class LazyTask(Task):
+    """
+    Stands in for the task described by `spec` until it is needed.
+    """
+
+    def __init__(self, spec):
+        Task.__init__(self, name=spec.name)
+        self.spec = spec
+        self.__doc__ = spec.doc
+        self.rundeck_cron = spec.cron
+
+    @property
+    def task(self):
+        module = importlib.import_module(
+            '{}.{}'.format(PACKAGE, self.spec.module_name))
+        return getattr(module, self.spec.name)
+
+    @property
+    def wrapped(self):
+        return self.task
+
+    def run(self, *args, **kwargs):
+        return self.task.run(*args, **kwargs)
+
+    def get_hosts_and_effective_roles(self, *args, **kwargs):
+        return self.task.get_hosts_and_effective_roles(*args, **kwargs)
+
+    def get_pool_size(self, *args, **kwargs):
+        return self.task.get_pool_size(*args, **kwargs)
+
+    def __details__(self):
+        return self.task.__details__()
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in ('spec', 'task'):
+            raise AttributeError(name)
+        return getattr(self.task, name)
+
+
+def lazy_module(module_name):
+    """
+    Stub module Fabric can collect fabfile/`module_name`.py's tasks from,
+    keeping the usual `module_name.task_name` names.
+    """
+    doc, specs = scan(module_name)
+    module = types.ModuleType(str(module_name), doc)
+    for spec in specs:
+        setattr(module, spec.name, LazyTask(spec))
+    return module
@@ -1,4 +1,8 @@
 from __future__ import unicode_literals
+import json
+import os
+import tempfile
+import time
 
 from fabric.api import env
 import boto.ec2
@@ -11,20 +15,103 @@ def schedule(crontab):
     return annotate_function
 
 
-def find_hosts(pattern, region='us-west-1'):
-    matches = []
-    conn = boto.ec2.connect_to_region(region)
-    reservations = conn.get_all_instances()
-    for reservation in reservations:
-        for instance in reservation.instances:
-            if pattern in instance.tags.get('Name', ''):
-                matches.append(instance)
-    return [
-        match.ip_address or match.private_ip_address
-        for match in matches
-    ]
+INVENTORY_PATH = os.environ.get(
+    'OPS_INVENTORY_PATH', os.path.expanduser('~/.cache/ops/ec2-{region}.json'))
+
+INVENTORY_TTL = int(os.environ.get('OPS_INVENTORY_TTL', 10 * 60))
+
+
+class Inventory(object):
+    """
+    On-disk cache of EC2 `Name` tag pattern -> IPs for one region. Entries
+    older than `ttl` seconds are re-fetched with a server side tag filter,
+    so only matching instances come back.
+    """
+
+    def __init__(self, region, path=INVENTORY_PATH, ttl=INVENTORY_TTL):
+        self.region = region
+        self.path = path.format(region=region)
+        self.ttl = ttl
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = self.load()
+        return self._index
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as fo:
+                return json.load(fo)
+        except (IOError, ValueError):
+            return {}
+
+    def save(self):
+        dir_path = os.path.dirname(self.path)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path)
+        with os.fdopen(fd, 'w') as fo:
+            json.dump(self.index, fo)
+        os.rename(tmp_path, self.path)
+
+    def find(self, pattern, refresh=False):
+        entry = self.index.get(pattern)
+        if (refresh or entry is None or
+                time.time() - entry['fetched_at'] > self.ttl):
+            entry = {
+                'fetched_at': time.time(),
+                'hosts': self.describe(pattern),
+            }
+            self.index[pattern] = entry
+            if self.ttl:
+                self.save()
+        return entry['hosts']
+
+    def refresh(self):
+        for pattern in self.index.keys():
+            self.find(pattern, refresh=True)
+
+    def describe(self, pattern):
+        conn = boto.ec2.connect_to_region(self.region)
+        reservations = conn.get_all_instances(
+            filters={'tag:Name': '*{}*'.format(pattern)})
+        return [
+            instance.ip_address or instance.private_ip_address
+            for reservation in reservations
+            for instance in reservation.instances
+        ]
+
+
+_inventories = {}
+
+
+def get_inventory(region='us-west-1'):
+    if region not in _inventories:
+        _inventories[region] = Inventory(region)
+    return _inventories[region]
+
+
+def find_hosts(pattern, region='us-west-1', refresh=False):
+    return get_inventory(region).find(pattern, refresh=refresh)
 
 
 def find_host(pattern):
     # this info comes from aws, so assuming that all hosts are alive
     return find_hosts(pattern)[0]
+
+
+def lazy_role(pattern, single=False):
+    """
+    Registers a roledef that resolves `pattern` to hosts only when a task
+    using it actually runs, e.g. ``@roles(lazy_role('log-prod'))``. With
+    `single` only the first match is used.
+    """
+    name = pattern + ':1' if single else pattern
+    if name not in env.roledefs:
+        if single:
+            env.roledefs[name] = lambda: [find_host(pattern)]
+        else:
+            env.roledefs[name] = lambda: find_hosts(pattern)
+    return name
@@ -0,0 +1,121 @@
+"""
+Compression codecs for log archives. Archives are made by piping
+`tar cf -` through the codec's program, so any stdin -> stdout compressor
+can be plugged in::
+
+    codec = get_codec('zstd', level=3, threads=0)
+    name = '20140601_host' + codec.extension
+    procs = tar_pipeline('/mnt/log/host/2014-06-01', codec, open(name, 'wb'))
+    wait(procs)
+
+"""
+import multiprocessing
+import os
+import pipes
+import subprocess
+import sys
+
+
+__all__ = ['Codec', 'CODECS', 'EXTENSIONS', 'get_codec', 'tar_pipeline',
+           'wait']
+
+
+class Codec(object):
+
+    def __init__(self, name, extension, program, threads_flag=None,
+                 level=None, threads=None, auto_threads=False):
+        self.name = name
+        self.extension = extension
+        self.program = program
+        self.threads_flag = threads_flag
+        self.level = level
+        self.threads = threads
+        # whether the program itself takes 0 threads as one per core
+        self.auto_threads = auto_threads
+
+    def configure(self, level=None, threads=None):
+        """
+        Copy of this codec using compression `level` and `threads` (0 means
+        one per core, where the program supports it).
+        """
+        return Codec(
+            self.name, self.extension, self.program, self.threads_flag,
+            self.level if level is None else level,
+            self.threads if threads is None else threads, self.auto_threads)
+
+    def command(self):
+        cmd = list(self.program)
+        if self.level is not None:
+            cmd.append('-{}'.format(self.level))
+        if self.threads is not None and self.threads_flag:
+            threads = self.threads
+            if threads == 0 and not self.auto_threads:
+                threads = multiprocessing.cpu_count()
+            cmd.append(self.threads_flag.format(threads))
+        return cmd
+
+    def shell_command(self):
+        return ' '.join(pipes.quote(arg) for arg in self.command())
+
+    def __repr__(self):
+        return '<Codec {} level={} threads={}>'.format(
+            self.name, self.level, self.threads)
+
+
+CODECS = dict((codec.name, codec) for codec in [
+    Codec('gzip', '.tar.gz', ['gzip', '-c']),
+    Codec('pigz', '.tar.gz', ['pigz', '-c'], threads_flag='-p{}'),
+    Codec('zstd', '.tar.zst', ['zstd', '-c', '-q'], threads_flag='-T{}',
+          auto_threads=True),
+    Codec('xz', '.tar.xz', ['xz', '-c'], threads_flag='-T{}',
+          auto_threads=True),
+])
+
+EXTENSIONS = sorted(set(codec.extension for codec in CODECS.itervalues()))
+
+
+def get_codec(name, level=None, threads=None):
+    if name not in CODECS:
+        raise ValueError('Unknown codec {}, expected one of {}'.format(
+            name, ', '.join(sorted(CODECS))))
+    return CODECS[name].configure(level, threads)
+
+
+def tar_pipeline(path, codec, stdout):
+    """
+    Starts `tar cf - path | codec` writing to `stdout` (a file or
+    subprocess.PIPE) and returns both processes, compressor last.
+    """
+    tar_cmd = ['tar', 'cf', '-', os.path.basename(path)]
+    tar = subprocess.Popen(
+              tar_cmd,
+              stdout=subprocess.PIPE,
+              stderr=sys.stderr,
+              cwd=os.path.dirname(path))
+    tar.args = tar_cmd
+    compressor_cmd = codec.command()
+    compressor = subprocess.Popen(
+                     compressor_cmd,
+                     stdin=tar.stdout,
+                     stdout=stdout,
+                     stderr=sys.stderr)
+    compressor.args = compressor_cmd
+    # compressor owns the read end now, so tar sees SIGPIPE if it dies
+    tar.stdout.close()
+    return tar, compressor
+
+
+def wait(procs):
+    """
+    Waits for every process in `procs` and raises RuntimeError if any of
+    them failed.
+    """
+    failed = []
+    for proc in procs:
+        if proc.wait() != 0:
+            failed.append(proc)
+    if failed:
+        raise RuntimeError(
+            'archive command(s) failed: %s' % ', '.join(
+                '"%s" (code %d)' % (' '.join(proc.args), proc.returncode)
+                for proc in failed))
@@ -174,6 +174,14 @@ class Report(object):
         self.to_addrs = to_addrs
         self.smtp_host = smtp_host
         self.smtp_creds = smtp_creds
+        self.sections = []
+
+    def attach(self, section):
+        """
+        Appends `section` (anything with a useful str, e.g. a
+        `infra.parallel.ParallelReport`) to the emailed log.
+        """
+        self.sections.append(section)
 
     def __call__(self):
         self.std_hook.detach()
@@ -187,6 +195,8 @@ class Report(object):
         # FIXME: this is probably wrong
         log = self.std_hook.log.getvalue()
         log = re.sub('\r.+?\n', '\n', log)
+        if self.sections:
+            log = '\n\n'.join([log] + [str(s) for s in self.sections])
 
         # TODO: make it pretty?
         msg = MIMEText(log)
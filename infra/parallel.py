@@ -0,0 +1,192 @@
+"""
+Runs a Fabric task over many hosts at once.
+
+Fabric's env is process global, so each host gets its own forked process
+(as in Fabric's own @parallel) with at most `workers` alive at a time. A
+host that runs past `timeout` seconds is terminated and reported as timed
+out. Results and failures are collected per host into a `ParallelReport`
+whose summary can be attached to an `infra.deploy.Report` email::
+
+    report = execute_parallel(archive, find_hosts('log-prod'), workers=8)
+    print report.summary()
+
+"""
+import cPickle as pickle
+import logging
+import multiprocessing
+import Queue
+import time
+import traceback
+
+from fabric.api import execute
+from fabric.state import connections
+
+
+__all__ = ['execute_parallel', 'ParallelReport', 'HostResult']
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+
+
+class HostResult(object):
+
+    def __init__(self, host, succeeded, result=None, error=None,
+                 duration=None, timed_out=False):
+        self.host = host
+        self.succeeded = succeeded
+        self.result = result
+        self.error = error
+        self.duration = duration
+        self.timed_out = timed_out
+
+    @property
+    def status(self):
+        if self.succeeded:
+            return 'ok'
+        if self.timed_out:
+            return 'timed out'
+        return 'failed'
+
+    def __repr__(self):
+        return '<HostResult %s %s>' % (self.host, self.status)
+
+
+class ParallelReport(object):
+
+    def __init__(self, task_name, hosts):
+        self.task_name = task_name
+        self.hosts = list(hosts)
+        self.results = {}
+        self.started_at = time.time()
+        self.finished_at = None
+
+    def add(self, host_result):
+        self.results[host_result.host] = host_result
+
+    @property
+    def succeeded(self):
+        return [
+            self.results[host] for host in self.hosts
+            if host in self.results and self.results[host].succeeded
+        ]
+
+    @property
+    def failed(self):
+        return [
+            self.results[host] for host in self.hosts
+            if host in self.results and not self.results[host].succeeded
+        ]
+
+    @property
+    def duration(self):
+        return (self.finished_at or time.time()) - self.started_at
+
+    def summary(self):
+        lines = [
+            '%s on %d host(s): %d ok, %d failed in %.1fs' % (
+                self.task_name, len(self.hosts), len(self.succeeded),
+                len(self.failed), self.duration),
+        ]
+        for host in self.hosts:
+            host_result = self.results.get(host)
+            if host_result is None:
+                lines.append('  %s: not run' % host)
+                continue
+            lines.append('  %s: %s (%.1fs)' % (
+                host, host_result.status, host_result.duration or 0.0))
+            if host_result.error:
+                lines.extend(
+                    '    ' + line
+                    for line in host_result.error.rstrip().splitlines())
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.summary()
+
+
+def _run_host(results, task, host, args, kwargs):
+    # parent's ssh sockets are shared after fork, never reuse them
+    connections.clear()
+    started_at = time.time()
+    try:
+        result = execute(task, *args, hosts=[host], **kwargs)[host]
+        try:
+            pickle.dumps(result)
+        except Exception:
+            result = repr(result)
+        results.put(HostResult(host, True, result=result,
+                               duration=time.time() - started_at))
+    except BaseException:
+        # fabric's abort() raises SystemExit, report it like any failure
+        results.put(HostResult(host, False, error=traceback.format_exc(),
+                               duration=time.time() - started_at))
+
+
+def _drain(results, report, timeout):
+    # read every result in the pipe, waiting up to `timeout` for the first
+    try:
+        report.add(results.get(timeout=timeout))
+        while True:
+            report.add(results.get_nowait())
+    except Queue.Empty:
+        pass
+
+
+def execute_parallel(task, hosts, workers=DEFAULT_WORKERS, timeout=None,
+                     args=(), kwargs=None):
+    """
+    Executes `task` once per host in `hosts` with at most `workers` hosts in
+    flight, and returns a `ParallelReport`. `timeout` is per host, in
+    seconds.
+    """
+    kwargs = kwargs or {}
+    task_name = getattr(task, 'name', None) or task.__name__
+    report = ParallelReport(task_name, hosts)
+    results = multiprocessing.Queue()
+    pending = list(hosts)
+    running = {}
+    while pending or running:
+        while pending and len(running) < workers:
+            host = pending.pop(0)
+            proc = multiprocessing.Process(
+                target=_run_host, args=(results, task, host, args, kwargs))
+            proc.daemon = True
+            proc.start()
+            logger.debug('started %s on %s (pid %s)',
+                         task_name, host, proc.pid)
+            running[host] = (proc, time.time())
+
+        # drain before joining so children never block on a full pipe
+        _drain(results, report, 0.1)
+
+        for host, (proc, started_at) in running.items():
+            if host in report.results:
+                proc.join()
+                del running[host]
+                logger.info('%s on %s %s', task_name, host,
+                            report.results[host].status)
+            elif timeout and time.time() - started_at > timeout:
+                proc.terminate()
+                proc.join()
+                del running[host]
+                report.add(HostResult(
+                    host, False, error='timed out after %ss' % timeout,
+                    duration=time.time() - started_at, timed_out=True))
+                logger.warning('%s on %s timed out', task_name, host)
+            elif not proc.is_alive():
+                if proc.exitcode == 0:
+                    # a result sent before exiting may not have been read
+                    _drain(results, report, 0.1)
+                    if host in report.results:
+                        continue
+                    error = 'exited without a result'
+                else:
+                    error = 'exited with code %s' % proc.exitcode
+                del running[host]
+                report.add(HostResult(
+                    host, False, error=error,
+                    duration=time.time() - started_at))
+                logger.warning('%s on %s died', task_name, host)
+    report.finished_at = time.time()
+    return report
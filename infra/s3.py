@@ -0,0 +1,738 @@
+import base64
+import collections
+import hashlib
+import itertools
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import random
+from StringIO import StringIO
+import threading
+import time
+
+from boto.s3.key import Key
+
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+MIN_PART_SIZE = 5 * MB
+
+MAX_PARTS = 10000
+
+DEFAULT_PART_SIZE = 64 * MB
+
+AWS_CLI_PART_SIZE = 8 * MB
+
+DEFAULT_WORKERS = 8
+
+MAX_DELETE_KEYS = 1000
+
+MAX_COPY_SIZE = 5 * 1024 * MB
+
+MAX_UPLOAD_SIZE = 5 * 1024 * MB
+
+CHUNK_SIZE = 1 * MB
+
+
+def with_retries(func, retries=3, backoff=1.0, description=None):
+    """
+    Calls `func` until it succeeds, at most `retries` more times, sleeping
+    a jittered, doubling `backoff` seconds in between.
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception, ex:
+            if attempt >= retries:
+                raise
+            delay = backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+            attempt += 1
+            logger.warning('%s failed (%s), retry %d/%d in %.1fs',
+                           description or func, ex, attempt, retries, delay)
+            time.sleep(delay)
+
+
+class Progress(object):
+    """
+    Thread safe byte counter logging progress and throughput.
+    """
+
+    def __init__(self, description, total=None):
+        self.description = description
+        self.total = total
+        self.done = 0
+        self.started_at = time.time()
+        self.first_byte_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started_at
+
+    @property
+    def throughput(self):
+        return self.done / max(self.elapsed, 0.001) / MB
+
+    @property
+    def ttfb(self):
+        if self.first_byte_at is None:
+            return None
+        return self.first_byte_at - self.started_at
+
+    def first_byte(self):
+        with self.lock:
+            if self.first_byte_at is None:
+                self.first_byte_at = time.time()
+
+    def add(self, size):
+        with self.lock:
+            self.done += size
+            done = self.done
+        if self.total:
+            logger.info('%s: %d/%d MB (%.0f%%) at %.1f MB/s',
+                        self.description, done / MB, self.total / MB,
+                        100.0 * done / self.total, self.throughput)
+        else:
+            logger.info('%s: %d MB at %.1f MB/s',
+                        self.description, done / MB, self.throughput)
+
+
+def part_ranges(size, part_size):
+    """
+    (part number, offset, length) for each part of a `size` byte object,
+    growing `part_size` if needed to stay within S3's part count limit.
+    """
+    part_size = max(part_size, MIN_PART_SIZE, -(-size // MAX_PARTS))
+    offset, part_num = 0, 1
+    while offset < size or part_num == 1:
+        length = min(part_size, size - offset)
+        yield part_num, offset, length
+        offset += length
+        part_num += 1
+
+
+class _RestartingMD5(object):
+    """
+    MD5 digest that `restart` empties again.
+    """
+
+    def __init__(self):
+        self.restart()
+
+    def restart(self):
+        self.md5 = hashlib.md5()
+
+    def update(self, data):
+        self.md5.update(data)
+
+    def digest(self):
+        return self.md5.digest()
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+class _AttemptFile(object):
+    """
+    Wraps the file boto sends from. boto seeks it back to where the data
+    starts before each retry of the PUT, which restarts `digest` too.
+    """
+
+    def __init__(self, fo, digest):
+        self.fo = fo
+        self.digest = digest
+
+    def tell(self):
+        return self.fo.tell()
+
+    def seek(self, *args):
+        self.digest.restart()
+        return self.fo.seek(*args)
+
+    def read(self, *args):
+        return self.fo.read(*args)
+
+
+def send_file(key, fo, size, headers=None, query_args=None):
+    """
+    PUTs the next `size` bytes of `fo` as `key`, reading them once: boto
+    hashes them as they are sent and checks the MD5 against the ETag. boto
+    keeps its digest across its retries of the PUT, so here it is given
+    one that each retry restarts. Returns `key`.
+    """
+    digest = _RestartingMD5()
+    # boto takes Content-Length from the key
+    key.size = size
+    # Key.send_file would hash with a digest of its own
+    key._send_file_internal(
+        _AttemptFile(fo, digest), headers=headers, query_args=query_args,
+        size=size, hash_algs={'md5': lambda: digest})
+    return key
+
+
+def send_part(mp, fo, part_num, size):
+    """
+    Uploads the next `size` bytes of `fo` as part `part_num` of `mp` with
+    `send_file`, and returns their MD5 digest.
+    """
+    key = send_file(
+        mp.bucket.new_key(mp.key_name), fo, size,
+        query_args='uploadId=%s&partNumber=%d' % (mp.id, part_num))
+    return key.local_hashes['md5']
+
+
+def check_etag(completed, digests):
+    """
+    Compares a completed multipart upload's ETag with the one expected from
+    the MD5 `digests` of its parts, by part number.
+    """
+    expected = '%s-%d' % (
+        hashlib.md5(''.join(
+            digests[i] for i in sorted(digests))).hexdigest(),
+        len(digests))
+    if completed.etag.strip('"') != expected:
+        raise RuntimeError('%s has ETag %s, expected %s' % (
+            completed.key_name, completed.etag, expected))
+
+
+class MultipartUploader(object):
+    """
+    Uploads a local file to `key_name` as a multipart upload, reading each
+    part's byte range straight from the file (no split copies) with at
+    most `workers` parts in flight. Failed parts are retried on their own;
+    if one still fails the whole upload is cancelled.
+    """
+
+    def __init__(self, s3_bucket, key_name, part_size=DEFAULT_PART_SIZE,
+                 workers=DEFAULT_WORKERS, retries=3, backoff=1.0,
+                 headers=None):
+        self.s3_bucket = s3_bucket
+        self.key_name = key_name
+        self.part_size = part_size
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.headers = headers
+
+    def upload_file(self, path):
+        size = os.path.getsize(path)
+        progress = Progress('uploading %s' % self.key_name, size)
+        mp = self.s3_bucket.initiate_multipart_upload(
+            self.key_name, headers=self.headers)
+        digests = {}
+
+        def upload_part((part_num, offset, length)):
+            def attempt():
+                with open(path, 'rb') as fo:
+                    fo.seek(offset)
+                    return send_part(mp, fo, part_num, length)
+            digests[part_num] = with_retries(
+                attempt, self.retries, self.backoff,
+                'part %d of %s' % (part_num, self.key_name))
+            progress.add(length)
+
+        pool = ThreadPool(self.workers)
+        try:
+            for _ in pool.imap_unordered(
+                    upload_part, part_ranges(size, self.part_size)):
+                pass
+            completed = mp.complete_upload()
+        except:
+            logger.error('cancelling upload of %s', self.key_name)
+            mp.cancel_upload()
+            raise
+        finally:
+            pool.terminate()
+            pool.join()
+        check_etag(completed, digests)
+        logger.info('uploaded %s (%d MB) in %.1fs at %.1f MB/s',
+                    self.key_name, size / MB, progress.elapsed,
+                    progress.throughput)
+        return completed
+
+    def upload_stream(self, fo, check=None):
+        """
+        Uploads everything read from `fo` (e.g. a subprocess's stdout) while
+        it is still being written. Parts are read `part_size` (at least
+        `MIN_PART_SIZE`) at a time and at most `workers` of them are held in
+        memory. `check` is called at
+        EOF, before the upload is completed, and can raise to cancel it.
+        Once complete the ETag S3 computed is compared with the one
+        expected from the parts' MD5s.
+        """
+        # S3 only takes smaller parts last, it would refuse to complete
+        part_size = max(self.part_size, MIN_PART_SIZE)
+        progress = Progress('streaming %s' % self.key_name)
+        mp = self.s3_bucket.initiate_multipart_upload(
+            self.key_name, headers=self.headers)
+        slots = threading.BoundedSemaphore(self.workers)
+        digests = {}
+
+        def upload_part(part_num, data):
+            try:
+                md5 = hashlib.md5(data)
+                digest = (md5.hexdigest(), base64.b64encode(md5.digest()))
+
+                def attempt():
+                    mp.upload_part_from_file(
+                        StringIO(data), part_num, md5=digest)
+                with_retries(attempt, self.retries, self.backoff,
+                             'part %d of %s' % (part_num, self.key_name))
+                digests[part_num] = md5.digest()
+                progress.add(len(data))
+            finally:
+                slots.release()
+
+        pool = ThreadPool(self.workers)
+        try:
+            results = []
+            part_num = 0
+            while True:
+                # blocks while `workers` parts are still in flight
+                slots.acquire()
+                data = fo.read(part_size)
+                if not data and part_num:
+                    slots.release()
+                    break
+                part_num += 1
+                results.append(
+                    pool.apply_async(upload_part, (part_num, data)))
+                for result in results:
+                    if result.ready() and not result.successful():
+                        result.get()
+                if len(data) < part_size:
+                    break
+            for result in results:
+                result.get()
+            if check is not None:
+                check()
+            completed = mp.complete_upload()
+        except:
+            logger.error('cancelling upload of %s', self.key_name)
+            mp.cancel_upload()
+            raise
+        finally:
+            pool.terminate()
+            pool.join()
+        check_etag(completed, digests)
+        logger.info('streamed %s (%d MB, %d parts) in %.1fs at %.1f MB/s',
+                    self.key_name, progress.done / MB, part_num,
+                    progress.elapsed, progress.throughput)
+        return completed
+
+
+class MultipartCopier(object):
+    """
+    Copies a key within S3 with `workers` concurrent UploadPartCopy
+    requests of `part_size` bytes. A single PUT copy cannot copy more than
+    5GB, and for large keys parallel parts are faster anyway. The copy
+    keeps the source's content type and metadata, as a PUT copy does.
+    """
+
+    def __init__(self, s3_bucket, part_size=DEFAULT_PART_SIZE,
+                 workers=DEFAULT_WORKERS, retries=3, backoff=1.0):
+        self.s3_bucket = s3_bucket
+        self.part_size = part_size
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+
+    def copy(self, src_key, dst_key_name):
+        """
+        Copies `src_key`, as returned by `get_key`, to `dst_key_name`.
+        """
+        progress = Progress('copying %s' % src_key.name, src_key.size)
+        headers = {}
+        if src_key.content_type:
+            headers['Content-Type'] = src_key.content_type
+        mp = self.s3_bucket.initiate_multipart_upload(
+            dst_key_name, headers=headers, metadata=src_key.metadata)
+
+        def copy_part((part_num, offset, length)):
+            def attempt():
+                mp.copy_part_from_key(
+                    src_key.bucket.name, src_key.name, part_num,
+                    offset, offset + length - 1)
+            with_retries(attempt, self.retries, self.backoff,
+                         'part %d of %s' % (part_num, dst_key_name))
+            progress.add(length)
+
+        pool = ThreadPool(self.workers)
+        try:
+            for _ in pool.imap_unordered(
+                    copy_part, part_ranges(src_key.size, self.part_size)):
+                pass
+            completed = mp.complete_upload()
+        except:
+            logger.error('cancelling copy of %s to %s',
+                         src_key.name, dst_key_name)
+            mp.cancel_upload()
+            raise
+        finally:
+            pool.terminate()
+            pool.join()
+        logger.info('copied %s to %s (%d MB) in %.1fs at %.1f MB/s',
+                    src_key.name, dst_key_name, src_key.size / MB,
+                    progress.elapsed, progress.throughput)
+        return completed
+
+
+class RangedDownloader(object):
+    """
+    Downloads keys with concurrent HTTP range GETs of `part_size` bytes, at
+    most `workers` of them in flight. Failed ranges are retried on their
+    own. The returned `Progress` carries the time to first byte and the
+    throughput.
+    """
+
+    def __init__(self, s3_bucket, part_size=DEFAULT_PART_SIZE,
+                 workers=DEFAULT_WORKERS, retries=3, backoff=1.0):
+        self.s3_bucket = s3_bucket
+        self.part_size = part_size
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+
+    def _read_range(self, key_name, offset, length, write, progress):
+        key = Key(self.s3_bucket, key_name)
+        key.open_read(headers={
+            'Range': 'bytes=%d-%d' % (offset, offset + length - 1)})
+        try:
+            remaining = length
+            while remaining:
+                data = key.resp.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    raise IOError('%s: short read at %d, %d byte(s) missing'
+                                  % (key_name, offset + length - remaining,
+                                     remaining))
+                progress.first_byte()
+                write(data)
+                remaining -= len(data)
+        finally:
+            key.close()
+
+    def _download_range(self, key_name, path, offset, length, progress):
+        def attempt():
+            with open(path, 'r+b') as fo:
+                fo.seek(offset)
+                self._read_range(key_name, offset, length, fo.write, progress)
+        with_retries(attempt, self.retries, self.backoff,
+                     'bytes %d-%d of %s' % (offset, offset + length - 1,
+                                            key_name))
+        progress.add(length)
+
+    def _fetch_range(self, key_name, offset, length, progress):
+        def attempt():
+            buf = StringIO()
+            self._read_range(key_name, offset, length, buf.write, progress)
+            return buf.getvalue()
+        data = with_retries(attempt, self.retries, self.backoff,
+                            'bytes %d-%d of %s' % (offset, offset + length - 1,
+                                                   key_name))
+        progress.add(length)
+        return data
+
+    def download_files(self, items, description=None):
+        """
+        Downloads each (key name, size, path) in `items`. Every file is
+        preallocated to its full size and ranges are written in place at
+        their offsets, with all files' ranges sharing one pool.
+        """
+        total = sum(size for _, size, _ in items)
+        progress = Progress(
+            description or 'downloading %d key(s)' % len(items), total)
+        ranges = []
+        for key_name, size, path in items:
+            with open(path, 'wb') as fo:
+                fo.truncate(size)
+            ranges.extend(
+                (key_name, path, offset, length)
+                for _, offset, length in part_ranges(size, self.part_size)
+                if length)
+
+        def download_range((key_name, path, offset, length)):
+            self._download_range(key_name, path, offset, length, progress)
+
+        pool = ThreadPool(self.workers)
+        try:
+            for _ in pool.imap_unordered(download_range, ranges):
+                pass
+        finally:
+            pool.terminate()
+            pool.join()
+        logger.info('downloaded %d key(s) (%d MB) in %.1fs, first byte after '
+                    '%.2fs, at %.1f MB/s', len(items), total / MB,
+                    progress.elapsed, progress.ttfb or 0.0,
+                    progress.throughput)
+        return progress
+
+    def download_file(self, key_name, path, size=None):
+        if size is None:
+            size = self.s3_bucket.get_key(key_name).size
+        return self.download_files(
+            [(key_name, size, path)], 'downloading %s' % key_name)
+
+    def download_stream(self, key_name, fo, size=None):
+        """
+        Writes `key_name` to `fo` (e.g. a subprocess's stdin) in order while
+        later ranges are still downloading. At most `workers` ranges are
+        held in memory.
+        """
+        if size is None:
+            size = self.s3_bucket.get_key(key_name).size
+        progress = Progress('downloading %s' % key_name, size)
+        ranges = iter([
+            (offset, length)
+            for _, offset, length in part_ranges(size, self.part_size)
+            if length])
+        pool = ThreadPool(self.workers)
+        try:
+            pending = collections.deque()
+            for offset, length in itertools.islice(ranges, self.workers):
+                pending.append(pool.apply_async(
+                    self._fetch_range, (key_name, offset, length, progress)))
+            while pending:
+                fo.write(pending.popleft().get())
+                for offset, length in itertools.islice(ranges, 1):
+                    pending.append(pool.apply_async(
+                        self._fetch_range,
+                        (key_name, offset, length, progress)))
+        finally:
+            pool.terminate()
+            pool.join()
+        logger.info('downloaded %s (%d MB) in %.1fs, first byte after '
+                    '%.2fs, at %.1f MB/s', key_name, size / MB,
+                    progress.elapsed, progress.ttfb or 0.0,
+                    progress.throughput)
+        return progress
+
+
+class ETagHasher(object):
+    """
+    Computes the ETag S3 gives an object from its data, written to it in
+    order (and passed on to `fo`, if given). A multipart ETag depends on
+    the part size of the upload, which S3 does not record, so the data is
+    hashed for each of the `part_sizes` known to be used by our uploads and
+    aws-cli's that give as many parts as the ETag has. If there are none
+    the ETag is not `verifiable`, and if none match the data may just have
+    been uploaded in parts of another size: neither is an error.
+    """
+
+    part_sizes = (DEFAULT_PART_SIZE, AWS_CLI_PART_SIZE)
+
+    def __init__(self, etag, size, fo=None, part_sizes=None):
+        self.etag = etag.strip('"')
+        self.fo = fo
+        self.multipart = '-' in self.etag
+        if not self.multipart:
+            self.hashers = [_PartHasher(None)]
+        else:
+            parts = int(self.etag.rsplit('-', 1)[1])
+            # grown as part_ranges does for large objects
+            candidates = set(
+                max(part_size, MIN_PART_SIZE, -(-size // MAX_PARTS))
+                for part_size in part_sizes or self.part_sizes)
+            self.hashers = [
+                _PartHasher(part_size) for part_size in sorted(candidates)
+                if max(-(-size // part_size), 1) == parts]
+        self.verifiable = bool(self.hashers)
+
+    def write(self, data):
+        if self.fo is not None:
+            self.fo.write(data)
+        for hasher in self.hashers:
+            hasher.write(data)
+
+    def hexdigests(self):
+        return [hasher.hexdigest() for hasher in self.hashers]
+
+    def matches(self):
+        return self.etag in self.hexdigests()
+
+    def hash_file(self, path):
+        with open(path, 'rb') as fo:
+            for data in iter(lambda: fo.read(CHUNK_SIZE), ''):
+                self.write(data)
+        return self
+
+    def check(self, name):
+        """
+        Whether the data hashed matches the ETag. Raises IOError if it does
+        not match a single part ETag.
+        """
+        if self.matches():
+            return True
+        if self.multipart:
+            logger.info('cannot verify %s, part size of multipart ETag %s '
+                        'unknown', name, self.etag)
+            return False
+        raise IOError('%s has ETag %s, data hashes to %s' % (
+            name, self.etag, self.hexdigests()[0]))
+
+
+class _PartHasher(object):
+    """
+    ETag of data uploaded in `part_size` parts, or in one if None.
+    """
+
+    def __init__(self, part_size):
+        self.part_size = part_size
+        self.md5 = hashlib.md5()
+        self.part_done = 0
+        self.digests = []
+
+    def write(self, data):
+        if self.part_size is None:
+            self.md5.update(data)
+            return
+        while data:
+            length = min(len(data), self.part_size - self.part_done)
+            self.md5.update(data[:length])
+            self.part_done += length
+            data = data[length:]
+            if self.part_done == self.part_size:
+                self.digests.append(self.md5.digest())
+                self.md5 = hashlib.md5()
+                self.part_done = 0
+
+    def hexdigest(self):
+        if self.part_size is None:
+            return self.md5.hexdigest()
+        digests = list(self.digests)
+        if self.part_done or not digests:
+            digests.append(self.md5.digest())
+        return '%s-%d' % (
+            hashlib.md5(''.join(digests)).hexdigest(), len(digests))
+
+
+class KeyIndex(object):
+    """
+    In-memory set of the key names in a bucket, filled by listing instead
+    of a HEAD per key. With `prefix_len` each distinct leading
+    `prefix_len` characters of the names asked about are listed once
+    (e.g. 8 for our YYYYMMDD_ archive names), otherwise the whole bucket is
+    listed on first use. `list_keys(prefix)` returns the key names starting
+    with `prefix`.
+    """
+
+    def __init__(self, list_keys, prefix_len=None):
+        self.list_keys = list_keys
+        self.prefix_len = prefix_len
+        self.names = set()
+        self.listed = set()
+        self.lock = threading.Lock()
+
+    def _prefix(self, name):
+        if self.prefix_len is None:
+            return ''
+        return name[:self.prefix_len]
+
+    def refresh(self, prefix=''):
+        names = set(self.list_keys(prefix))
+        logger.debug('listed %d key(s) with prefix "%s"', len(names), prefix)
+        with self.lock:
+            self.names = set(
+                name for name in self.names if not name.startswith(prefix))
+            self.names.update(names)
+            self.listed.add(prefix)
+
+    def __contains__(self, name):
+        prefix = self._prefix(name)
+        with self.lock:
+            listed = prefix in self.listed or '' in self.listed
+        if not listed:
+            self.refresh(prefix)
+        with self.lock:
+            return name in self.names
+
+    def add(self, name):
+        with self.lock:
+            self.names.add(name)
+
+    def discard(self, name):
+        with self.lock:
+            self.names.discard(name)
+
+
+def bucket_key_index(s3_bucket, prefix_len=None):
+    """
+    `KeyIndex` of `s3_bucket` using paginated boto listings.
+    """
+    def list_keys(prefix):
+        return (key.name for key in s3_bucket.list(prefix=prefix))
+
+    return KeyIndex(list_keys, prefix_len)
+
+
+DeleteFailure = collections.namedtuple('DeleteFailure', 'key code message')
+
+
+class BatchDeleter(object):
+    """
+    Collects key names and deletes them `batch_size` at a time with S3's
+    multi-object delete, one request per batch instead of one per key. Use
+    it as a context manager so the last, partial batch is flushed.
+
+    Keys S3 fails to delete are collected in `errors`, as are all the keys
+    of a batch whose request still fails after its retries, and `deleted`
+    counts the keys confirmed deleted. Flushing never raises.
+    """
+
+    def __init__(self, s3_bucket, batch_size=MAX_DELETE_KEYS, dry=False,
+                 retries=3, backoff=1.0):
+        self.s3_bucket = s3_bucket
+        self.batch_size = min(batch_size, MAX_DELETE_KEYS)
+        self.dry = dry
+        self.retries = retries
+        self.backoff = backoff
+        self.pending = []
+        self.deleted = 0
+        self.errors = []
+
+    def add(self, name):
+        self.pending.append(name)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        names, self.pending = self.pending, []
+        if not names:
+            return
+        if self.dry:
+            logger.info('would delete %d key(s) from %s',
+                        len(names), self.s3_bucket.name)
+            self.deleted += len(names)
+            return
+
+        def attempt():
+            return self.s3_bucket.delete_keys(names, quiet=True)
+
+        try:
+            result = with_retries(
+                attempt, self.retries, self.backoff,
+                'deleting %d key(s) from %s' % (
+                    len(names), self.s3_bucket.name))
+        except Exception, ex:
+            logger.error('deleting %d key(s) from %s failed: %s',
+                         len(names), self.s3_bucket.name, ex)
+            self.errors.extend(
+                DeleteFailure(name, type(ex).__name__, str(ex))
+                for name in names)
+            return
+        for error in result.errors:
+            logger.error('deleting %s from %s failed: %s %s', error.key,
+                         self.s3_bucket.name, error.code, error.message)
+        self.errors.extend(result.errors)
+        self.deleted += len(names) - len(result.errors)
+        logger.debug('deleted %d key(s) from %s',
+                     len(names) - len(result.errors), self.s3_bucket.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.flush()
@@ -0,0 +1,348 @@
+"""
+Shared S3 connection for scripts making many concurrent requests from one
+process::
+
+    s3_cxn = connect(aws_access_key, aws_secret_key)
+    s3_bucket = s3_cxn.bucket(s3_bucket_name)
+    ...
+    logger.info('%s', s3_cxn.utilisation())
+
+boto already reuses HTTP connections from a thread safe pool, but keeps
+every connection it ever opened and retries a failed request up to 6
+times, sleeping an uncapped random.random() * 2 ** attempt seconds in
+between. Here the connections kept per host, the socket timeout and the
+backoff are bounded, and set either by argument or by the OPS_S3_*
+environment variables.
+
+With `hedge` the idempotent metadata requests (HEADs and bucket GETs such
+as listing pages) are hedged: when a request has not completed within the
+`hedge_percentile` latency of its recent requests, a duplicate is sent and
+whichever completes first is used. Either way the request fails with an
+IOError once past its `deadline`, rather than stalling the caller on one
+slow response.
+"""
+import collections
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import Queue
+import random
+import sys
+import threading
+import time
+
+from boto.connection import ConnectionPool, HostConnectionPool
+from boto.exception import BotoServerError, PleaseRetryException
+from boto.s3.connection import S3Connection
+
+
+__all__ = [
+    'POOL_SIZE', 'TIMEOUT', 'RETRIES', 'BACKOFF', 'MAX_BACKOFF',
+    'HEDGE_PERCENTILE', 'DEADLINE', 'BoundedConnectionPool', 'Latencies',
+    'PooledS3Connection', 'connect',
+]
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZE = int(os.environ.get('OPS_S3_POOL_SIZE', 32))
+
+TIMEOUT = float(os.environ.get('OPS_S3_TIMEOUT', 60))
+
+RETRIES = int(os.environ.get('OPS_S3_RETRIES', 5))
+
+BACKOFF = float(os.environ.get('OPS_S3_BACKOFF', 0.2))
+
+MAX_BACKOFF = float(os.environ.get('OPS_S3_MAX_BACKOFF', 20))
+
+HEDGE_PERCENTILE = float(os.environ.get('OPS_S3_HEDGE_PERCENTILE', 95))
+
+DEADLINE = float(os.environ.get('OPS_S3_DEADLINE', 30))
+
+RETRY_ERROR_CODES = ['InternalError', 'RequestTimeout', 'SlowDown']
+
+
+class BoundedConnectionPool(ConnectionPool):
+    """
+    boto's `ConnectionPool` keeping at most `size` connections per host.
+    Connections returned to a full pool are dropped, and closed once their
+    response has been read.
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        ConnectionPool.__init__(self)
+        self.max_size = size
+        self.discarded = 0
+
+    def put_http_connection(self, host, port, is_secure, conn):
+        with self.mutex:
+            key = (host, port, is_secure)
+            if key not in self.host_to_pool:
+                self.host_to_pool[key] = HostConnectionPool()
+            if self.host_to_pool[key].size() >= self.max_size:
+                self.discarded += 1
+                return
+            self.host_to_pool[key].put(conn)
+
+
+class Latencies(object):
+    """
+    The last `size` latencies, in seconds, of an operation. Percentiles
+    are only given once there are `min_samples` of them.
+    """
+
+    min_samples = 20
+
+    def __init__(self, size=1000):
+        self.samples = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, latency):
+        with self.lock:
+            self.samples.append(latency)
+
+    def percentile(self, percent):
+        with self.lock:
+            samples = sorted(self.samples)
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(int(len(samples) * percent / 100.0),
+                           len(samples) - 1)]
+
+
+class PooledS3Connection(S3Connection):
+    """
+    `S3Connection` with a `BoundedConnectionPool`, a socket `timeout` and
+    requests retried `retries` times with a jittered, doubling `backoff`
+    capped at `max_backoff` seconds. It counts requests, retries and
+    connections for `utilisation`. Metadata requests are hedged if `hedge`.
+    """
+
+    def __init__(self, aws_access_key_id=None, aws_secret_access_key=None,
+                 pool_size=POOL_SIZE, timeout=TIMEOUT, retries=RETRIES,
+                 backoff=BACKOFF, max_backoff=MAX_BACKOFF, hedge=False,
+                 hedge_percentile=HEDGE_PERCENTILE, deadline=DEADLINE,
+                 **kwargs):
+        S3Connection.__init__(
+            self, aws_access_key_id, aws_secret_access_key, **kwargs)
+        self._pool = BoundedConnectionPool(pool_size)
+        self.http_connection_kwargs['timeout'] = timeout
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stats = collections.Counter()
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.deadline = deadline
+        self.latencies = collections.defaultdict(Latencies)
+        self._hedge_pool = None
+
+    def _count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def bucket(self, name):
+        """
+        `Bucket` for `name`, created once and not validated.
+        """
+        with self.lock:
+            if name not in self.buckets:
+                self.buckets[name] = self.bucket_class(self, name)
+            return self.buckets[name]
+
+    def get_http_connection(self, host, port, is_secure):
+        conn = self._pool.get_http_connection(host, port, is_secure)
+        if conn is None:
+            return self.new_http_connection(host, port, is_secure)
+        self._count('reused')
+        return conn
+
+    def new_http_connection(self, host, port, is_secure):
+        self._count('opened')
+        return S3Connection.new_http_connection(self, host, port, is_secure)
+
+    def retryable(self, ex):
+        if isinstance(ex, BotoServerError):
+            return ex.status >= 500 or ex.error_code in RETRY_ERROR_CODES
+        return (isinstance(ex, self.http_exceptions) and
+                not isinstance(ex, tuple(self.http_unretryable_exceptions)))
+
+    def delay(self, attempt):
+        return (min(self.backoff * 2 ** attempt, self.max_backoff) *
+                random.uniform(0.5, 1.5))
+
+    def _mexe(self, request, sender=None, override_num_retries=None,
+              retry_handler=None):
+        # boto gets a single try and retries are done here, with our
+        # backoff. boto still sleeps up to a second itself before giving up
+        # on a try.
+        retries = self.retries
+        if override_num_retries is not None:
+            retries = override_num_retries
+        if sender is not None:
+            sender = self._error_body_sender(sender)
+        with self.lock:
+            self.stats['requests'] += 1
+            self.in_flight += 1
+            self.stats['peak_in_flight'] = max(
+                self.stats['peak_in_flight'], self.in_flight)
+        try:
+            attempt = 0
+            while True:
+                try:
+                    return S3Connection._mexe(
+                        self, request, sender, 0, retry_handler)
+                except Exception, ex:
+                    if attempt >= retries or not self.retryable(ex):
+                        raise
+                    # drops the traceback, and with it the failed
+                    # connection, before waiting
+                    sys.exc_clear()
+                    delay = self.delay(attempt)
+                    attempt += 1
+                    self._count('retries')
+                    logger.warning(
+                        '%s %s failed (%s), retry %d/%d in %.1fs',
+                        request.method, request.path, ex, attempt, retries,
+                        delay)
+                    time.sleep(delay)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    @staticmethod
+    def _error_body_sender(sender):
+        """
+        Wraps a boto `sender` (as used to PUT file contents) so that S3
+        errors it asks boto to retry, like a 400 RequestTimeout, are raised
+        with their body. boto would raise them from its last try without
+        one, and so without the error code `retryable` needs.
+
+        Senders are retried as is, so they must not keep state across
+        tries. boto's send_file keeps the MD5 it computes while sending:
+        use `infra.s3.send_file`, which restarts it.
+        """
+        def send(http_conn, method, path, data, headers):
+            try:
+                return sender(http_conn, method, path, data, headers)
+            except PleaseRetryException, ex:
+                raise BotoServerError(
+                    ex.response.status, ex.response.reason,
+                    ex.response.read())
+
+        return send
+
+    def make_request(self, method, bucket='', key='', headers=None, data='',
+                     query_args=None, sender=None, override_num_retries=None,
+                     retry_handler=None):
+        args = (method, bucket, key, headers, data, query_args, sender,
+                override_num_retries, retry_handler)
+        if self.hedge and (method == 'HEAD' or (method == 'GET' and not key)):
+            return self._hedged('HEAD' if key else 'GET bucket', args)
+        return S3Connection.make_request(self, *args)
+
+    def _hedged(self, operation, args):
+        # the caller waits on `results` without a timeout, the hedge and the
+        # deadline are fired by a watcher thread
+        with self.lock:
+            if self._hedge_pool is None:
+                self._hedge_pool = ThreadPool(2 * self.pool_size)
+            latencies = self.latencies[operation]
+        delay = latencies.percentile(self.hedge_percentile)
+        started_at = time.time()
+        results = Queue.Queue()
+        done = threading.Event()
+        attempts = [False]
+
+        def attempt(hedged):
+            attempt_args = list(args)
+            # boto adds the signature to the headers it is given
+            attempt_args[3] = dict(args[3] or {})
+            attempt_started_at = time.time()
+            try:
+                response = S3Connection.make_request(self, *attempt_args)
+                # boto caches the body for the caller's read()
+                response.read()
+            except Exception, ex:
+                results.put((hedged, None, ex))
+                return
+            latencies.add(time.time() - attempt_started_at)
+            results.put((hedged, response, None))
+
+        def watch():
+            if delay is not None and delay < self.deadline:
+                if done.wait(delay):
+                    return
+                self._count('hedged')
+                attempts.append(True)
+                logger.debug('%s %s/%s not done after %.3fs, hedging',
+                             operation, args[1], args[2], delay)
+                self._hedge_pool.apply_async(attempt, (True,))
+            if not done.wait(started_at + self.deadline - time.time()):
+                results.put((None, None, IOError(
+                    '%s %s/%s not done within %gs deadline' % (
+                        args[0], args[1], args[2], self.deadline))))
+
+        self._hedge_pool.apply_async(attempt, (False,))
+        watcher = threading.Thread(target=watch)
+        watcher.daemon = True
+        watcher.start()
+        try:
+            failed = 0
+            while True:
+                hedged, response, ex = results.get()
+                if ex is None:
+                    if hedged:
+                        self._count('hedge_wins')
+                    return response
+                if hedged is None:
+                    self._count('past_deadline')
+                    raise ex
+                failed += 1
+                # the other attempt, if there is one, may still succeed
+                if failed >= len(attempts):
+                    raise ex
+                logger.debug('%s %s/%s attempt failed (%s)',
+                             operation, args[1], args[2], ex)
+        finally:
+            done.set()
+
+    def utilisation(self):
+        with self.lock:
+            stats = dict(self.stats, in_flight=self.in_flight)
+        stats.update(
+            pool_size=self.pool_size, idle=self._pool.size(),
+            discarded=self._pool.discarded)
+        stats = collections.defaultdict(int, stats)
+        summary = (
+            '%(requests)d request(s), %(retries)d retried, %(in_flight)d in '
+            'flight (peak %(peak_in_flight)d, pool of %(pool_size)d), '
+            'connections: %(opened)d opened, %(reused)d reused, '
+            '%(discarded)d discarded, %(idle)d pooled' % stats)
+        if self.hedge:
+            summary += (
+                ', %(hedged)d hedged (%(hedge_wins)d won), '
+                '%(past_deadline)d past deadline' % stats)
+        return summary
+
+
+_connections = {}
+
+_connections_lock = threading.Lock()
+
+
+def connect(aws_access_key, aws_secret_key, **kwargs):
+    """
+    The `PooledS3Connection` shared by all callers with these credentials
+    and settings, created on first use.
+    """
+    key = (aws_access_key, aws_secret_key, tuple(sorted(kwargs.items())))
+    with _connections_lock:
+        if key not in _connections:
+            logger.debug('creating connection')
+            _connections[key] = PooledS3Connection(
+                aws_access_key, aws_secret_key, **kwargs)
+        return _connections[key]
@@ -0,0 +1,174 @@
+"""
+On-disk SQLite index of the keys in an S3 bucket, so pipelines that list
+the same bucket several times a day do not re-list it from scratch::
+
+    index = BucketIndex(s3_bucket)
+    index.update()
+    for entry in index.keys(prefix='20140601'):
+        print entry.name, entry.size
+
+Our buckets mostly grow at the end (keys start with a timestamp), so an
+update only lists the keys after the last one indexed. Keys deleted,
+overwritten or added earlier in the keyspace by someone else are only
+picked up by a full listing, done once the index is older than `ttl`
+seconds or when asked for with `fresh`.
+"""
+import collections
+import logging
+import os
+import sqlite3
+import time
+
+from boto.s3.bucketlistresultset import bucket_lister
+
+
+__all__ = ['INDEX_PATH', 'INDEX_TTL', 'Entry', 'BucketIndex']
+
+logger = logging.getLogger(__name__)
+
+INDEX_PATH = os.environ.get(
+    'OPS_S3_INDEX_PATH', os.path.expanduser('~/.cache/ops/s3-{bucket}.db'))
+
+INDEX_TTL = int(os.environ.get('OPS_S3_INDEX_TTL', 24 * 60 * 60))
+
+Entry = collections.namedtuple('Entry', 'name size etag last_modified')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (
+    name TEXT PRIMARY KEY,
+    size INTEGER,
+    etag TEXT,
+    last_modified TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value REAL
+);
+"""
+
+
+class BucketIndex(object):
+
+    batch_size = 1000
+
+    def __init__(self, s3_bucket, path=INDEX_PATH, ttl=INDEX_TTL):
+        self.s3_bucket = s3_bucket
+        self.path = path.format(bucket=s3_bucket.name)
+        self.ttl = ttl
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            dir_path = os.path.dirname(self.path)
+            if dir_path and not os.path.isdir(dir_path):
+                os.makedirs(dir_path)
+            self._db = sqlite3.connect(self.path)
+            self._db.text_factory = str
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def _meta(self, name):
+        row = self.db.execute(
+            'SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, name, value):
+        self.db.execute(
+            'INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)',
+            (name, value))
+
+    @property
+    def listed_at(self):
+        """
+        When the whole bucket was last listed, None if never.
+        """
+        return self._meta('listed_at')
+
+    @property
+    def updated_at(self):
+        return self._meta('updated_at')
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM keys').fetchone()[0]
+
+    def staleness(self):
+        def ago(ts):
+            return '%ds ago' % (time.time() - ts) if ts else 'never'
+
+        return '%s index: %d key(s), fully listed %s, updated %s' % (
+            self.s3_bucket.name, len(self), ago(self.listed_at),
+            ago(self.updated_at))
+
+    def _add(self, keys):
+        count = 0
+        rows = []
+        for key in keys:
+            rows.append((key.name, key.size, key.etag, key.last_modified))
+            if len(rows) >= self.batch_size:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?)', rows)
+                count += len(rows)
+                rows = []
+        self.db.executemany(
+            'INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?)', rows)
+        return count + len(rows)
+
+    def update(self, fresh=False):
+        """
+        Lists the keys after the last one indexed, or the whole bucket if
+        `fresh` or the last full listing is older than `ttl`.
+        """
+        started_at = time.time()
+        listed_at = self.listed_at
+        if fresh or listed_at is None or started_at - listed_at > self.ttl:
+            self.db.execute('DELETE FROM keys')
+            count = self._add(bucket_lister(self.s3_bucket))
+            self._set_meta('listed_at', started_at)
+            logger.info('indexed %d key(s) of %s in %.1fs',
+                        count, self.s3_bucket.name, time.time() - started_at)
+        else:
+            marker = self.db.execute(
+                'SELECT MAX(name) FROM keys').fetchone()[0] or ''
+            count = self._add(bucket_lister(self.s3_bucket, marker=marker))
+            logger.info('indexed %d new key(s) of %s after "%s" in %.1fs',
+                        count, self.s3_bucket.name, marker,
+                        time.time() - started_at)
+        self._set_meta('updated_at', started_at)
+        self.db.commit()
+        return count
+
+    def get(self, name):
+        row = self.db.execute(
+            'SELECT * FROM keys WHERE name = ?', (name,)).fetchone()
+        return Entry(*row) if row else None
+
+    def keys(self, prefix='', after=None, before=None):
+        """
+        `Entry`s with names starting with `prefix` in order, optionally only
+        those last modified within [`after`, `before`], given as S3
+        formatted timestamps.
+        """
+        query = 'SELECT * FROM keys WHERE name >= ?'
+        params = [prefix]
+        if after:
+            query += ' AND last_modified >= ?'
+            params.append(after)
+        if before:
+            # last_modified has milliseconds `before` does not
+            query += ' AND substr(last_modified, 1, ?) <= ?'
+            params.extend([len(before), before])
+        for row in self.db.execute(query + ' ORDER BY name', params):
+            if not row[0].startswith(prefix):
+                break
+            yield Entry(*row)
+
+    def discard(self, names):
+        self.db.executemany(
+            'DELETE FROM keys WHERE name = ?', ((name,) for name in names))
+        self.db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -10,10 +10,21 @@ usage::
     with make_tunnel('user@192.168.0.2:10022') as t:
         run('pwd')
 
+`tunnel()` hands out tunnels from `pool`, which keeps them (and the Fabric
+connection through them) warm between uses::
+
+    env.tunnel_hoststring = 'user@192.168.0.2:10022'
+    with tunnel():
+        run('pwd')
+
 """
+import atexit
+import errno
 import hashlib
 import logging
+import Queue
 import select
+import socket
 import SocketServer
 #import random
 import time
@@ -24,22 +35,34 @@ from fabric.network import join_host_strings, normalize
 from fabric.state import connections
 
 
-__all__ = ['tunnel', 'make_tunnel']
+__all__ = ['tunnel', 'make_tunnel', 'pool']
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+DEFAULT_MAX_CHANNELS = 256
+
+DEFAULT_IDLE_TIMEOUT = 300
+
 
 def tunnel():
     KEY = 'tunnel_hoststring'
 
     if hasattr(env, KEY):
-        return make_tunnel(getattr(env, KEY))
+        return pool.acquire(getattr(env, KEY))
     else:
         return NullTunnel()
 
 
 def make_tunnel(tunnel=None, remote=None, local_port=None,
-                teardown_timeout=None):
+                teardown_timeout=None, buffer_size=DEFAULT_BUFFER_SIZE,
+                backend='threads', max_channels=DEFAULT_MAX_CHANNELS):
+    """
+    `backend` is either 'threads' (a thread per forwarded connection) or
+    'events' (every connection multiplexed on one thread, at most
+    `max_channels` open at once).
+    """
     if remote is None:
         remote = env.host_string
     username, remote_hostname, remote_port = normalize(remote)
@@ -55,7 +78,10 @@ def make_tunnel(tunnel=None, remote=None, local_port=None,
                remote_hostname, remote_port,
                local_port,
                client.get_transport(),
-               teardown_timeout)
+               teardown_timeout,
+               buffer_size,
+               backend,
+               max_channels)
 
 
 def port_from_host(hoststring):
@@ -78,15 +104,25 @@ class NullTunnel():
 
 class TunnelThread(threading.Thread):
     def __init__(self, remote_host, remote_port, local_port, transport,
-                 teardown_timeout=None):
+                 teardown_timeout=None, buffer_size=DEFAULT_BUFFER_SIZE,
+                 backend='threads', max_channels=DEFAULT_MAX_CHANNELS):
         threading.Thread.__init__(self)
+        self.transport = transport
 
         class SubHander (Handler):
             chain_host = remote_host
             chain_port = int(remote_port, 10)
             ssh_transport = transport
 
-        self.server = ForwardServer(('127.0.0.1', local_port), SubHander)
+        SubHander.buffer_size = buffer_size
+
+        if backend == 'threads':
+            self.server = ForwardServer(('127.0.0.1', local_port), SubHander)
+        elif backend == 'events':
+            self.server = EventForwardServer(
+                ('127.0.0.1', local_port), SubHander, max_channels)
+        else:
+            raise ValueError('Unknown tunnel backend %r' % backend)
         _addr, port = self.server.server_address
         self.local_port = port
         self.teardown_timeout = teardown_timeout
@@ -94,10 +130,20 @@ class TunnelThread(threading.Thread):
     def run(self):
         self.server.serve_forever()
 
+    def local_host_string(self):
+        return join_host_strings(env.user, '127.0.0.1', self.local_port)
+
+    def close(self):
+        host_string = self.local_host_string()
+        if host_string in connections:
+            connections[host_string].close()
+            del connections[host_string]
+
+        self.server.shutdown()
+
     def __enter__(self):
         self.old_env = env.user, env.host, env.port, env.host_string
-        env.host_string = join_host_strings(env.user, '127.0.0.1',
-                                            self.local_port)
+        env.host_string = self.local_host_string()
         env.host = '127.0.0.1'
         env.port = self.local_port
 
@@ -113,11 +159,7 @@ class TunnelThread(threading.Thread):
                     self.teardown_timeout)
             time.sleep(self.teardown_timeout)
 
-        if env.host_string in connections:
-            connections[env.host_string].close()
-            del connections[env.host_string]
-
-        self.server.shutdown()
+        self.close()
 
         env.user, env.host, env.port, env.host_string = self.old_env
 
@@ -127,14 +169,252 @@ class TunnelThread(threading.Thread):
         return '-e "ssh -p %d -i %s"' % (self.local_port, env.key_filename)
 
 
-class ForwardServer(SocketServer.ThreadingTCPServer):
+class PooledTunnel(object):
+    """
+    Reference counted handle on a warm `TunnelThread`. Entering points env
+    at the tunnel, exiting puts env back but leaves the tunnel and its
+    Fabric connection open for the next user.
+    """
+
+    def __init__(self, pool, key, tunnel_thread):
+        self.pool = pool
+        self.key = key
+        self.tunnel = tunnel_thread
+        self.refs = 0
+        self.last_used = time.time()
+        self.old_envs = []
+
+    @property
+    def local_port(self):
+        return self.tunnel.local_port
+
+    @property
+    def healthy(self):
+        transport = self.tunnel.transport
+        return (
+            self.tunnel.is_alive() and
+            transport is not None and
+            transport.is_active()
+        )
+
+    def __enter__(self):
+        self.old_envs.append(
+            (env.user, env.host, env.port, env.host_string,
+             env.get('tunnel')))
+        env.host_string = self.tunnel.local_host_string()
+        env.host = '127.0.0.1'
+        env.port = self.local_port
+        env.tunnel = self
+        return self
+
+    def __exit__(self, *exc):
+        (env.user, env.host, env.port, env.host_string,
+         old_tunnel) = self.old_envs.pop()
+        if old_tunnel is None:
+            del env['tunnel']
+        else:
+            env.tunnel = old_tunnel
+        self.pool.release(self)
+
+    def rsync_shell_option(self):
+        return self.tunnel.rsync_shell_option()
+
+
+class TunnelPool(object):
+    """
+    Warm tunnels keyed by (tunnel_hoststring, remote). A tunnel is rebuilt
+    when its SSH transport dies and closed once nobody has used it for
+    `idle_timeout` seconds. Tunnels are opened outside the pool lock, so a
+    slow bastion only holds up the callers waiting on its tunnels, and a
+    dead tunnel still in use is only closed once its last user is done.
+    """
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.tunnels = {}
+        # key -> Event set once the tunnel being opened is pooled (or not)
+        self.opening = {}
+        # tunnel_hoststring -> Lock, Fabric's connection cache isn't safe
+        # to fill from many threads
+        self.connect_locks = {}
+        # dead tunnels that are still referenced
+        self.retired = set()
+
+    def acquire(self, tunnel_hoststring, remote=None, **kwargs):
+        if remote is None:
+            remote = env.host_string
+        key = (tunnel_hoststring, remote)
+        while True:
+            with self.lock:
+                closing = self._evict_idle()
+                pooled = self.tunnels.get(key)
+                if pooled is not None and not pooled.healthy:
+                    verbose('Tunnel %r -> %r is unhealthy, reopening' % key)
+                    closing.extend(self._retire(pooled))
+                    self._drop_connection(tunnel_hoststring)
+                    pooled = None
+                if pooled is not None:
+                    pooled.refs += 1
+                    pooled.last_used = time.time()
+                    break
+                opened = self.opening.get(key)
+                if opened is None:
+                    opened = self.opening[key] = threading.Event()
+                    connect_lock = self.connect_locks.setdefault(
+                        tunnel_hoststring, threading.Lock())
+                    break
+            self._close(closing)
+            # another caller is opening it, use theirs once it is pooled
+            opened.wait()
+        self._close(closing)
+        if pooled is None:
+            pooled = self._open(key, opened, connect_lock, kwargs)
+        return pooled
+
+    def release(self, pooled):
+        with self.lock:
+            pooled.refs -= 1
+            pooled.last_used = time.time()
+            closing = pooled in self.retired and pooled.refs <= 0
+            if closing:
+                self.retired.discard(pooled)
+        if closing:
+            self._close([pooled])
+
+    def evict_idle(self):
+        with self.lock:
+            evicted = self._evict_idle()
+        self._close(evicted)
+        return len(evicted)
+
+    def close_all(self):
+        with self.lock:
+            closing = self.tunnels.values() + list(self.retired)
+            self.tunnels.clear()
+            self.retired.clear()
+        self._close(closing)
+
+    def _open(self, key, opened, connect_lock, kwargs):
+        tunnel_hoststring, remote = key
+        try:
+            with connect_lock:
+                tunnel_thread = make_tunnel(tunnel_hoststring, remote,
+                                            **kwargs)
+            # don't hold the interpreter open at exit, close_all does
+            tunnel_thread.daemon = True
+            tunnel_thread.start()
+            pooled = PooledTunnel(self, key, tunnel_thread)
+            pooled.refs = 1
+            with self.lock:
+                self.tunnels[key] = pooled
+        finally:
+            with self.lock:
+                del self.opening[key]
+            opened.set()
+        verbose('Tunnel %r -> %r pooled on port %d' % (
+            key + (pooled.local_port,)))
+        return pooled
+
+    def _evict_idle(self):
+        cutoff = time.time() - self.idle_timeout
+        evicted = [
+            pooled for pooled in self.tunnels.itervalues()
+            if pooled.refs <= 0 and pooled.last_used < cutoff
+        ]
+        for pooled in evicted:
+            verbose('Tunnel %r -> %r idle, closing' % pooled.key)
+            del self.tunnels[pooled.key]
+        return evicted
+
+    def _retire(self, pooled):
+        # takes `pooled` out of the pool, it is closed by its last release
+        del self.tunnels[pooled.key]
+        if pooled.refs > 0:
+            self.retired.add(pooled)
+            return []
+        return [pooled]
+
+    def _drop_connection(self, tunnel_hoststring):
+        # force Fabric to reconnect to the bastion if its transport died,
+        # other tunnels may still be using a live one
+        if tunnel_hoststring not in connections:
+            return
+        transport = connections[tunnel_hoststring].get_transport()
+        if transport is None or not transport.is_active():
+            connections[tunnel_hoststring].close()
+            del connections[tunnel_hoststring]
+
+    def _close(self, tunnels):
+        for pooled in tunnels:
+            pooled.tunnel.close()
+
+
+pool = TunnelPool()
+
+atexit.register(pool.close_all)
+
+
+class RelayTotals(object):
+
+    def reset_totals(self):
+        self.stats_lock = threading.Lock()
+        self.connections = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def record(self, stats):
+        with self.stats_lock:
+            self.connections += 1
+            self.bytes_sent += stats.bytes_sent
+            self.bytes_received += stats.bytes_received
+
+
+class ForwardServer(RelayTotals, SocketServer.ThreadingTCPServer):
     daemon_threads = False
     allow_reuse_address = True
 
+    def __init__(self, *args, **kwargs):
+        SocketServer.ThreadingTCPServer.__init__(self, *args, **kwargs)
+        self.reset_totals()
+
+
+class RelayStats(object):
+    """
+    Byte and latency counters for a single forwarded connection. Sent is
+    local -> remote, received is remote -> local.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.connected_at = None
+        self.closed_at = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    @property
+    def connect_latency(self):
+        if self.connected_at is None:
+            return None
+        return self.connected_at - self.started_at
+
+    @property
+    def duration(self):
+        return (self.closed_at or time.time()) - self.started_at
+
+    def __repr__(self):
+        return (
+            '<RelayStats sent=%d received=%d connect=%.3fs duration=%.3fs>' %
+            (self.bytes_sent, self.bytes_received,
+             self.connect_latency or 0.0, self.duration))
+
 
 class Handler(SocketServer.BaseRequestHandler):
+    buffer_size = DEFAULT_BUFFER_SIZE
+
     def handle(self):
         request_peername = self.request.getpeername()
+        self.stats = RelayStats()
 
         try:
             chan = self.ssh_transport.open_channel('direct-tcpip',
@@ -151,26 +431,317 @@ class Handler(SocketServer.BaseRequestHandler):
                      '.') %
                     (self.chain_host, self.chain_port))
             return
+        self.stats.connected_at = time.time()
 
         verbose('Connected!  Tunnel open %r -> %r -> %r' % (request_peername,
                                                             chan.getpeername(),
                                                             (self.chain_host,
                                                              self.chain_port)))
-        while True:
-            r, w, x = select.select([self.request, chan], [], [])
+        try:
+            self.relay(chan)
+        finally:
+            chan.close()
+            self.request.close()
+            self.stats.closed_at = time.time()
+            if hasattr(self.server, 'record'):
+                self.server.record(self.stats)
+        verbose('Tunnel closed from %r %r' % (request_peername, self.stats))
+
+    def relay(self, chan):
+        """
+        Pumps bytes both ways until each side has closed its write half.
+        Local reads land in a reusable buffer and every write is a
+        `sendall`, so a slow peer applies backpressure instead of dropping
+        data.
+        """
+        buf = bytearray(self.buffer_size)
+        view = memoryview(buf)
+        readers = [self.request, chan]
+        while readers:
+            r, w, x = select.select(readers, [], [])
             if self.request in r:
-                data = self.request.recv(1024)
-                if len(data) == 0:
-                    break
-                chan.send(data)
+                size = self.request.recv_into(buf)
+                if size == 0:
+                    # local side is done writing, forward the half-close
+                    readers.remove(self.request)
+                    chan.shutdown_write()
+                else:
+                    # paramiko packs str payloads, so this is the one copy
+                    chan.sendall(view[:size].tobytes())
+                    self.stats.bytes_sent += size
             if chan in r:
-                data = chan.recv(1024)
+                data = chan.recv(self.buffer_size)
                 if len(data) == 0:
-                    break
-                self.request.send(data)
-        chan.close()
-        self.request.close()
-        verbose('Tunnel closed from %r' % (request_peername,))
+                    readers.remove(chan)
+                    try:
+                        self.request.shutdown(socket.SHUT_WR)
+                    except socket.error:
+                        pass
+                else:
+                    self.request.sendall(data)
+                    self.stats.bytes_received += len(data)
+
+
+class EventForwardServer(RelayTotals):
+    """
+    Forwards every local connection from a single thread. Local sockets and
+    paramiko channels are all non-blocking and multiplexed with poll (or
+    select where poll is missing). At most `max_channels` connections are
+    relayed at once, extra ones wait in the listen backlog, and neither
+    side is read while the other still has bytes pending. Channels are
+    opened on a thread per connection, which hands them back to the loop,
+    so a slow SSH server never stalls the connections already relayed.
+    """
+
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class,
+                 max_channels=DEFAULT_MAX_CHANNELS):
+        self.handler_class = handler_class
+        self.max_channels = max_channels
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(0)
+        self.server_address = self.socket.getsockname()
+        self.relays = []
+        self.opening = 0
+        # channels opened off the loop, which is woken up through a socket
+        self._opened = Queue.Queue()
+        self._wakeup, self._wakeup_writer = socket.socketpair()
+        self._wakeup.setblocking(0)
+        self._lock = threading.Lock()
+        self._closed = False
+        self.reset_totals()
+        self._shutdown_request = False
+        self._stopped = threading.Event()
+
+    def serve_forever(self, poll_interval=0.5):
+        self._stopped.clear()
+        try:
+            while not self._shutdown_request:
+                self._step(poll_interval)
+        finally:
+            with self._lock:
+                self._closed = True
+            self._add_opened()
+            for relay in self.relays:
+                relay.close()
+                self.record(relay.stats)
+            self.relays = []
+            self.socket.close()
+            self._wakeup.close()
+            self._wakeup_writer.close()
+            self._stopped.set()
+
+    def shutdown(self):
+        self._shutdown_request = True
+        self._stopped.wait()
+
+    def _step(self, timeout):
+        readers, writers = [self._wakeup], []
+        if len(self.relays) + self.opening < self.max_channels:
+            readers.append(self.socket)
+        for relay in self.relays:
+            relay_readers, relay_writers = relay.interest()
+            readers.extend(relay_readers)
+            writers.extend(relay_writers)
+            if relay.to_chan:
+                # channels can't be polled for window space, so spin briefly
+                timeout = min(timeout, 0.01)
+        readable, writable = _wait(readers, writers, timeout)
+        if self._wakeup in readable:
+            self._add_opened()
+        if self.socket in readable:
+            self._accept()
+        for relay in list(self.relays):
+            try:
+                relay.pump(readable, writable)
+            except (socket.error, EOFError), e:
+                verbose('Tunnel relay failed: %r' % (e,))
+                relay.close()
+            if relay.closed:
+                self.relays.remove(relay)
+                self.record(relay.stats)
+                verbose('Tunnel closed from %r %r' % (relay.peername,
+                                                      relay.stats))
+
+    def _accept(self):
+        try:
+            request, peername = self.socket.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        # opening a channel waits on the SSH server, so it is done on a
+        # thread of its own and the relay is only added once it is open
+        self.opening += 1
+        opener = threading.Thread(
+            target=self._open, args=(request, peername, RelayStats()))
+        opener.daemon = True
+        opener.start()
+
+    def _open(self, request, peername, stats):
+        handler = self.handler_class
+        try:
+            chan = handler.ssh_transport.open_channel(
+                'direct-tcpip', (handler.chain_host, handler.chain_port),
+                peername)
+        except Exception, e:
+            verbose('Incoming request to %s:%d failed: %s' % (
+                handler.chain_host, handler.chain_port, repr(e)))
+            chan = None
+        else:
+            if chan is None:
+                verbose(('Incoming request to %s:%d was rejected by the SSH '
+                         'server.') % (handler.chain_host, handler.chain_port))
+            else:
+                stats.connected_at = time.time()
+        with self._lock:
+            if not self._closed:
+                self._opened.put((request, peername, stats, chan))
+                self._wakeup_writer.send('.')
+                return
+        # the server has shut down in the meantime
+        if chan is not None:
+            chan.close()
+        request.close()
+
+    def _add_opened(self):
+        try:
+            self._wakeup.recv(4096)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        while True:
+            try:
+                request, peername, stats, chan = self._opened.get_nowait()
+            except Queue.Empty:
+                return
+            self.opening -= 1
+            if chan is None:
+                request.close()
+                continue
+            handler = self.handler_class
+            verbose('Connected!  Tunnel open %r -> %r -> %r' % (
+                peername, chan.getpeername(),
+                (handler.chain_host, handler.chain_port)))
+            self.relays.append(
+                _Relay(request, chan, peername, stats, handler.buffer_size))
+
+
+class _Relay(object):
+
+    def __init__(self, local, chan, peername, stats, buffer_size):
+        self.local = local
+        self.chan = chan
+        self.peername = peername
+        self.stats = stats
+        self.buffer_size = buffer_size
+        self.local.setblocking(0)
+        self.chan.setblocking(0)
+        self.to_chan = ''
+        self.to_local = ''
+        self.local_eof = self.chan_eof = False
+        self.chan_shut = self.local_shut = False
+        self.closed = False
+
+    def interest(self):
+        readers, writers = [], []
+        if not self.local_eof and not self.to_chan:
+            readers.append(self.local)
+        if not self.chan_eof and not self.to_local:
+            readers.append(self.chan)
+        if self.to_local:
+            writers.append(self.local)
+        return readers, writers
+
+    def pump(self, readable, writable):
+        if self.local in readable:
+            try:
+                data = self.local.recv(self.buffer_size)
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+            else:
+                if data:
+                    self.to_chan = data
+                else:
+                    self.local_eof = True
+        if self.chan in readable:
+            try:
+                data = self.chan.recv(self.buffer_size)
+            except socket.timeout:
+                pass
+            else:
+                if data:
+                    self.to_local = data
+                else:
+                    self.chan_eof = True
+        # a channel send takes at most one packet, keep going while the
+        # window has room rather than waiting out the spin for each one
+        while self.to_chan and self.chan.send_ready():
+            try:
+                sent = self.chan.send(self.to_chan)
+            except socket.timeout:
+                break
+            self.to_chan = self.to_chan[sent:]
+            self.stats.bytes_sent += sent
+        if self.to_local and self.local in writable:
+            try:
+                sent = self.local.send(self.to_local)
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                sent = 0
+            self.to_local = self.to_local[sent:]
+            self.stats.bytes_received += sent
+        # forward half-closes once everything before them is flushed
+        if self.local_eof and not self.to_chan and not self.chan_shut:
+            self.chan.shutdown_write()
+            self.chan_shut = True
+        if self.chan_eof and not self.to_local and not self.local_shut:
+            try:
+                self.local.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+            self.local_shut = True
+        if self.chan_shut and self.local_shut:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.chan.close()
+        self.local.close()
+        self.stats.closed_at = time.time()
+        self.closed = True
+
+
+def _wait(readers, writers, timeout):
+    if not hasattr(select, 'poll'):
+        r, w, _ = select.select(readers, writers, [], timeout)
+        return set(r), set(w)
+    masks, objs = {}, {}
+    for obj in readers:
+        fd = obj.fileno()
+        objs[fd] = obj
+        masks[fd] = masks.get(fd, 0) | select.POLLIN
+    for obj in writers:
+        fd = obj.fileno()
+        objs[fd] = obj
+        masks[fd] = masks.get(fd, 0) | select.POLLOUT
+    poller = select.poll()
+    for fd, mask in masks.iteritems():
+        poller.register(fd, mask)
+    readable, writable = set(), set()
+    for fd, event in poller.poll(timeout * 1000):
+        if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+            readable.add(objs[fd])
+        if event & select.POLLOUT:
+            writable.add(objs[fd])
+    return readable, writable
 
 
 def verbose(s):
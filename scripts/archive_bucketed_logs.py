@@ -7,14 +7,19 @@ import glob
 import logging
 from optparse import OptionParser
 import os
+import Queue
 import shutil
+from StringIO import StringIO
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 
-from boto.s3.bucket import Bucket
-from boto.s3.connection import S3Connection
 from boto.s3.key import Key
+from infra.compression import EXTENSIONS, get_codec, tar_pipeline, wait
+from infra.s3 import bucket_key_index
+from infra.s3_client import DEADLINE, connect
 from infra.util import get_aws_creds_file, get_aws_creds_env
 
 
@@ -65,12 +70,16 @@ class BucketedLog(object):
 
     REAP_THRESHOLD = timedelta(days=15)
     RIPE_THRESHOLD = timedelta(days=1)
+    STREAM = False
+    PART_SIZE = 16 * 1024 * 1024
+    CODEC = get_codec('gzip')
 
     def __init__(self, host, ts, path):
         self.host = host
         self.ts = ts
         self.path = path
-        self.name = '_'.join([ts.strftime('%Y%m%d'), self.host]) + '.tar.gz'
+        self.base_name = '_'.join([ts.strftime('%Y%m%d'), self.host])
+        self.name = self.base_name + self.CODEC.extension
 
     @property
     def expired(self):
@@ -81,14 +90,23 @@ class BucketedLog(object):
         return self.ts < (datetime.now() - self.RIPE_THRESHOLD)
 
     def archive(self, s3_bucket):
+        if self.STREAM:
+            BucketedLogStreamer(self, self.PART_SIZE).upload(s3_bucket)
+            return
         with BucktedLogArchiver(self) as ar:
-            s3_key = Key(s3_bucket)
-            s3_key.key = os.path.basename(self.name)
-            logger.info('uploading %s to %s', ar.fo.name, s3_key.key)
-            s3_key.set_contents_from_file(ar.fo)
+            self.upload(s3_bucket, ar)
 
-    def is_archived(self, s3_bucket):
-        return s3_bucket.get_key(self.name)
+    def upload(self, s3_bucket, ar):
+        s3_key = Key(s3_bucket)
+        s3_key.key = os.path.basename(self.name)
+        logger.info('uploading %s to %s', ar.fo.name, s3_key.key)
+        s3_key.set_contents_from_file(ar.fo)
+
+    def is_archived(self, archived):
+        # archived with any codec counts
+        return any(
+            self.base_name + extension in archived
+            for extension in EXTENSIONS)
 
     def remove(self):
         logger.debug('removing %s', self.path)
@@ -103,23 +121,14 @@ class BucktedLogArchiver(object):
         self.path = os.path.join(tempfile.gettempdir(), self.log.name)
         logger.debug('creating archive %s from %s',
                      self.path, self.log.path)
-        cmd = [
-            'tar',
-            'zcf',
-            self.path,
-            os.path.basename(self.log.path),
-            ]
-        proc = subprocess.Popen(
-                   cmd,
-                   stderr=sys.stderr,
-                   cwd=os.path.dirname(self.log.path))
-        out, err = proc.communicate()
-        if proc.returncode != 0:
-            raise RuntimeError(
-                'command "%s" failed, code - %d, err - %s' % (
-                    ' '.join(cmd),
-                    proc.returncode,
-                    err))
+        self.fo = None
+        with open(self.path, 'wb') as fo:
+            procs = tar_pipeline(self.log.path, self.log.CODEC, fo)
+        try:
+            wait(procs)
+        except:
+            os.remove(self.path)
+            raise
         self.fo = open(self.path, 'r')
         return self
 
@@ -132,6 +141,166 @@ class BucktedLogArchiver(object):
             os.remove(self.path)
 
 
+class BucketedLogStreamer(object):
+    """
+    Uploads the archive straight from the tar pipeline as multipart parts of
+    `part_size` bytes, so at most one part is held in memory and nothing
+    touches the temp dir.
+    """
+
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, log, part_size):
+        if part_size < self.MIN_PART_SIZE:
+            raise ValueError('part size must be at least %d bytes' %
+                             self.MIN_PART_SIZE)
+        self.log = log
+        self.part_size = part_size
+
+    def upload(self, s3_bucket):
+        key_name = os.path.basename(self.log.name)
+        logger.info('streaming %s to %s', self.log.path, key_name)
+        procs = tar_pipeline(
+            self.log.path, self.log.CODEC, subprocess.PIPE)
+        stdout = procs[-1].stdout
+        mp = s3_bucket.initiate_multipart_upload(key_name)
+        try:
+            part_num = 0
+            while True:
+                part = stdout.read(self.part_size)
+                if not part and part_num:
+                    break
+                part_num += 1
+                logger.debug('uploading part %d (%d bytes) of %s',
+                             part_num, len(part), key_name)
+                mp.upload_part_from_file(StringIO(part), part_num)
+                if len(part) < self.part_size:
+                    break
+            stdout.close()
+            wait(procs)
+            mp.complete_upload()
+        except:
+            logger.debug('cancelling upload of %s', key_name)
+            mp.cancel_upload()
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+            raise
+
+
+class ArchiveResult(object):
+
+    def __init__(self, log):
+        self.log = log
+        self.compress_time = None
+        self.upload_time = None
+        self.error = None
+
+    @property
+    def archived(self):
+        return self.error is None and self.upload_time is not None
+
+    def __str__(self):
+        if self.error:
+            return '%s failed: %s' % (self.log.name, self.error)
+        return '%s compressed in %.1fs, uploaded in %.1fs' % (
+            self.log.name, self.compress_time or 0.0, self.upload_time)
+
+
+class ArchivePipeline(object):
+    """
+    Archives logs with a pool of `compressors` running tar and a pool of
+    `uploaders` sending the results to S3, so compression and uploads
+    overlap. At most `queue_size` finished archives wait for an uploader,
+    which bounds the temp space used. When streaming, compression and
+    upload are one step and only the compressor pool is used.
+    """
+
+    def __init__(self, s3_bucket, compressors=2, uploaders=4, queue_size=4,
+                 archived=None):
+        self.s3_bucket = s3_bucket
+        self.archived = archived
+        self.compressors = compressors
+        self.uploaders = uploaders
+        self.queue_size = queue_size
+
+    def run(self, logs):
+        """
+        Returns an `ArchiveResult` per log, in the order of `logs`.
+        """
+        results = [ArchiveResult(log) for log in logs]
+        pending = Queue.Queue()
+        for result in results:
+            pending.put(result)
+        compressed = Queue.Queue(self.queue_size)
+        compressors = [
+            threading.Thread(target=self._compress, args=(pending, compressed))
+            for _ in range(self.compressors)
+        ]
+        uploaders = [
+            threading.Thread(target=self._upload, args=(compressed,))
+            for _ in range(0 if BucketedLog.STREAM else self.uploaders)
+        ]
+        for thread in compressors + uploaders:
+            thread.daemon = True
+            thread.start()
+        for _ in compressors:
+            pending.put(None)
+        for thread in compressors:
+            thread.join()
+        for _ in uploaders:
+            compressed.put(None)
+        for thread in uploaders:
+            thread.join()
+        return results
+
+    def _compress(self, pending, compressed):
+        while True:
+            result = pending.get()
+            if result is None:
+                return
+            started_at = time.time()
+            try:
+                if BucketedLog.STREAM:
+                    result.log.archive(self.s3_bucket)
+                    result.compress_time = 0.0
+                    result.upload_time = time.time() - started_at
+                    self._archived(result.log)
+                    logger.info('%s', result)
+                    continue
+                ar = BucktedLogArchiver(result.log)
+                ar.__enter__()
+            except Exception, ex:
+                logger.exception('archiving %s failed', result.log.path)
+                result.error = ex
+                continue
+            result.compress_time = time.time() - started_at
+            compressed.put((result, ar))
+
+    def _archived(self, log):
+        if self.archived is not None:
+            self.archived.add(log.name)
+
+    def _upload(self, compressed):
+        while True:
+            item = compressed.get()
+            if item is None:
+                return
+            result, ar = item
+            started_at = time.time()
+            try:
+                result.log.upload(self.s3_bucket, ar)
+                result.upload_time = time.time() - started_at
+                self._archived(result.log)
+                logger.info('%s', result)
+            except Exception, ex:
+                logger.exception('uploading %s failed', result.log.name)
+                result.error = ex
+            finally:
+                ar.__exit__(None, None, None)
+
+
 def main():
     opt_parser = OptionParser(usage=USAGE)
     opt_parser.add_option(
@@ -144,14 +313,54 @@ def main():
     opt_parser.add_option(
         '--ripe-threshold', default=None, type="int",
         help='Age in days after which to archive bucket.')
+    opt_parser.add_option(
+        '--stream', action='store_true', default=False,
+        help='Stream archives to S3 instead of staging them in a temp file.')
+    opt_parser.add_option(
+        '--part-size', default=None, type="int",
+        help='Multipart part size in MB when streaming.')
+    opt_parser.add_option(
+        '--codec', default='gzip',
+        help='Compression codec, one of gzip, pigz, zstd or xz.')
+    opt_parser.add_option(
+        '--level', default=None, type="int",
+        help='Compression level, defaults to the codec\'s own default.')
+    opt_parser.add_option(
+        '--threads', default=None, type="int",
+        help='Compression threads for codecs that support them, 0 for all '
+             'cores.')
+    opt_parser.add_option(
+        '--compressors', default=1, type="int",
+        help='Number of archives to compress at once.')
+    opt_parser.add_option(
+        '--uploaders', default=1, type="int",
+        help='Number of archives to upload at once.')
+    opt_parser.add_option(
+        '--queue-size', default=2, type="int",
+        help='Number of compressed archives allowed to wait for upload.')
+    opt_parser.add_option(
+        '--hedge', action='store_true', default=False,
+        help='Send a duplicate of S3 metadata requests (HEADs, listing pages) '
+             'slower than most, and use whichever completes first.')
+    opt_parser.add_option(
+        '--deadline', default=DEADLINE, type="float",
+        help='Seconds after which hedged S3 requests fail.')
     opts, args = opt_parser.parse_args()
     if not args:
         raise Exception(USAGE)
+    if (opts.part_size is not None and
+            opts.part_size * 1024 * 1024 < BucketedLogStreamer.MIN_PART_SIZE):
+        opt_parser.error('--part-size must be at least %d MB' % (
+            BucketedLogStreamer.MIN_PART_SIZE // (1024 * 1024)))
 
     if opts.reap_threshold is not None:
         BucketedLog.REAP_THRESHOLD = timedelta(days=opts.reap_threshold)
     if opts.ripe_threshold is not None:
         BucketedLog.RIPE_THRESHOLD = timedelta(days=opts.ripe_threshold)
+    BucketedLog.STREAM = opts.stream
+    BucketedLog.CODEC = get_codec(opts.codec, opts.level, opts.threads)
+    if opts.part_size is not None:
+        BucketedLog.PART_SIZE = opts.part_size * 1024 * 1024
 
     if opts.verbose:
         logger.setLevel(logging.DEBUG)
@@ -166,18 +375,38 @@ def main():
 
     s3_bucket_name = args[0]
     base_paths = args[1:]
-    s3_cxn = S3Connection(aws_access_key, aws_secret_key)
-    s3_bucket = Bucket(s3_cxn, s3_bucket_name)
-    for base_path in args:
+    s3_cxn = connect(
+        aws_access_key, aws_secret_key, hedge=opts.hedge,
+        deadline=opts.deadline)
+    s3_bucket = s3_cxn.bucket(s3_bucket_name)
+    # archive names start with YYYYMMDD, list each day once
+    archived = bucket_key_index(s3_bucket, prefix_len=8)
+    pipeline = ArchivePipeline(
+        s3_bucket, opts.compressors, opts.uploaders, opts.queue_size,
+        archived)
+    failed = []
+    for base_path in base_paths:
         logger.debug('getting buckets in %s', base_path)
+        to_archive, to_remove = [], []
         for log in get_logs(base_path):
             if not log.ripe:
                 logger.debug('%s is not ripe, skipping', log.path)
-            elif not log.is_archived(s3_bucket):
-                log.archive(s3_bucket)
+            elif not log.is_archived(archived):
+                to_archive.append(log)
             elif log.expired:
-                logger.debug('%s is expired, removing', log.path)
-                log.remove()
+                to_remove.append(log)
+        failed.extend(
+            result for result in pipeline.run(to_archive)
+            if not result.archived)
+        # only logs that were already archived before this run are reaped
+        for log in to_remove:
+            logger.debug('%s is expired, removing', log.path)
+            log.remove()
+    logger.debug('s3 %s', s3_cxn.utilisation())
+    if failed:
+        for result in failed:
+            logger.error('%s', result)
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
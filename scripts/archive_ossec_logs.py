@@ -9,9 +9,9 @@ import os
 import re
 import sys
 
-from boto.s3.bucket import Bucket
-from boto.s3.connection import S3Connection
 from boto.s3.key import Key
+from infra.s3 import bucket_key_index
+from infra.s3_client import DEADLINE, connect
 from infra.util import get_aws_creds_file, get_aws_creds_env
 
 
@@ -59,15 +59,17 @@ class OSSECRotatedLog(object):
     def expired(self):
         return self.ts < (datetime.now() - self.expired_delta)
 
-    def archive(self, s3_bucket):
+    def archive(self, s3_bucket, archived=None):
         with open(self.path, 'r') as fo:
             s3_key = Key(s3_bucket)
             s3_key.key = self.name
             logger.info('uploading %s to %s', fo.name, s3_key.key)
             s3_key.set_contents_from_file(fo)
+        if archived is not None:
+            archived.add(self.name)
 
-    def is_archived(self, s3_bucket):
-        return s3_bucket.get_key(self.name)
+    def is_archived(self, archived):
+        return self.name in archived
 
     def remove(self):
         logger.debug('removing %s', self.path)
@@ -80,6 +82,13 @@ def main():
         '-v', '--verbose', action='store_true', default=False)
     opt_parser.add_option(
         '-a', '--aws-creds', default=None)
+    opt_parser.add_option(
+        '--hedge', action='store_true', default=False,
+        help='Send a duplicate of S3 metadata requests (HEADs, listing pages) '
+             'slower than most, and use whichever completes first.')
+    opt_parser.add_option(
+        '--deadline', default=DEADLINE, type="float",
+        help='Seconds after which hedged S3 requests fail.')
     opts, args = opt_parser.parse_args()
     if not args:
         raise Exception(USAGE)
@@ -97,15 +106,20 @@ def main():
 
     s3_bucket_name = args[0]
     base_paths = args[1:]
-    s3_cxn = S3Connection(aws_access_key, aws_secret_key)
-    s3_bucket = Bucket(s3_cxn, s3_bucket_name)
+    s3_cxn = connect(
+        aws_access_key, aws_secret_key, hedge=opts.hedge,
+        deadline=opts.deadline)
+    s3_bucket = s3_cxn.bucket(s3_bucket_name)
+    # archive names start with YYYYMMDD, list each day once
+    archived = bucket_key_index(s3_bucket, prefix_len=8)
     for base_path in args:
         logger.debug('getting rotated ossec logs in %s', base_path)
         for log in get_logs(base_path):
-            if not log.is_archived(s3_bucket):
-                log.archive(s3_bucket)
+            if not log.is_archived(archived):
+                log.archive(s3_bucket, archived)
             elif log.expired:
                 log.remove()
+    logger.debug('s3 %s', s3_cxn.utilisation())
 
 if __name__ == '__main__':
     main()
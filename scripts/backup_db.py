@@ -1,22 +1,27 @@
 #!/usr/bin/env python
 """
-Backs up database to S3.
+Backs up database to S3, or restores it from there with --restore.
 """
 from datetime import datetime
-import glob
+import heapq
+import itertools
+import json
 import logging
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 import os
+import shutil
 import subprocess
 import tempfile
-from multiprocessing.pool import ThreadPool
+import time
 import sys
 
-from boto.s3.bucket import Bucket
 from boto.s3.bucketlistresultset import BucketListResultSet
-from boto.s3.connection import S3Connection
 from boto.s3.key import Key
-import iso8601
+from infra.s3 import (
+    MB, DEFAULT_PART_SIZE, DEFAULT_WORKERS, BatchDeleter, MultipartUploader,
+    RangedDownloader, with_retries)
+from infra.s3_client import connect
 from infra.util import get_aws_creds_file, get_aws_creds_env
 
 
@@ -28,6 +33,10 @@ USAGE = """\
 
 MAX_UPLOAD_SIZE = 5 * 1024 * 1000000 # ~5GB
 
+MULTIPART_THRESHOLD = 64 * MB
+
+MANIFEST_NAME = 'MANIFEST.json'
+
 
 class DumpDB(object):
     date_fmt = '%Y%m%d_%H%M%S'
@@ -40,22 +49,25 @@ class DumpDB(object):
         self.username = username
         self.temp_dir = temp_dir or tempfile.gettempdir()
 
-    def __enter__(self):
-        self.timestamp = datetime.now().strftime(self.date_fmt)
-        self.tmp_path = os.path.join(
-            self.temp_dir, self.db + '-' + self.timestamp + '.sql')
-
-        logger.info('dumping %s to %s', self.db, self.tmp_path)
-        cmd = [
+    def command(self, *options):
+        return [
             'pg_dump',
             '--format=' + self.format,
             '--compress=' + self.compression_level,
-            '--file=' + self.tmp_path,
             '--user=' + self.username,
             '--host=' + self.host,
             '--exclude-table=' + 'repl_test',
+            ] + list(options) + [
             self.db,
             ]
+
+    def __enter__(self):
+        self.timestamp = datetime.now().strftime(self.date_fmt)
+        self.tmp_path = os.path.join(
+            self.temp_dir, self.db + '-' + self.timestamp + '.sql')
+
+        logger.info('dumping %s to %s', self.db, self.tmp_path)
+        cmd = self.command('--file=' + self.tmp_path)
         proc = subprocess.Popen(cmd)
         out, err = proc.communicate()
         if proc.returncode != 0:
@@ -79,38 +91,417 @@ def archive(s3_bucket, dump_file, dst_file):
         s3_key.set_contents_from_file(dump_fo)
 
 
-def archive_in_parts(s3_bucket, dump_file, key_name):
-    def split_file(file_path, key):
-        temp_dir = tempfile.gettempdir()
-        prefix = os.path.join(temp_dir, key)
-        cl = ['split', '-b {}'.format(MAX_UPLOAD_SIZE), file_path, prefix]
-        subprocess.check_call(cl)
-        return sorted(glob.glob('{}*'.format(prefix))), temp_dir
-    mp = s3_bucket.initiate_multipart_upload(key_name)
-    chunks, temp_dir = split_file(dump_file, key_name)
-    pool = ThreadPool(len(chunks))
-    pool.map(spawn_upload, [(mp, chunk, i) for i, chunk in enumerate(chunks)])
-    mp.complete_upload()
-    for chunk in chunks:
-        os.unlink(chunk)
-
-
-def spawn_upload((multipart_upload, path_to_chunk, index)):
-    multipart_upload.upload_part_from_file(open(path_to_chunk, 'rb'), index+1)
-
-
-def reap(s3_bucket, capacity, dry=False):
-    keys = [key for key in BucketListResultSet(s3_bucket)]
-    if len(keys) <= capacity:
-        return 0
-    keys = sorted(keys, key=lambda x: iso8601.parse_date(x.last_modified))
-    keys.reverse()
-    for key in keys[capacity:]:
-        logger.debug("deleting key %s last modified @ %s from s3 bucket %s",
-            key.name, key.last_modified, s3_bucket.name)
-        if not dry:
-            key.delete()
-    return len(keys) - capacity
+def archive_in_parts(s3_bucket, dump_file, key_name,
+                     part_size=DEFAULT_PART_SIZE, workers=DEFAULT_WORKERS):
+    logger.info('uploading %s to s3 bucket %s as %s in parts',
+        dump_file, s3_bucket.name, key_name)
+    uploader = MultipartUploader(
+        s3_bucket, key_name, part_size=part_size, workers=workers)
+    uploader.upload_file(dump_file)
+
+
+def archive_stream(s3_bucket, dump, part_size=DEFAULT_PART_SIZE,
+                   workers=DEFAULT_WORKERS):
+    """
+    Uploads `dump` from pg_dump's stdout while it is still dumping, nothing
+    is written locally. Returns the key name.
+    """
+    dump.timestamp = datetime.now().strftime(dump.date_fmt)
+    key_name = dump.timestamp + '.sql'
+    cmd = dump.command()
+    logger.info('streaming %s to s3 bucket %s as %s',
+        dump.db, s3_bucket.name, key_name)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+    def check():
+        if proc.wait() != 0:
+            raise RuntimeError(
+                'dump command "%s" failed, code - %d' % (
+                ' '.join(cmd), proc.returncode))
+
+    uploader = MultipartUploader(
+        s3_bucket, key_name, part_size=part_size, workers=workers)
+    try:
+        uploader.upload_stream(proc.stdout, check)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+    return key_name
+
+
+class DirectoryDump(object):
+    """
+    Runs `pg_dump --format=directory --jobs=N` and uploads each file under
+    `{timestamp}/` as soon as it stops growing, while the dump is still
+    running. Files that change after they were uploaded are uploaded again
+    once pg_dump exits. A `MANIFEST.json` listing every file is written
+    last, so restores can fetch the files in parallel.
+    """
+
+    poll_interval = 2
+    format = 'directory'
+
+    def __init__(self, s3_bucket, dump, jobs, workers=DEFAULT_WORKERS,
+                 part_size=DEFAULT_PART_SIZE,
+                 multipart_threshold=MULTIPART_THRESHOLD):
+        self.s3_bucket = s3_bucket
+        self.dump = dump
+        self.jobs = jobs
+        self.workers = workers
+        self.part_size = part_size
+        self.multipart_threshold = multipart_threshold
+        self.uploaded = {}
+        self.pending = {}
+
+    def _scan(self):
+        if not os.path.isdir(self.path):
+            return {}
+        stats = {}
+        for name in os.listdir(self.path):
+            st = os.stat(os.path.join(self.path, name))
+            stats[name] = (st.st_size, st.st_mtime)
+        return stats
+
+    def _upload(self, name):
+        file_path = os.path.join(self.path, name)
+        key_name = self.prefix + name
+        size = os.path.getsize(file_path)
+        logger.debug('uploading %s (%d bytes) as %s',
+            file_path, size, key_name)
+        if size > min(self.multipart_threshold, MAX_UPLOAD_SIZE):
+            MultipartUploader(
+                self.s3_bucket, key_name, part_size=self.part_size,
+                workers=self.workers).upload_file(file_path)
+        else:
+            with_retries(
+                lambda: Key(self.s3_bucket, key_name)
+                        .set_contents_from_filename(file_path),
+                description='upload of %s' % key_name)
+
+    def _submit(self, pool, stats, only_settled=None):
+        for name, stat in sorted(stats.iteritems()):
+            if name in self.pending and not self.pending[name].ready():
+                continue
+            if self.uploaded.get(name) == stat:
+                continue
+            if only_settled is not None and only_settled.get(name) != stat:
+                continue
+            self.uploaded[name] = stat
+            self.pending[name] = pool.apply_async(self._upload, (name,))
+
+    def _wait(self):
+        for result in self.pending.values():
+            result.get()
+
+    def run(self):
+        """
+        Dumps and uploads, returns the manifest key name.
+        """
+        dump = self.dump
+        dump.format = self.format
+        dump.timestamp = datetime.now().strftime(dump.date_fmt)
+        self.prefix = dump.timestamp + '/'
+        self.path = os.path.join(
+            dump.temp_dir, dump.db + '-' + dump.timestamp)
+        cmd = dump.command(
+            '--jobs=%d' % self.jobs,
+            '--file=' + self.path)
+        logger.info('dumping %s with %d jobs to %s, uploading as %s',
+            dump.db, self.jobs, self.path, self.prefix)
+        started_at = time.time()
+        proc = subprocess.Popen(cmd)
+        pool = ThreadPool(self.workers)
+        try:
+            previous = {}
+            while proc.poll() is None:
+                time.sleep(self.poll_interval)
+                current = self._scan()
+                # only files that did not change over a whole poll interval
+                self._submit(pool, current, only_settled=previous)
+                previous = current
+            if proc.returncode != 0:
+                raise RuntimeError(
+                    'dump command "%s" failed, code - %d' % (
+                    ' '.join(cmd), proc.returncode))
+            self._wait()
+            self._submit(pool, self._scan())
+            self._wait()
+            return self._write_manifest(time.time() - started_at)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            pool.terminate()
+            pool.join()
+            if os.path.isdir(self.path):
+                logger.debug('deleting dump %s', self.path)
+                shutil.rmtree(self.path)
+
+    def _write_manifest(self, duration):
+        manifest = {
+            'db': self.dump.db,
+            'timestamp': self.dump.timestamp,
+            'format': self.format,
+            'jobs': self.jobs,
+            'compression_level': self.dump.compression_level,
+            'files': [
+                {'name': name, 'key': self.prefix + name, 'size': size}
+                for name, (size, _) in sorted(self.uploaded.iteritems())
+            ],
+        }
+        key_name = self.prefix + MANIFEST_NAME
+        Key(self.s3_bucket, key_name).set_contents_from_string(
+            json.dumps(manifest, indent=2))
+        logger.info('dumped and uploaded %d file(s) of %s in %.1fs',
+            len(self.uploaded), self.dump.db, duration)
+        return key_name
+
+
+def backup_name(key_name):
+    """
+    Backup a key belongs to, directory dumps span many keys.
+    """
+    return key_name.split('/', 1)[0]
+
+
+class Backup(object):
+
+    def __init__(self, name, keys):
+        self.name = name
+        self.key_names = [key.name for key in keys]
+        # listings all use the same ISO 8601 format so these sort as strings
+        self.last_modified = max(key.last_modified for key in keys)
+
+    @property
+    def complete(self):
+        # a directory dump's manifest is written last
+        if self.key_names == [self.name]:
+            return True
+        return self.name + '/' + MANIFEST_NAME in self.key_names
+
+
+def list_backups(s3_bucket):
+    """
+    Streams the `Backup`s in `s3_bucket`. Listings are sorted by key name so
+    the keys of a directory dump come one after the other.
+    """
+    keys = BucketListResultSet(s3_bucket)
+    for name, keys in itertools.groupby(
+            keys, key=lambda key: backup_name(key.name)):
+        yield Backup(name, list(keys))
+
+
+class Tier(object):
+    """
+    Retains the newest backup from each of the newest `count` periods. A
+    period is the first `period_len` characters of a backup's last
+    modified timestamp, e.g. 13 for hours, 10 for days or 7 for months.
+    Without `period_len` each backup is its own period, so the newest
+    `count` backups are retained.
+    """
+
+    HOURLY = 13
+    DAILY = 10
+    MONTHLY = 7
+
+    def __init__(self, count, period_len=None):
+        self.count = count
+        self.period_len = period_len
+        self.periods = []
+        self.retained = {}
+
+    def period(self, backup):
+        if self.period_len is None:
+            return backup.last_modified, backup.name
+        return backup.last_modified[:self.period_len]
+
+    def offer(self, backup):
+        """
+        Offers `backup` to the tier and returns the backups that fall out of
+        it, which includes `backup` if it is not retained.
+        """
+        period = self.period(backup)
+        current = self.retained.get(period)
+        if current is not None:
+            if backup.last_modified > current.last_modified:
+                self.retained[period] = backup
+                return [current]
+            return [backup]
+        if len(self.periods) < self.count:
+            heapq.heappush(self.periods, period)
+            self.retained[period] = backup
+            return []
+        oldest = heapq.heappushpop(self.periods, period)
+        if oldest == period:
+            return [backup]
+        self.retained[period] = backup
+        return [self.retained.pop(oldest)]
+
+
+def reap(s3_bucket, tiers, dry=False):
+    """
+    Deletes every backup in `s3_bucket` not retained by any of `tiers`.
+    The listing is streamed and only the backups currently retained are
+    kept in memory, a bounded heap per tier. Once a backup falls out of
+    every tier it is deleted in batches with multi-object deletes.
+    """
+    # backup name -> number of tiers it has not fallen out of yet
+    refs = {}
+    reaped = 0
+    with BatchDeleter(s3_bucket, dry=dry) as deleter:
+        for backup in list_backups(s3_bucket):
+            refs[backup.name] = len(tiers)
+            for tier in tiers:
+                for dropped in tier.offer(backup):
+                    refs[dropped.name] -= 1
+                    if refs[dropped.name]:
+                        continue
+                    del refs[dropped.name]
+                    logger.debug(
+                        "deleting backup %s (%d key(s)) last modified @ %s "
+                        "from s3 bucket %s", dropped.name,
+                        len(dropped.key_names), dropped.last_modified,
+                        s3_bucket.name)
+                    for key_name in dropped.key_names:
+                        deleter.add(key_name)
+                    reaped += 1
+    if deleter.errors:
+        raise RuntimeError('failed to delete %d key(s) from %s' % (
+            len(deleter.errors), s3_bucket.name))
+    return reaped
+
+
+class Restore(object):
+    """
+    Restores a backup into `db` with `pg_restore`. Keys are fetched with
+    concurrent range GETs. A single-key dump is piped straight into
+    `pg_restore` when restoring with one job. pg_restore needs a seekable
+    file for `--jobs`, so with more jobs the dump is first downloaded into
+    a preallocated temp file. Directory dumps are fetched file by file as
+    listed in their manifest, then restored in parallel.
+    """
+
+    def __init__(self, s3_bucket, host, db, username, jobs=1,
+                 workers=DEFAULT_WORKERS, part_size=DEFAULT_PART_SIZE,
+                 temp_dir=None):
+        self.s3_bucket = s3_bucket
+        self.host = host
+        self.db = db
+        self.username = username
+        self.jobs = jobs
+        self.downloader = RangedDownloader(
+            s3_bucket, part_size=part_size, workers=workers)
+        self.temp_dir = temp_dir or tempfile.gettempdir()
+
+    def command(self, *options):
+        cmd = [
+            'pg_restore',
+            '--user=' + self.username,
+            '--host=' + self.host,
+            '--dbname=' + self.db,
+            ]
+        if self.jobs > 1:
+            cmd.append('--jobs=%d' % self.jobs)
+        return cmd + list(options)
+
+    def find(self, name=None):
+        """
+        The `Backup` called `name`, or the latest complete one.
+        """
+        if name is None:
+            backup = None
+            for candidate in list_backups(self.s3_bucket):
+                if not candidate.complete:
+                    logger.debug('skipping incomplete backup %s',
+                                 candidate.name)
+                elif (backup is None or
+                        candidate.last_modified > backup.last_modified):
+                    backup = candidate
+            if backup is None:
+                raise LookupError(
+                    'no complete backups in s3 bucket %s' %
+                    self.s3_bucket.name)
+            return backup
+        name = backup_name(name)
+        keys = [key for key in self.s3_bucket.list(prefix=name)
+                if backup_name(key.name) == name]
+        if not keys:
+            raise LookupError('no backup %s in s3 bucket %s' % (
+                name, self.s3_bucket.name))
+        return Backup(name, keys)
+
+    def _pg_restore(self, cmd, stdin=None):
+        logger.info('running "%s"', ' '.join(cmd))
+        return subprocess.Popen(cmd, stdin=stdin)
+
+    def _check(self, proc, cmd):
+        if proc.wait() != 0:
+            raise RuntimeError(
+                'restore command "%s" failed, code - %d' % (
+                ' '.join(cmd), proc.returncode))
+
+    def _restore_key(self, key_name):
+        if self.jobs > 1:
+            path = os.path.join(
+                self.temp_dir, self.db + '-' + os.path.basename(key_name))
+            try:
+                progress = self.downloader.download_file(key_name, path)
+                cmd = self.command(path)
+                self._check(self._pg_restore(cmd), cmd)
+            finally:
+                if os.path.isfile(path):
+                    logger.debug('deleting dump %s', path)
+                    os.unlink(path)
+            return progress
+        cmd = self.command()
+        proc = self._pg_restore(cmd, stdin=subprocess.PIPE)
+        try:
+            progress = self.downloader.download_stream(key_name, proc.stdin)
+            proc.stdin.close()
+            self._check(proc, cmd)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        return progress
+
+    def _restore_directory(self, backup):
+        manifest_key = backup.name + '/' + MANIFEST_NAME
+        if manifest_key not in backup.key_names:
+            raise LookupError(
+                'backup %s has no %s, the dump did not complete' % (
+                backup.name, MANIFEST_NAME))
+        manifest = json.loads(
+            Key(self.s3_bucket, manifest_key).get_contents_as_string())
+        path = os.path.join(self.temp_dir, self.db + '-' + backup.name)
+        os.makedirs(path)
+        try:
+            progress = self.downloader.download_files(
+                [(entry['key'], entry['size'],
+                  os.path.join(path, entry['name']))
+                 for entry in manifest['files']],
+                'downloading %s' % backup.name)
+            cmd = self.command('--format=' + manifest['format'], path)
+            self._check(self._pg_restore(cmd), cmd)
+        finally:
+            logger.debug('deleting dump %s', path)
+            shutil.rmtree(path)
+        return progress
+
+    def run(self, name=None):
+        """
+        Restores backup `name`, or the latest one, and returns its name and
+        the download `Progress`.
+        """
+        backup = self.find(name)
+        logger.info('restoring %s from backup %s in s3 bucket %s',
+            self.db, backup.name, self.s3_bucket.name)
+        if backup.key_names == [backup.name]:
+            progress = self._restore_key(backup.key_names[0])
+        else:
+            progress = self._restore_directory(backup)
+        return backup.name, progress
 
 
 def main():
@@ -119,14 +510,51 @@ def main():
         '-v', '--verbose', action='store_true', default=False)
     opt_parser.add_option(
         '-d', '--dry', action='store_true', default=False)
-    # TODO: if you do more intelligent backup naming this is not needed
-    #       e.g. hrmod48, daymod14, year+month, etc.
     opt_parser.add_option(
-        '-c', '--capacity-count', type='int', default=24 * 365)
+        '-c', '--capacity-count', type='int', default=24 * 365,
+        help='Keep the newest N backups.')
+    opt_parser.add_option(
+        '--keep-hourly', type='int', default=0,
+        help='Also keep the newest backup of each of the last N hours.')
+    opt_parser.add_option(
+        '--keep-daily', type='int', default=0,
+        help='Also keep the newest backup of each of the last N days.')
+    opt_parser.add_option(
+        '--keep-monthly', type='int', default=0,
+        help='Also keep the newest backup of each of the last N months.')
     opt_parser.add_option(
          '--host', default='localhost')
     opt_parser.add_option(
         '-a', '--aws-creds', default=None)
+    opt_parser.add_option(
+        '-j', '--jobs', type='int', default=None,
+        help='Dump N tables at once in directory format, uploading each '
+             'file as it completes. With --restore, restore N tables at '
+             'once.')
+    opt_parser.add_option(
+        '--restore', action='store_true', default=False,
+        help='Restore the database from a backup instead of backing it up.')
+    opt_parser.add_option(
+        '--backup', default=None,
+        help='Backup to restore, defaults to the latest.')
+    opt_parser.add_option(
+        '--download-workers', type='int', default=DEFAULT_WORKERS,
+        help='Number of byte ranges to download at once when restoring.')
+    opt_parser.add_option(
+        '--compression-level', default=DumpDB.compression_level,
+        help='pg_dump compression level, 0-9.')
+    opt_parser.add_option(
+        '--stream', action='store_true', default=False,
+        help='Upload the dump while pg_dump runs instead of via a temp file.')
+    opt_parser.add_option(
+        '--part-size', type='int', default=DEFAULT_PART_SIZE / MB,
+        help='Multipart upload part size in MB.')
+    opt_parser.add_option(
+        '--upload-workers', type='int', default=DEFAULT_WORKERS,
+        help='Number of parts to upload at once.')
+    opt_parser.add_option(
+        '--multipart-threshold', type='int', default=MULTIPART_THRESHOLD / MB,
+        help='Dumps larger than this many MB are uploaded in parts.')
     opts, args = opt_parser.parse_args()
     if args:
         lines = [' '.join(args)]
@@ -144,20 +572,60 @@ def main():
     else:
         aws_access_key, aws_secret_key = get_aws_creds_env()
 
-    s3_cxn = S3Connection(aws_access_key, aws_secret_key)
+    DumpDB.compression_level = str(opts.compression_level)
+
+    def retention():
+        tiers = [Tier(opts.capacity_count)]
+        for count, period_len in [
+                (opts.keep_hourly, Tier.HOURLY),
+                (opts.keep_daily, Tier.DAILY),
+                (opts.keep_monthly, Tier.MONTHLY)]:
+            if count:
+                tiers.append(Tier(count, period_len))
+        return tiers
+
+    s3_cxn = connect(aws_access_key, aws_secret_key)
     for line in lines:
         parts = line.strip().split()
         if len(parts) == 3:
             s3_bucket_name, db, username = parts
         else:
             raise Exception(USAGE)
+        s3_bucket = s3_cxn.bucket(s3_bucket_name)
+        if opts.restore:
+            started_at = time.time()
+            name, progress = Restore(
+                s3_bucket, opts.host, db, username, opts.jobs or 1,
+                opts.download_workers, opts.part_size * MB).run(opts.backup)
+            # the summary of a restore is its output, whatever the log level
+            print ('restored %s from %s: %d MB downloaded, first byte after '
+                   '%.2fs, %.1f MB/s, restored in %.1fs' % (
+                       db, name, progress.done / MB, progress.ttfb or 0.0,
+                       progress.throughput, time.time() - started_at))
+            continue
+        if opts.jobs:
+            DirectoryDump(
+                s3_bucket, DumpDB(opts.host, db, username), opts.jobs,
+                opts.upload_workers, opts.part_size * MB,
+                opts.multipart_threshold * MB).run()
+            reap(s3_bucket, retention(), opts.dry)
+            continue
+        if opts.stream:
+            archive_stream(
+                s3_bucket, DumpDB(opts.host, db, username),
+                opts.part_size * MB, opts.upload_workers)
+            reap(s3_bucket, retention(), opts.dry)
+            continue
         with DumpDB(opts.host, db, username) as dump:
-            s3_bucket = Bucket(s3_cxn, s3_bucket_name)
-            if os.path.getsize(dump.tmp_path) > MAX_UPLOAD_SIZE:
-                archive_in_parts(s3_bucket, dump.tmp_path, dump.timestamp + '.sql')
+            dump_size = os.path.getsize(dump.tmp_path)
+            if dump_size > min(opts.multipart_threshold * MB, MAX_UPLOAD_SIZE):
+                archive_in_parts(
+                    s3_bucket, dump.tmp_path, dump.timestamp + '.sql',
+                    opts.part_size * MB, opts.upload_workers)
             else:
                 archive(s3_bucket, dump.tmp_path, dump.timestamp + '.sql')
-            reap(s3_bucket, opts.capacity_count, opts.dry)
+            reap(s3_bucket, retention(), opts.dry)
+    logger.debug('s3 %s', s3_cxn.utilisation())
 
 if __name__ == '__main__':
     main()
@@ -8,16 +8,28 @@ s3.py list some.bucket --before=30d | s3.py delete some.bucket --verbose
 s3.py list some.db --prefix=some_db_production | while read l; do echo $l ${l:19}; done | s3.py rename some.db --verbose
 """
 import argparse
+import collections
 from datetime import datetime, timedelta
+import errno
 import logging
+import mimetypes
+from multiprocessing.pool import ThreadPool
 import os
 import re
+import stat
 import sys
+import threading
+import time
 
 from boto.s3.bucketlistresultset import bucket_lister
-from boto.s3.connection import S3Connection
 from boto.s3.key import Key
 import iso8601
+from infra.s3 import (
+    MB, DEFAULT_PART_SIZE, DEFAULT_WORKERS, MAX_COPY_SIZE, MAX_DELETE_KEYS,
+    MAX_UPLOAD_SIZE, BatchDeleter, ETagHasher, MultipartCopier,
+    MultipartUploader, RangedDownloader, send_file)
+from infra.s3_client import DEADLINE, POOL_SIZE, connect
+from infra.s3_index import BucketIndex
 from infra.util import get_aws_creds_file, get_aws_creds_env
 
 
@@ -26,19 +38,100 @@ logger = logging.getLogger(__name__)
 
 # commands
 
+def utc_timestamp(ts):
+    """
+    `ts` formatted like S3 listing last modified times, which then compare
+    as strings.
+    """
+    if ts is None:
+        return None
+    if ts.tzinfo is not None:
+        ts = (ts - ts.utcoffset()).replace(tzinfo=None)
+    return ts.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def first_key(s3_bucket, prefix):
+    keys = s3_bucket.get_all_keys(prefix=prefix, max_keys=1)
+    return keys[0] if keys else None
+
+
+def dated_partitions(s3_bucket, prefix, first_day=None, last_day=None):
+    """
+    A `{prefix}YYYYMMDD` partition per day from `first_day` (or the first
+    key's date) to `last_day` (or today), for keys named the way our
+    archivers and backups name them. Days are YYYYMMDD strings.
+    """
+    if first_day is None:
+        key = first_key(s3_bucket, prefix)
+        if key is None:
+            return []
+        first_day = key.name[len(prefix):len(prefix) + 8]
+    try:
+        day = datetime.strptime(first_day, '%Y%m%d')
+    except ValueError:
+        raise ValueError('{} keys with prefix "{}" are not dated'.format(
+                  s3_bucket.name, prefix))
+    last_day = last_day or datetime.utcnow().strftime('%Y%m%d')
+    partitions = []
+    while day.strftime('%Y%m%d') <= last_day:
+        partitions.append(prefix + day.strftime('%Y%m%d'))
+        day += timedelta(days=1)
+    return partitions
+
+
+def delimited_partitions(s3_bucket, prefix, delimiter):
+    """
+    The keys directly under `prefix` and a partition per common prefix,
+    in order.
+    """
+    return sorted(
+        (item if isinstance(item, Key) else item.name
+         for item in s3_bucket.list(prefix=prefix, delimiter=delimiter)),
+        key=lambda item: getattr(item, 'name', item))
+
+
+def list_partitions(s3_bucket, partitions, emit, concurrency=1):
+    """
+    Lists each partition, a key prefix, with up to `concurrency` at once
+    and passes their keys to `emit` in order. Partitions must be disjoint
+    and sorted. Keys given as partitions are passed on as they are.
+    """
+    def list_partition(partition):
+        if isinstance(partition, Key):
+            return [partition]
+        return list(bucket_lister(s3_bucket, prefix=partition))
+
+    def done(partition, keys):
+        for key in keys:
+            emit(key)
+
+    batch = Batch(
+        'list', concurrency,
+        describe=lambda partition: getattr(partition, 'name', partition))
+    return batch.run(list_partition, partitions, done)
+
+
+def open_index(s3_bucket, args):
+    index = BucketIndex(s3_bucket)
+    index.update(fresh=args.fresh)
+    logger.info('%s', index.staleness())
+    return index
+
+
 def list_command(s3_bucket, args):
+    prefix = args.prefix or ''
     logger.debug('listing bucket %s using prefix "%s"',
-                 s3_bucket.name, args.prefix)
-    for key in bucket_lister(s3_bucket, prefix=args.prefix):
-        last_modified = (iso8601
-            .parse_date(key.last_modified)
-            .replace(tzinfo=None))
-        if args.after and last_modified < args.after:
+                 s3_bucket.name, prefix)
+    after = utc_timestamp(args.after)
+    before = utc_timestamp(args.before)
+
+    def emit(key):
+        if after and key.last_modified[:19] < after:
             logger.debug('discarding key %s', key.name)
-            continue
-        if args.before and args.before < last_modified:
+            return
+        if before and before < key.last_modified[:19]:
             logger.debug('discarding key %s', key.name)
-            continue
+            return
         print args.format % {
             'bucket': s3_bucket.name,
             'b': s3_bucket.name,
@@ -50,82 +143,432 @@ def list_command(s3_bucket, args):
             'm': key.last_modified,
         }
 
+    first_day = last_day = None
+    if args.dated:
+        # the window applies to the dates in the key names
+        first_day = after and after[:10].replace('-', '')
+        last_day = before and before[:10].replace('-', '')
+        after = before = None
+    if args.indexed:
+        index = open_index(s3_bucket, args)
+        for entry in index.keys(prefix, after, before):
+            day = entry.name[len(prefix):len(prefix) + 8]
+            if ((first_day and day < first_day) or
+                    (last_day and last_day < day)):
+                continue
+            emit(entry)
+        return
+    if args.dated:
+        # days outside of the window are not listed at all
+        partitions = dated_partitions(
+            s3_bucket, prefix, first_day, last_day)
+    elif args.delimiter:
+        partitions = delimited_partitions(s3_bucket, prefix, args.delimiter)
+    else:
+        partitions = None
+
+    if partitions is None:
+        for key in bucket_lister(s3_bucket, prefix=prefix):
+            emit(key)
+        return
+    logger.debug('listing %d partition(s)', len(partitions))
+    return list_partitions(s3_bucket, partitions, emit, args.concurrency)
+
+
+class Batch(object):
+    """
+    Runs `func(item)` for each item with up to `concurrency` in flight and
+    at most twice that many queued, so input is read as it is consumed.
+    Results are logged, and passed to `done(item, result)`, in input order.
+    A failed item is logged and recorded in `failed` without stopping the
+    batch. An item can stand for several lines, `expand(item)` describes
+    each of them, and `done` can return the descriptions of those that
+    failed.
+    """
+
+    def __init__(self, name, concurrency=1, describe=str, expand=None):
+        self.name = name
+        self.concurrency = max(concurrency, 1)
+        self.describe = describe
+        self.expand = expand or (lambda item: [describe(item)])
+        self.succeeded = 0
+        self.failed = []
+        self.batches = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+
+    def count_bytes(self, size):
+        with self.lock:
+            self.bytes += size
+
+    def _finish(self, item, result, done):
+        lines = self.expand(item)
+        self.batches += 1
+        try:
+            value = result.get()
+            failed = done(item, value) if done is not None else None
+        except Exception, ex:
+            logger.error(
+                '%s %s failed: %s', self.name, self.describe(item), ex)
+            self.failed.extend(lines)
+            return
+        logger.debug('%s %s', self.name, self.describe(item))
+        self.failed.extend(failed or [])
+        self.succeeded += len(lines) - len(failed or [])
+
+    def run(self, func, items, done=None):
+        started_at = time.time()
+        pool = ThreadPool(self.concurrency)
+        pending = collections.deque()
+        try:
+            for item in items:
+                pending.append((item, pool.apply_async(func, (item,))))
+                if len(pending) >= 2 * self.concurrency:
+                    item, result = pending.popleft()
+                    self._finish(item, result, done)
+            while pending:
+                item, result = pending.popleft()
+                self._finish(item, result, done)
+        finally:
+            pool.terminate()
+            pool.join()
+            self.elapsed = time.time() - started_at
+        return self
+
+    def summary(self):
+        elapsed = max(self.elapsed, 0.001)
+        lines = self.succeeded + len(self.failed)
+        summary = '%s: %d ok, %d failed in %.1fs (%.1f/s, %.1f MB/s)' % (
+            self.name, self.succeeded, len(self.failed), self.elapsed,
+            lines / elapsed, self.bytes / elapsed / MB)
+        if self.batches != lines:
+            summary += ', %d batch(es)' % self.batches
+        return summary
+
+
+def read_lines(input):
+    for line_no, line in enumerate(input, 1):
+        line = line.strip()
+        if line:
+            yield line_no, line
+
 
 def download_command(s3_bucket, args):
-    line_no = 0
-    for line in args.input:
-        line_no += 1
-        key_name = line.strip()
-        if not args.dir_path:
-            if not args.dry:
-                output = sys.stdout
-            logger.debug('downloading %s key %s to stdout',
-                s3_bucket.name, key_name)
+    # keys above the multipart threshold are fetched with concurrent range
+    # GETs. Output to stdout is written in input order from the main
+    # thread: smaller keys are buffered, larger ones streamed through a
+    # bounded buffer of ranges.
+    threshold = args.multipart_threshold * MB
+    downloader = RangedDownloader(
+        s3_bucket, args.part_size * MB, args.part_workers)
+    index = open_index(s3_bucket, args) if args.indexed else None
+
+    def lookup():
+        for line_no, key_name in read_lines(args.input):
+            yield key_name, index and index.get(key_name)
+
+    part_sizes = ETagHasher.part_sizes + (args.part_size * MB,)
+
+    def hasher(key, fo=None):
+        return ETagHasher(key.etag, key.size, fo, part_sizes)
+
+    def download((key_name, entry)):
+        if entry is not None:
+            # indexed, no need for a HEAD
+            key = Key(s3_bucket, key_name)
+            key.size, key.etag = entry.size, entry.etag
         else:
-            file_path = os.path.join(dir_path, key_name)
-            logger.debug('downloading %s key %s to %s',
-                s3_bucket.name, key_name, file_path)
-            if not dry:
-                output = open(file_path, 'w')
-        key = s3_bucket.get_key(key_name)
+            key = s3_bucket.get_key(key_name)
         if not key:
             raise ValueError('{} has no key {}'.format(
                       s3_bucket.name, key_name))
-        if not args.dry:
-            try:
-                key.get_contents_to_file(output)
-            finally:
-                if args.dir_path:
-                    output.close()
+        if args.dry:
+            return
+        batch.count_bytes(key.size)
+        if not args.dir_path:
+            if key.size > threshold:
+                return key
+            contents = key.get_contents_as_string()
+            if args.verify:
+                out = hasher(key)
+                out.write(contents)
+                out.check(key_name)
+            return contents
+        file_path = os.path.join(args.dir_path, key_name)
+        try:
+            os.makedirs(os.path.dirname(file_path))
+        except OSError, ex:
+            # or another worker just did
+            if ex.errno != errno.EEXIST:
+                raise
+        if key.size > threshold:
+            downloader.download_file(key_name, file_path, key.size)
+        else:
+            key.get_contents_to_filename(file_path)
+        if args.verify:
+            hasher(key).hash_file(file_path).check(key_name)
+
+    def write((key_name, _), result):
+        if isinstance(result, Key):
+            out = hasher(result, sys.stdout)
+            downloader.download_stream(key_name, out, result.size)
+            if args.verify:
+                out.check(key_name)
+        elif result is not None:
+            sys.stdout.write(result)
+
+    batch = Batch(
+        'download', args.concurrency, describe=lambda (key_name, _): key_name)
+    return batch.run(download, lookup(), write)
+
+
+def chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 def delete_command(s3_bucket, args):
-    line_no = 0
-    for line in args.input:
-        line_no += 1
-        key_name = line.strip()
-        logger.debug('delete %s key %s', s3_bucket.name, key_name)
-        key = s3_bucket.get_key(key_name)
-        if not args.dry:
-            key.delete()
+    # multi-object deletes, no HEAD first; S3 reports deleting a key that
+    # does not exist as a success
+    key_names = (key_name for _, key_name in read_lines(args.input))
+    index = open_index(s3_bucket, args) if args.indexed else None
+
+    def delete(key_names):
+        if args.dry:
+            return []
+        return s3_bucket.delete_keys(key_names, quiet=True).errors
+
+    def report(key_names, errors):
+        for error in errors:
+            logger.error('delete %s failed: %s %s',
+                         error.key, error.code, error.message)
+        failed = [error.key for error in errors]
+        if index is not None and not args.dry:
+            index.discard(set(key_names).difference(failed))
+        return failed
+
+    batch = Batch(
+        'delete', args.concurrency,
+        describe=lambda key_names: '%d key(s) %s .. %s' % (
+            len(key_names), key_names[0], key_names[-1]),
+        expand=list)
+    return batch.run(
+        delete, chunks(key_names, min(args.batch_size, MAX_DELETE_KEYS)),
+        report)
 
 
 def rename_command(s3_bucket, args):
-    line_no = 0
-    for line in args.input:
-        line_no += 1
-        key_names = map(lambda x: x.strip(), line.strip().split())
-        if len(key_names) != 2:
-            raise ValueError(
-                'line #%s invalid, expecting source and destination key name '
-                'pair' % line_no)
-        src_key_name, dst_key_name = key_names
-        logger.debug('renaming %s key %s to %s',
-            s3_bucket.name, src_key_name, dst_key_name)
+
+    def pairs():
+        for line_no, line in read_lines(args.input):
+            key_names = line.split()
+            if len(key_names) != 2:
+                raise ValueError(
+                    'line #%s invalid, expecting source and destination key '
+                    'name pair' % line_no)
+            yield key_names
+
+    def copy((src_key_name, dst_key_name)):
+        if src_key_name == dst_key_name:
+            raise ValueError('source and destination are the same')
         key = s3_bucket.get_key(src_key_name)
         if not key:
             raise ValueError('{} has no key {}'.format(
                       s3_bucket.name, src_key_name))
-        if not args.dry:
+        if args.dry:
+            return
+        if key.size > min(args.multipart_threshold * MB, MAX_COPY_SIZE):
+            MultipartCopier(
+                s3_bucket, args.part_size * MB, args.part_workers,
+            ).copy(key, dst_key_name)
+        else:
             key.copy(s3_bucket.name, dst_key_name)
-            key.delete()
+        batch.count_bytes(key.size)
+
+    def copied((src_key_name, dst_key_name), _):
+        if not args.dry:
+            deleter.add(src_key_name)
+
+    batch = Batch(
+        'rename', args.concurrency, describe=lambda pair: ' -> '.join(pair))
+    # sources are deleted in batches once copied, a rename only counts as
+    # done once its source is gone too
+    with BatchDeleter(s3_bucket) as deleter:
+        batch.run(copy, pairs(), copied)
+    if not args.dry:
+        batch.succeeded = deleter.deleted
+    for error in deleter.errors:
+        batch.failed.append('%s (copied, not deleted)' % error.key)
+    return batch
+
+
+def upload_file(s3_bucket, src_path, dst_path, args):
+    """
+    Uploads `src_path` as `dst_path`, in parts above the multipart
+    threshold, and returns its size.
+    """
+    size = os.path.getsize(src_path)
+    headers = {
+        'Content-Type': (mimetypes.guess_type(src_path)[0] or
+                         Key.DefaultContentType),
+    }
+    if args.public:
+        # applied with the upload, no separate set_acl request
+        headers['x-amz-acl'] = 'public-read'
+    if size > min(args.multipart_threshold * MB, MAX_UPLOAD_SIZE):
+        MultipartUploader(
+            s3_bucket, dst_path, args.part_size * MB, args.part_workers,
+            headers=headers,
+        ).upload_file(src_path)
+    else:
+        with open(src_path, 'rb') as fo:
+            send_file(Key(s3_bucket, dst_path), fo, size, headers=headers)
+    return size
 
 
 def upload_command(s3_bucket, args):
-    line_no = 0
-    for line in args.input:
-        line_no += 1
-        line = line.strip()
-        src_path, _, dst_path = line.partition(' ')
-        if not dst_path:
-            dst_path = os.path.basename(src_path)
-        key = Key(s3_bucket, dst_path)
-        logger.debug('uploading %s %s key from %s',
-            s3_bucket.name, dst_path, src_path)
+
+    def paths():
+        for line_no, line in read_lines(args.input):
+            src_path, _, dst_path = line.partition(' ')
+            yield src_path, dst_path or os.path.basename(src_path)
+
+    def upload((src_path, dst_path)):
         if not args.dry:
-            key.set_contents_from_filename(src_path)
-            if args.public:
-                key.set_acl('public-read')
+            batch.count_bytes(upload_file(s3_bucket, src_path, dst_path, args))
+
+    batch = Batch(
+        'upload', args.concurrency,
+        describe=lambda (src_path, dst_path): '%s as %s' % (
+            src_path, dst_path))
+    return batch.run(upload, paths())
+
+
+def walk_sorted(root, rel=''):
+    """
+    (relative path, stat) of the files under `root` in key order, i.e.
+    sorted as whole '/' separated paths. Only one directory listing per
+    level is held at a time.
+    """
+    entries = []
+    for name in os.listdir(os.path.join(root, rel)):
+        path = os.path.join(root, rel, name)
+        try:
+            st = os.stat(path)
+        except OSError, ex:
+            logger.warning('skipping %s: %s', path, ex)
+            continue
+        if stat.S_ISDIR(st.st_mode) and not os.path.islink(path):
+            entries.append((rel + name + '/', None))
+        elif stat.S_ISREG(st.st_mode):
+            entries.append((rel + name, st))
+    for name, st in sorted(entries):
+        if st is None:
+            for entry in walk_sorted(root, name):
+                yield entry
+        else:
+            yield name, st
+
+
+def merge_join(left, right):
+    """
+    Joins two iterators of (name, item) sorted by name, yielding (name,
+    left item, right item) with None for the side a name is missing from.
+    """
+    l, r = next(left, None), next(right, None)
+    while l is not None or r is not None:
+        if r is None or (l is not None and l[0] < r[0]):
+            yield l[0], l[1], None
+            l = next(left, None)
+        elif l is None or r[0] < l[0]:
+            yield r[0], None, r[1]
+            r = next(right, None)
+        else:
+            yield l[0], l[1], r[1]
+            l, r = next(left, None), next(right, None)
+
+
+def sync_command(s3_bucket, args):
+    # both sides are streamed in key order and merge joined, so memory does
+    # not grow with the number of files
+    prefix = args.prefix or ''
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    local = walk_sorted(args.local_dir)
+    remote = (
+        (key.name.encode('utf-8')[len(prefix):], key)
+        for key in bucket_lister(s3_bucket, prefix=prefix))
+    counts = collections.Counter()
+    part_sizes = ETagHasher.part_sizes + (args.part_size * MB,)
+
+    def newer(st, key):
+        return key.last_modified[:19] < time.strftime(
+            '%Y-%m-%dT%H:%M:%S', time.gmtime(st.st_mtime))
+
+    def changes():
+        for name, st, key in merge_join(local, remote):
+            if st is None:
+                if args.delete:
+                    yield 'delete', name, None, key
+                continue
+            if (key is None or key.size != st.st_size or args.checksum or
+                    newer(st, key)):
+                yield 'upload', name, st, key
+                continue
+            counts['unchanged'] += 1
+
+    def apply((action, name, st, key)):
+        path = os.path.join(args.local_dir, name)
+        if action != 'upload':
+            return action
+        if key is not None and key.size == st.st_size:
+            # same size but newer (or --checksum), only upload if the
+            # contents differ
+            hasher = ETagHasher(key.etag, key.size, part_sizes=part_sizes)
+            if hasher.verifiable:
+                hasher.hash_file(path)
+            if hasher.matches():
+                return 'unchanged'
+            # a multipart ETag matching none of the part sizes we know may
+            # still be of the same contents, fall back to size and mtime
+            if hasher.multipart and not newer(st, key):
+                return 'unchanged'
+        if not args.dry:
+            batch.count_bytes(
+                upload_file(s3_bucket, path, prefix + name, args))
+        return action
+
+    def done((_, name, st, key), action):
+        counts[action] += 1
+        if action == 'unchanged':
+            return
+        if args.dry:
+            print '%s %s' % (action, prefix + name)
+        elif action == 'delete':
+            deleter.add(key.name)
+
+    batch = Batch(
+        'sync', args.concurrency,
+        describe=lambda (action, name, st, key): '%s %s' % (
+            action, prefix + name))
+    with BatchDeleter(s3_bucket) as deleter:
+        batch.run(apply, changes(), done)
+    if not args.dry:
+        # deletes only count once confirmed
+        batch.succeeded += deleter.deleted - counts['delete']
+        counts['delete'] = deleter.deleted
+    for error in deleter.errors:
+        batch.failed.append('delete %s' % error.key)
+    logger.info('sync: %d uploaded, %d deleted, %d unchanged',
+                counts['upload'], counts['delete'], counts['unchanged'])
+    return batch
 
 
 # main
@@ -163,16 +606,53 @@ def create_arg_parser():
         '-s', '--spew', action='store_true', default=False)
     common.add_argument(
         '-c', '--aws-creds', metavar='FILE', default=None)
+    common.add_argument(
+        '--hedge', action='store_true', default=False,
+        help='Send a duplicate of S3 metadata requests (HEADs, listing pages) '
+             'slower than most, and use whichever completes first.')
+    common.add_argument(
+        '--deadline', metavar='SECONDS', type=float, default=DEADLINE,
+        help='Seconds after which hedged S3 requests fail.')
     parents = [common]
 
+    # commands reading keys from stdin
+    concurrent = argparse.ArgumentParser(add_help=False)
+    concurrent.add_argument(
+        '-n', '--concurrency', metavar='N', type=int, default=1,
+        help='Number of lines, or partitions when listing, to process at '
+             'once.')
+
     # root
     root = argparse.ArgumentParser(parents=parents)
     subs = root.add_subparsers(title='sub-commands')
 
+    # commands transferring large keys in parts
+    multipart = argparse.ArgumentParser(add_help=False)
+    multipart.add_argument(
+        '--multipart-threshold', metavar='MB', type=int,
+        default=DEFAULT_PART_SIZE / MB,
+        help='Transfer keys larger than this in parts.')
+    multipart.add_argument(
+        '--part-size', metavar='MB', type=int,
+        default=DEFAULT_PART_SIZE / MB)
+    multipart.add_argument(
+        '--part-workers', metavar='N', type=int, default=DEFAULT_WORKERS,
+        help='Number of parts of a key to transfer at once.')
+
+    # commands that can use the bucket index
+    indexed = argparse.ArgumentParser(add_help=False)
+    indexed.add_argument(
+        '-i', '--indexed', action='store_true', default=False,
+        help='Use the local index of the bucket\'s keys, only listing keys '
+             'added after the last indexed one.')
+    indexed.add_argument(
+        '--fresh', action='store_true', default=False,
+        help='With --indexed, list the whole bucket again first.')
+
     # list
     sub_command = subs.add_parser('list',
         description='List files in S3-BUCKET-NAME.',
-        parents=parents)
+        parents=parents + [concurrent, indexed])
     sub_command.add_argument('s3_bucket_name',
         nargs=1, metavar='S3-BUCKET-NAME', help='S3 bucket.')
     sub_command.add_argument(
@@ -183,6 +663,14 @@ def create_arg_parser():
         '-b', '--before', default=None, action=TimestampAction)
     sub_command.add_argument(
         '-a', '--after', default=None, action=TimestampAction)
+    sub_command.add_argument(
+        '--dated', action='store_true', default=False,
+        help='Keys are named {PREFIX}YYYYMMDD..., list each day as its own '
+             'partition and apply --before/--after to those dates.')
+    sub_command.add_argument(
+        '--delimiter', default=None,
+        help='List each common prefix up to DELIMITER as its own '
+             'partition.')
     sub_command.set_defaults(command=list_command)
 
     # download
@@ -191,7 +679,7 @@ def create_arg_parser():
 Downloads file(s) from S3-BUCKET-NAME. File names are read from stdin one \
 per line.\
 """,
-        parents=parents)
+        parents=parents + [concurrent, indexed, multipart])
     sub_command.add_argument('s3_bucket_name',
         nargs=1, metavar='S3-BUCKET-NAME', help='S3 bucket.')
     sub_command.add_argument('dir_path',
@@ -200,6 +688,9 @@ per line.\
         default=None)
     sub_command.add_argument(
         '-d', '--dry', action='store_true', default=False)
+    sub_command.add_argument(
+        '--no-verify', dest='verify', action='store_false', default=True,
+        help='Do not check downloads against their ETags.')
     sub_command.set_defaults(command=download_command, input=sys.stdin)
 
     # delete
@@ -208,11 +699,15 @@ per line.\
 Deletes file(s) from S3-BUCKET-NAME. File names are read from stdin one per \
 line.\
 """,
-        parents=parents)
+        parents=parents + [concurrent, indexed])
     sub_command.add_argument('s3_bucket_name',
         nargs=1, metavar='S3-BUCKET-NAME', help='S3 bucket.')
     sub_command.add_argument(
         '-d', '--dry', action='store_true', default=False)
+    sub_command.add_argument(
+        '--batch-size', metavar='N', type=int, default=MAX_DELETE_KEYS,
+        help='Number of keys to delete per request, at most %d.' % (
+            MAX_DELETE_KEYS))
     sub_command.set_defaults(command=delete_command, input=sys.stdin)
 
     # rename
@@ -221,7 +716,7 @@ line.\
 Renames file(s) in S3-BUCKET-NAME. The source and destination file names are \
 read from stdin one pair per line.\
 """,
-        parents=parents)
+        parents=parents + [concurrent, multipart])
     sub_command.add_argument('s3_bucket_name',
         nargs=1, metavar='S3-BUCKET-NAME', help='S3 bucket.')
     sub_command.add_argument(
@@ -231,7 +726,7 @@ read from stdin one pair per line.\
     # upload
     sub_command = subs.add_parser('upload',
         description='Uploads file(s) to S3-BUCKET-NAME.',
-        parents=parents)
+        parents=parents + [concurrent, multipart])
     sub_command.add_argument('s3_bucket_name',
         nargs=1, metavar='S3-BUCKET-NAME', help='S3 bucket.')
     sub_command.add_argument(
@@ -243,6 +738,33 @@ read from stdin one pair per line.\
         action='store_true', default=False)
     sub_command.set_defaults(command=upload_command, input=sys.stdin)
 
+    # sync
+    sub_command = subs.add_parser('sync',
+        description="""\
+Uploads the files under LOCAL-DIR that are missing from S3-BUCKET-NAME or \
+differ from their keys there, by size, modification time and ETag.\
+""",
+        parents=parents + [concurrent, multipart])
+    sub_command.add_argument('local_dir',
+        metavar='LOCAL-DIR', help='Directory to sync.')
+    sub_command.add_argument('s3_bucket_name',
+        nargs=1, metavar='S3-BUCKET-NAME[/PREFIX]',
+        help='S3 bucket and optional key prefix.')
+    sub_command.add_argument(
+        '-d', '--dry', action='store_true', default=False,
+        help='Print what would be uploaded or deleted.')
+    sub_command.add_argument(
+        '-p', '--public', action='store_true', default=False)
+    sub_command.add_argument(
+        '--delete', action='store_true', default=False,
+        help='Delete keys under PREFIX with no file under LOCAL-DIR.')
+    sub_command.add_argument(
+        '--checksum', action='store_true', default=False,
+        help='Compare ETags of same sized files even when the file is not '
+             'newer than its key. Keys uploaded in parts of an unknown size '
+             'are still compared by modification time.')
+    sub_command.set_defaults(command=sync_command)
+
     return root
 
 
@@ -264,10 +786,16 @@ def main():
         aws_access_key, aws_secret_key = get_aws_creds_file(args.aws_creds)
     else:
         aws_access_key, aws_secret_key = get_aws_creds_env()
-    logger.debug('creating connection')
-    s3_cxn = S3Connection(aws_access_key, aws_secret_key)
+    # enough pooled connections for every line and part in flight
+    s3_cxn = connect(
+        aws_access_key, aws_secret_key, pool_size=max(
+            POOL_SIZE, args.concurrency * getattr(args, 'part_workers', 1)),
+        hedge=args.hedge, deadline=args.deadline)
 
     # bucket
+    if args.command.func_name == 'sync_command':
+        args.s3_bucket_name[0], _, args.prefix = (
+            args.s3_bucket_name[0].partition('/'))
     if args.command.func_name == 'upload_command' and args.create_bucket:
         logger.debug('getting/creating bucket %s', args.s3_bucket_name[0])
         s3_bucket = s3_cxn.create_bucket(args.s3_bucket_name[0])
@@ -276,7 +804,16 @@ def main():
         s3_bucket = s3_cxn.get_bucket(args.s3_bucket_name[0])
 
     # do it
-    args.command(s3_bucket, args)
+    batch = args.command(s3_bucket, args)
+    if batch is not None:
+        logger.info('%s', batch.summary())
+    logger.info('s3 %s', s3_cxn.utilisation())
+    if batch is not None and batch.failed:
+        sys.stderr.write('%s failed for %d line(s):\n' % (
+            batch.name, len(batch.failed)))
+        for failed in batch.failed:
+            sys.stderr.write(failed + '\n')
+        sys.exit(1)
 
 
 if __name__ == '__main__':
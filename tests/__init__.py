@@ -0,0 +1,10 @@
+import os
+import sys
+
+
+# scripts are not a package, make them importable by the tests
+SCRIPTS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+
+if SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, SCRIPTS_DIR)
@@ -0,0 +1,7 @@
+"""
+Benchmarks backing the performance changes. They are not collected by the
+test runner, run them from the repository root, e.g.::
+
+    python -m tests.benchmarks.bench_codecs /mnt/log/host/2014-06-01
+
+"""
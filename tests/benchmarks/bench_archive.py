@@ -0,0 +1,108 @@
+"""
+Wall time and peak temp dir usage of archiving a host/day log bucket by
+staging the archive in a temp file versus streaming it to S3 multipart.
+Uploads go to an in-memory bucket, or to an S3 stand-in at --host.
+"""
+import argparse
+from datetime import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+
+# on sys.path through tests/__init__.py
+from archive_bucketed_logs import BucketedLog
+from infra.compression import get_codec
+from tests.benchmarks.bench_codecs import dir_size, make_sample
+from tests.fakes import FakeBucket
+
+
+MB = 1024 * 1024
+
+
+class DiskSampler(threading.Thread):
+    """
+    Samples the size of `path` until stopped, keeping the largest.
+    """
+
+    def __init__(self, path, interval=0.005):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.peak = max(self.peak, dir_size(self.path))
+            except OSError:
+                # a file went away while walking
+                pass
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def measure(log, s3_bucket, stream, tmp_dir):
+    BucketedLog.STREAM = stream
+    sampler = DiskSampler(tmp_dir)
+    sampler.start()
+    started = time.time()
+    log.archive(s3_bucket)
+    elapsed = time.time() - started
+    sampler.stop()
+    return elapsed, sampler.peak
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip())
+    arg_parser.add_argument('--size', type=int, default=256,
+                            help='MB of sample logs, default %(default)s')
+    arg_parser.add_argument('--part-size', type=int, default=16,
+                            help='MB per part when streaming')
+    arg_parser.add_argument('--codec', default='gzip')
+    arg_parser.add_argument('--host')
+    arg_parser.add_argument('--port', type=int, default=9000)
+    arg_parser.add_argument('--bucket', default='archive-bench')
+    args = arg_parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        log_path = os.path.join(work_dir, 'logs', 'web-1', '2014-06-01')
+        os.makedirs(os.path.dirname(log_path))
+        make_sample(log_path, args.size * MB)
+        # the staged archive goes to a temp dir of its own, to be measured
+        tmp_dir = os.path.join(work_dir, 'tmp')
+        os.mkdir(tmp_dir)
+        tempfile.tempdir = tmp_dir
+        BucketedLog.CODEC = get_codec(args.codec)
+        BucketedLog.PART_SIZE = args.part_size * MB
+        log = BucketedLog('web-1', datetime(2014, 6, 1), log_path)
+        print '%s: %.1f MB' % (log_path, float(dir_size(log_path)) / MB)
+        print '%-7s %8s %10s' % ('mode', 'seconds', 'peak MB')
+        for stream in [False, True]:
+            if args.host:
+                s3_cxn = S3Connection(
+                    'key', 'secret', host=args.host, port=args.port,
+                    is_secure=False, calling_format=OrdinaryCallingFormat())
+                s3_bucket = s3_cxn.get_bucket(args.bucket, validate=False)
+            else:
+                s3_bucket = FakeBucket()
+            elapsed, peak = measure(log, s3_bucket, stream, tmp_dir)
+            print '%-7s %8.1f %10.1f' % (
+                'stream' if stream else 'staged', elapsed,
+                float(peak) / MB)
+    finally:
+        tempfile.tempdir = None
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
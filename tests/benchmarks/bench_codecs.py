@@ -0,0 +1,93 @@
+"""
+Compression ratio and throughput of each installed codec, archiving a
+directory the way the log archivers do. Without a directory, archives a
+generated sample of web server logs.
+"""
+import argparse
+import distutils.spawn
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from infra.compression import CODECS, get_codec, tar_pipeline, wait
+
+
+MB = 1024 * 1024
+
+PATHS = ['/', '/index.html', '/api/v1/users', '/api/v1/orders',
+         '/static/app.js']
+
+AGENTS = ['Mozilla/5.0 (X11; Linux x86_64)', 'curl/7.35.0',
+          'python-requests/2.3.0']
+
+
+def make_sample(path, size):
+    os.mkdir(path)
+    rnd = random.Random(0)
+    for index in range(4):
+        written = 0
+        with open(os.path.join(path, 'access.log.%d' % index), 'w') as fo:
+            while written < size // 4:
+                line = '10.0.%d.%d - - [01/Jun/2014:%02d:%02d:%02d +0000] ' \
+                       '"GET %s HTTP/1.1" %d %d "-" "%s"\n' % (
+                           rnd.randint(0, 255), rnd.randint(0, 255),
+                           rnd.randint(0, 23), rnd.randint(0, 59),
+                           rnd.randint(0, 59), rnd.choice(PATHS),
+                           rnd.choice([200, 200, 200, 304, 404, 500]),
+                           rnd.randint(0, 100000), rnd.choice(AGENTS))
+                fo.write(line)
+                written += len(line)
+
+
+def dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(dir_path, file_name))
+        for dir_path, _, file_names in os.walk(path)
+        for file_name in file_names)
+
+
+def measure(path, codec, out_path):
+    with open(out_path, 'wb') as fo:
+        started = time.time()
+        wait(tar_pipeline(path, codec, fo))
+        elapsed = time.time() - started
+    return os.path.getsize(out_path), elapsed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip())
+    arg_parser.add_argument('path', nargs='?')
+    arg_parser.add_argument('--sample-size', type=int, default=64,
+                            help='MB of sample logs, default %(default)s')
+    arg_parser.add_argument('--level', type=int)
+    arg_parser.add_argument('--threads', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = args.path
+        if path is None:
+            path = os.path.join(tmp_dir, 'sample')
+            make_sample(path, args.sample_size * MB)
+        path = os.path.abspath(path.rstrip('/'))
+        size = dir_size(path)
+        print '%s: %.1f MB' % (path, float(size) / MB)
+        print '%-6s %10s %8s %8s' % ('codec', 'MB', 'ratio', 'MB/s')
+        for name in sorted(CODECS):
+            codec = get_codec(name, args.level, args.threads)
+            if distutils.spawn.find_executable(codec.program[0]) is None:
+                print '%-6s not installed' % name
+                continue
+            out_path = os.path.join(tmp_dir, 'archive' + codec.extension)
+            archived, elapsed = measure(path, codec, out_path)
+            print '%-6s %10.1f %8.2f %8.1f' % (
+                name, float(archived) / MB, float(size) / archived,
+                size / elapsed / MB)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
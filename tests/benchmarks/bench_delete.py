@@ -0,0 +1,94 @@
+"""
+Requests per key and keys/sec of `s3.py delete`, against the HEAD and
+DELETE per key it used to send. Keys live in an in-memory bucket, or on
+an S3 stand-in at --host, and every request can be given a round trip
+time with --rtt.
+"""
+import argparse
+from StringIO import StringIO
+import threading
+import time
+
+from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+
+# on sys.path through tests/__init__.py
+import s3
+from tests.fakes import FakeBucket
+
+
+class RequestCounter(object):
+    """
+    Wraps `method`, counting calls and sleeping `rtt` seconds in each.
+    """
+
+    def __init__(self, method, rtt):
+        self.method = method
+        self.rtt = rtt
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        with self.lock:
+            self.count += 1
+        time.sleep(self.rtt)
+        return self.method(*args, **kwargs)
+
+
+def per_key(s3_bucket, key_names):
+    for key_name in key_names:
+        key = s3_bucket.get_key(key_name)
+        if key is not None:
+            key.delete()
+
+
+def bulk(s3_bucket, key_names):
+    args = s3.create_arg_parser().parse_args(['delete', s3_bucket.name])
+    args.input = StringIO(''.join(key_name + '\n' for key_name in key_names))
+    batch = s3.delete_command(s3_bucket, args)
+    assert batch.succeeded == len(key_names), batch.failed
+
+
+def make_bucket(args, key_names):
+    if not args.host:
+        s3_bucket = FakeBucket()
+        for key_name in key_names:
+            s3_bucket.contents[key_name] = 'data'
+        counter = RequestCounter(s3_bucket.count, args.rtt / 1000.0)
+        s3_bucket.count = counter
+        return s3_bucket, counter
+    s3_cxn = S3Connection(
+        'key', 'secret', host=args.host, port=args.port, is_secure=False,
+        calling_format=OrdinaryCallingFormat())
+    s3_bucket = s3_cxn.get_bucket(args.bucket, validate=False)
+    for key_name in key_names:
+        s3_bucket.new_key(key_name).set_contents_from_string('data')
+    counter = RequestCounter(s3_cxn.make_request, args.rtt / 1000.0)
+    s3_cxn.make_request = counter
+    return s3_bucket, counter
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip())
+    arg_parser.add_argument('--keys', type=int, default=5000)
+    arg_parser.add_argument('--rtt', type=float, default=20,
+                            help='ms per request, default %(default)s')
+    arg_parser.add_argument('--host')
+    arg_parser.add_argument('--port', type=int, default=9000)
+    arg_parser.add_argument('--bucket', default='delete-bench')
+    args = arg_parser.parse_args()
+
+    key_names = ['logs/%08d' % i for i in xrange(args.keys)]
+    print '%-8s %9s %13s %10s' % ('mode', 'requests', 'requests/key',
+                                  'keys/sec')
+    for name, delete in [('per-key', per_key), ('bulk', bulk)]:
+        s3_bucket, counter = make_bucket(args, key_names)
+        started = time.time()
+        delete(s3_bucket, key_names)
+        elapsed = time.time() - started
+        print '%-8s %9d %13.3f %10.0f' % (
+            name, counter.count, float(counter.count) / len(key_names),
+            len(key_names) / elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Tail latency of S3 HEADs with and without hedging, against a local S3
+stand-in that answers most requests after --latency ms and a fraction
+of them after --outlier ms.
+"""
+import argparse
+import BaseHTTPServer
+import random
+import SocketServer
+import threading
+import time
+
+from boto.s3.connection import OrdinaryCallingFormat
+
+from infra.s3_client import PooledS3Connection
+
+
+class OutlierServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, latency, outlier, outlier_rate, seed=0):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), OutlierHandler)
+        self.latency = latency
+        self.outlier = outlier
+        self.outlier_rate = outlier_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def delay(self):
+        with self.lock:
+            self.requests += 1
+            outlier = self.random.random() < self.outlier_rate
+        return self.outlier if outlier else self.latency
+
+
+class OutlierHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # one write per response, or Nagle delays every other one
+    wbufsize = -1
+
+    def do_HEAD(self):
+        time.sleep(self.server.delay())
+        self.send_response(200)
+        self.send_header('Content-Length', '4')
+        self.send_header('ETag', '"8d777f385d3dfec8815d20f7496026dc"')
+        self.send_header('Last-Modified', 'Sun, 01 Jun 2014 00:00:00 GMT')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def percentile(samples, percent):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * percent / 100.0),
+                       len(samples) - 1)]
+
+
+def measure(port, hedge, count, server):
+    s3_cxn = PooledS3Connection(
+        'key', 'secret', host='127.0.0.1', port=port, is_secure=False,
+        calling_format=OrdinaryCallingFormat(), hedge=hedge)
+    s3_bucket = s3_cxn.get_bucket('bucket', validate=False)
+    requests = server.requests
+    latencies = []
+    for i in xrange(count):
+        started = time.time()
+        assert s3_bucket.get_key('logs/%08d' % i) is not None
+        latencies.append(time.time() - started)
+    return latencies, server.requests - requests, s3_cxn.stats
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip())
+    arg_parser.add_argument('--requests', type=int, default=500)
+    arg_parser.add_argument('--latency', type=float, default=5)
+    arg_parser.add_argument('--outlier', type=float, default=500)
+    arg_parser.add_argument('--outlier-rate', type=float, default=0.02)
+    args = arg_parser.parse_args()
+
+    server = OutlierServer(
+        args.latency / 1000.0, args.outlier / 1000.0, args.outlier_rate)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    port = server.server_address[1]
+    print '%-6s %8s %8s %8s %8s %8s %6s' % (
+        'hedge', 'p50 ms', 'p99 ms', 'max ms', 'total s', 'requests',
+        'wins')
+    for hedge in [False, True]:
+        latencies, requests, stats = measure(
+            port, hedge, args.requests, server)
+        print '%-6s %8.1f %8.1f %8.1f %8.1f %8d %6d' % (
+            'on' if hedge else 'off', percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000, max(latencies) * 1000,
+            sum(latencies), requests, stats['hedge_wins'])
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+MB/s through a tunnel to a local paramiko SSH server. Its direct-tcpip
+channels either swallow what they are sent (upload) or send a given
+number of bytes (download), so only the tunnel relay and SSH itself are
+measured.
+"""
+import argparse
+import os
+import socket
+import threading
+import time
+
+import paramiko
+
+from infra.tunnel import TunnelThread
+
+
+MB = 1024 * 1024
+
+BLOCK = os.urandom(64 * 1024)
+
+
+class StandInServer(paramiko.ServerInterface):
+    """
+    Lets anyone in and accepts every direct-tcpip channel. Port 0 is a
+    sink, any other port sends that many KB.
+    """
+
+    def __init__(self):
+        self.destinations = {}
+
+    def get_allowed_auths(self, username):
+        return 'none'
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'direct-tcpip':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin,
+                                           destination):
+        self.destinations[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+
+def sink(chan):
+    total = 0
+    while True:
+        data = chan.recv(256 * 1024)
+        if not data:
+            break
+        total += len(data)
+    chan.sendall(str(total))
+    chan.close()
+
+
+def source(chan, size):
+    while size > 0:
+        chan.sendall(BLOCK[:size])
+        size -= len(BLOCK)
+    chan.close()
+
+
+def serve(listener, host_key):
+    while True:
+        sock, _ = listener.accept()
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(host_key)
+        server = StandInServer()
+        transport.start_server(server=server)
+        thread = threading.Thread(target=serve_channels,
+                                  args=(transport, server))
+        thread.daemon = True
+        thread.start()
+
+
+def serve_channels(transport, server):
+    while transport.is_active():
+        chan = transport.accept(1)
+        if chan is None:
+            continue
+        _, port = server.destinations.pop(chan.get_id())
+        if port == 0:
+            target, args = sink, (chan,)
+        else:
+            target, args = source, (chan, port * 1024)
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+
+def start_server():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+    thread = threading.Thread(
+        target=serve, args=(listener, paramiko.RSAKey.generate(2048)))
+    thread.daemon = True
+    thread.start()
+    return listener.getsockname()[1]
+
+
+def connect(port):
+    transport = paramiko.Transport(
+        socket.create_connection(('127.0.0.1', port)))
+    transport.start_client()
+    transport.auth_none('bench')
+    return transport
+
+
+def upload(port, size):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sent = 0
+    while sent < size:
+        sock.sendall(BLOCK[:size - sent])
+        sent += len(BLOCK)
+    sock.shutdown(socket.SHUT_WR)
+    received = int(sock.makefile().read())
+    sock.close()
+    assert received == size, (received, size)
+
+
+def download(port, size):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.shutdown(socket.SHUT_WR)
+    received = 0
+    while True:
+        data = sock.recv(256 * 1024)
+        if not data:
+            break
+        received += len(data)
+    sock.close()
+    assert received == size, (received, size)
+
+
+def measure(transport, backend, buffer_size, direction, size, connections):
+    remote_port = '0' if direction == 'upload' else str(size // 1024)
+    tunnel = TunnelThread('127.0.0.1', remote_port, 0, transport,
+                          buffer_size=buffer_size, backend=backend)
+    tunnel.daemon = True
+    tunnel.start()
+    target = upload if direction == 'upload' else download
+    threads = [
+        threading.Thread(target=target, args=(tunnel.local_port, size))
+        for _ in xrange(connections)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    tunnel.server.shutdown()
+    return float(size) * connections / elapsed / MB
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip())
+    arg_parser.add_argument('--size', type=int, default=64,
+                            help='MB per connection, default %(default)s')
+    arg_parser.add_argument('--connections', type=int, default=1)
+    arg_parser.add_argument('--buffer-size', type=int, action='append',
+                            help='relay buffer KB, default 1 and 64')
+    arg_parser.add_argument('--backend', action='append',
+                            choices=['threads', 'events'])
+    args = arg_parser.parse_args()
+
+    transport = connect(start_server())
+    print '%-8s %8s %-8s %8s' % ('backend', 'buffer', 'dir', 'MB/s')
+    for backend in args.backend or ['threads', 'events']:
+        for buffer_kb in args.buffer_size or [1, 64]:
+            for direction in ['upload', 'download']:
+                rate = measure(transport, backend, buffer_kb * 1024,
+                               direction, args.size * MB, args.connections)
+                print '%-8s %7dK %-8s %8.1f' % (
+                    backend, buffer_kb, direction, rate)
+    transport.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""
+In-memory stand-ins for the boto S3 objects the scripts use.
+"""
+import collections
+import hashlib
+import threading
+import urlparse
+
+from boto.provider import Provider
+from boto.s3.key import Key
+
+
+CompletedUpload = collections.namedtuple('CompletedUpload', 'key_name etag')
+
+DeleteResult = collections.namedtuple('DeleteResult', 'deleted errors')
+
+
+class FakeResponse(object):
+
+    def __init__(self, status, reason, etag=None):
+        self.status = status
+        self.reason = reason
+        self.etag = etag
+
+    def getheader(self, name, default=None):
+        if name.lower() == 'etag' and self.etag is not None:
+            return self.etag
+        return default
+
+    def getheaders(self):
+        return [('etag', self.etag)] if self.etag is not None else []
+
+    def read(self):
+        return ''
+
+
+class FakeHTTPConnection(object):
+    """
+    Takes a single PUT from a boto sender and answers `status`, with the
+    MD5 of the body as ETag when it succeeds.
+    """
+
+    def __init__(self, status=200):
+        self.status = status
+        self.headers = {}
+        self.sent = []
+
+    def putrequest(self, method, path, **kwargs):
+        pass
+
+    def putheader(self, name, value):
+        self.headers[name] = value
+
+    def endheaders(self):
+        pass
+
+    def set_debuglevel(self, level):
+        pass
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def getresponse(self):
+        if self.status != 200:
+            return FakeResponse(self.status, 'Internal Error')
+        return FakeResponse(
+            200, 'OK', '"%s"' % hashlib.md5(''.join(self.sent)).hexdigest())
+
+
+class FakeConnection(object):
+    """
+    Runs the senders boto's Key uses to PUT data. The first `errors` PUTs
+    are answered with a 500, which is retried with the same sender as boto
+    does.
+    """
+
+    debug = 0
+
+    def __init__(self, bucket, errors=0):
+        self.bucket = bucket
+        self.errors = errors
+        self.attempts = 0
+        self.provider = Provider('aws', 'key', 'secret')
+        self.lock = threading.Lock()
+
+    def _required_auth_capability(self):
+        return ['s3']
+
+    def make_request(self, method, bucket='', key='', headers=None, data='',
+                     query_args=None, sender=None, **kwargs):
+        assert method == 'PUT' and sender is not None
+        while True:
+            with self.lock:
+                self.attempts += 1
+                error = self.errors > 0
+                self.errors -= error
+            http_conn = FakeHTTPConnection(500 if error else 200)
+            response = sender(http_conn, method, '/%s/%s' % (bucket, key),
+                              data, headers)
+            if response.status == 200:
+                break
+        self.bucket.put(key, ''.join(http_conn.sent), headers, query_args)
+        return response
+
+
+class FakeMultiPartUpload(object):
+    """
+    Keeps the parts uploaded to it and completes with the ETag S3 would
+    give. The first `failures[part_num]` uploads of a part fail.
+    """
+
+    def __init__(self, bucket, key_name, upload_id, headers=None,
+                 failures=None):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.id = upload_id
+        self.headers = headers
+        self.failures = dict(failures or {})
+        self.parts = {}
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def fail(self, part_num):
+        with self.lock:
+            if self.failures.get(part_num):
+                self.failures[part_num] -= 1
+                raise IOError('part %d failed' % part_num)
+
+    def upload_part_from_file(self, fo, part_num, md5=None, size=None):
+        data = fo.read() if size is None else fo.read(size)
+        self.fail(part_num)
+        if md5 is not None and md5[0] != hashlib.md5(data).hexdigest():
+            raise IOError('part %d does not match its MD5' % part_num)
+        with self.lock:
+            self.parts[part_num] = data
+        key = Key(self.bucket, self.key_name)
+        key.local_hashes['md5'] = hashlib.md5(data).digest()
+        return key
+
+    def complete_upload(self):
+        digests = [
+            hashlib.md5(self.parts[part_num]).digest()
+            for part_num in sorted(self.parts)]
+        etag = '"%s-%d"' % (
+            hashlib.md5(''.join(digests)).hexdigest(), len(digests))
+        self.bucket.contents[self.key_name] = ''.join(
+            self.parts[part_num] for part_num in sorted(self.parts))
+        return CompletedUpload(self.key_name, etag)
+
+    def cancel_upload(self):
+        self.cancelled = True
+
+
+class FakeBucket(object):
+    """
+    Bucket whose uploads end up in `contents`, and their headers in
+    `headers`, by key name. The first `errors` PUTs are answered with a 500
+    and retried, see `FakeConnection`. Other requests are counted by method
+    in `requests`.
+    """
+
+    def __init__(self, name='bucket', failures=None, errors=0):
+        self.name = name
+        self.failures = failures
+        self.connection = FakeConnection(self, errors)
+        self.contents = {}
+        self.headers = {}
+        self.uploads = []
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+
+    def count(self, method):
+        with self.lock:
+            self.requests[method] += 1
+
+    def new_key(self, key_name):
+        return Key(self, key_name)
+
+    def get_key(self, key_name):
+        self.count('get_key')
+        if key_name not in self.contents:
+            return None
+        key = Key(self, key_name)
+        key.size = len(self.contents[key_name])
+        return key
+
+    def delete_key(self, key_name, **kwargs):
+        self.count('delete_key')
+        self.contents.pop(key_name, None)
+
+    def delete_keys(self, key_names, quiet=False):
+        # deleting a missing key succeeds, as on S3
+        self.count('delete_keys')
+        for key_name in key_names:
+            self.contents.pop(key_name, None)
+        return DeleteResult([] if quiet else list(key_names), [])
+
+    def initiate_multipart_upload(self, key_name, headers=None):
+        mp = FakeMultiPartUpload(
+            self, key_name, str(len(self.uploads)), headers, self.failures)
+        self.uploads.append(mp)
+        return mp
+
+    def put(self, key_name, data, headers, query_args=None):
+        params = dict(urlparse.parse_qsl(query_args or ''))
+        if 'uploadId' not in params:
+            self.contents[key_name] = data
+            self.headers[key_name] = headers
+            return
+        mp = self.uploads[int(params['uploadId'])]
+        part_num = int(params['partNumber'])
+        mp.fail(part_num)
+        with mp.lock:
+            mp.parts[part_num] = data
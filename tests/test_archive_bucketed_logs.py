@@ -0,0 +1,83 @@
+from datetime import datetime
+import os
+import shutil
+from StringIO import StringIO
+import tarfile
+import tempfile
+import unittest
+
+import mock
+
+# on sys.path through tests/__init__.py
+from archive_bucketed_logs import (
+    BucketedLog, BucketedLogStreamer, get_logs, main)
+from infra.s3 import MB
+from tests.fakes import FakeBucket
+
+
+class TestBucketedLogs(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def log(self, host, date, data):
+        path = os.path.join(self.dir_path, host, date)
+        os.makedirs(path)
+        with open(os.path.join(path, 'app.log'), 'wb') as fo:
+            fo.write(data)
+        return BucketedLog(host, datetime.strptime(date, '%Y-%m-%d'), path)
+
+    def test_get_logs(self):
+        self.log('web-1', '2014-06-02', 'b')
+        self.log('web-2', '2014-06-01', 'a')
+        os.mkdir(os.path.join(self.dir_path, 'web-1', 'not-a-date'))
+        open(os.path.join(self.dir_path, 'stray'), 'w').close()
+        self.assertEqual(
+            [log.name for log in get_logs(self.dir_path)],
+            ['20140601_web-2.tar.gz', '20140602_web-1.tar.gz'])
+
+    def test_is_archived(self):
+        log = self.log('web-1', '2014-06-01', 'a')
+        self.assertTrue(log.is_archived(set(['20140601_web-1.tar.zst'])))
+        self.assertFalse(log.is_archived(set(['20140601_web-2.tar.gz'])))
+
+    def test_stream(self):
+        # incompressible, so the archive spans three parts
+        data = os.urandom(12 * MB)
+        log = self.log('web-1', '2014-06-01', data)
+        s3_bucket = FakeBucket()
+        BucketedLogStreamer(log, 5 * MB).upload(s3_bucket)
+        self.assertEqual(len(s3_bucket.uploads[0].parts), 3)
+        archive = tarfile.open(
+            fileobj=StringIO(s3_bucket.contents['20140601_web-1.tar.gz']))
+        self.assertEqual(
+            archive.extractfile('2014-06-01/app.log').read(), data)
+
+    def test_stream_failed(self):
+        log = self.log('web-1', '2014-06-01', 'a')
+        shutil.rmtree(log.path)
+        s3_bucket = FakeBucket()
+        with open(os.devnull, 'w') as devnull:
+            # keeps tar's complaint out of the test output
+            with mock.patch('sys.stderr', devnull):
+                self.assertRaises(
+                    RuntimeError,
+                    BucketedLogStreamer(log, 5 * MB).upload, s3_bucket)
+        self.assertTrue(s3_bucket.uploads[0].cancelled)
+        self.assertEqual(s3_bucket.contents, {})
+
+    def test_min_part_size(self):
+        log = self.log('web-1', '2014-06-01', 'a')
+        self.assertRaises(ValueError, BucketedLogStreamer, log, MB)
+
+    def test_part_size_option(self):
+        argv = ['archive_bucketed_logs.py', '--stream', '--part-size', '1',
+                'bucket', self.dir_path]
+        with open(os.devnull, 'w') as devnull:
+            with mock.patch('sys.argv', argv):
+                with mock.patch('sys.stderr', devnull):
+                    self.assertRaises(SystemExit, main)
+        self.assertEqual(BucketedLog.PART_SIZE, 16 * MB)
@@ -0,0 +1,225 @@
+import collections
+import sys
+import unittest
+
+import mock
+
+# on sys.path through tests/__init__.py
+import backup_db
+from backup_db import Backup, DumpDB, Restore, Tier, archive_stream, reap
+from infra.s3 import MB
+from tests.fakes import FakeBucket
+
+
+FakeKey = collections.namedtuple('FakeKey', 'name last_modified')
+
+# two backups a day at 00:10 and 12:10 from 2014-01-30 to 2014-03-02, and
+# a few more within the last day
+TIMESTAMPS = sorted(
+    ['2014-%s-%02dT%s:10:00.000Z' % (month, day, hour)
+     for month, days in [('01', [30, 31]), ('02', range(1, 29)),
+                         ('03', [1, 2])]
+     for day in days
+     for hour in ['00', '12']] +
+    ['2014-03-02T12:40:00.000Z', '2014-03-02T13:10:00.000Z',
+     '2014-03-02T13:40:00.000Z'])
+
+
+def backup(timestamp):
+    return Backup(timestamp, [FakeKey(timestamp, timestamp)])
+
+
+def retained(tier, timestamps=TIMESTAMPS):
+    for timestamp in timestamps:
+        tier.offer(backup(timestamp))
+    return sorted(backup.name for backup in tier.retained.itervalues())
+
+
+class TestTier(unittest.TestCase):
+
+    def test_newest(self):
+        self.assertEqual(retained(Tier(3)), TIMESTAMPS[-3:])
+
+    def test_hourly(self):
+        self.assertEqual(retained(Tier(3, Tier.HOURLY)), [
+            '2014-03-02T00:10:00.000Z',
+            '2014-03-02T12:40:00.000Z',
+            '2014-03-02T13:40:00.000Z',
+        ])
+
+    def test_daily(self):
+        self.assertEqual(retained(Tier(3, Tier.DAILY)), [
+            '2014-02-28T12:10:00.000Z',
+            '2014-03-01T12:10:00.000Z',
+            '2014-03-02T13:40:00.000Z',
+        ])
+
+    def test_monthly(self):
+        self.assertEqual(retained(Tier(2, Tier.MONTHLY)), [
+            '2014-02-28T12:10:00.000Z',
+            '2014-03-02T13:40:00.000Z',
+        ])
+        self.assertEqual(retained(Tier(12, Tier.MONTHLY)), [
+            '2014-01-31T12:10:00.000Z',
+            '2014-02-28T12:10:00.000Z',
+            '2014-03-02T13:40:00.000Z',
+        ])
+
+    def test_offer_order(self):
+        # listings come sorted by name, not by last modified
+        timestamps = list(reversed(TIMESTAMPS))
+        for tier in [Tier(3), Tier(3, Tier.HOURLY), Tier(3, Tier.DAILY)]:
+            self.assertEqual(
+                retained(tier, timestamps),
+                retained(Tier(tier.count, tier.period_len)))
+
+    def test_dropped(self):
+        tier = Tier(2, Tier.DAILY)
+        dropped = []
+        for timestamp in TIMESTAMPS:
+            dropped.extend(tier.offer(backup(timestamp)))
+        # every backup is either dropped once or retained
+        self.assertEqual(
+            sorted([each.name for each in dropped] +
+                   retained(tier, [])),
+            TIMESTAMPS)
+
+
+class TestReap(unittest.TestCase):
+
+    def reap(self, keys, tiers, dry=False):
+        s3_bucket = mock.Mock()
+        s3_bucket.name = 'bucket'
+        s3_bucket.delete_keys.return_value.errors = []
+        with mock.patch.object(
+                backup_db, 'BucketListResultSet', lambda bucket: keys):
+            reaped = reap(s3_bucket, tiers, dry)
+        deleted = []
+        for call in s3_bucket.delete_keys.call_args_list:
+            deleted.extend(call[0][0])
+        return reaped, sorted(deleted)
+
+    def test_tiers(self):
+        keys = [FakeKey(timestamp, timestamp) for timestamp in TIMESTAMPS]
+        tiers = [Tier(3), Tier(3, Tier.DAILY), Tier(2, Tier.MONTHLY)]
+        kept = set(TIMESTAMPS[-3:] + [
+            '2014-02-28T12:10:00.000Z', '2014-03-01T12:10:00.000Z'])
+        reaped, deleted = self.reap(keys, tiers)
+        self.assertEqual(reaped, len(TIMESTAMPS) - len(kept))
+        self.assertEqual(deleted, sorted(set(TIMESTAMPS) - kept))
+
+    def test_directory_dumps(self):
+        # a directory dump is one backup of many keys, newest last modified
+        keys = [
+            FakeKey('a', '2014-03-01T00:00:00.000Z'),
+            FakeKey('b/1.dat', '2014-03-01T01:00:00.000Z'),
+            FakeKey('b/2.dat', '2014-03-01T03:00:00.000Z'),
+            FakeKey('b/MANIFEST.json', '2014-03-01T03:00:01.000Z'),
+            FakeKey('c', '2014-03-01T02:00:00.000Z'),
+        ]
+        reaped, deleted = self.reap(keys, [Tier(1)])
+        self.assertEqual(reaped, 2)
+        self.assertEqual(deleted, ['a', 'c'])
+
+    def test_dry(self):
+        keys = [FakeKey(timestamp, timestamp) for timestamp in TIMESTAMPS]
+        reaped, deleted = self.reap(keys, [Tier(1)], dry=True)
+        self.assertEqual(reaped, len(TIMESTAMPS) - 1)
+        self.assertEqual(deleted, [])
+
+
+class ScriptDump(DumpDB):
+    """
+    Dumps whatever `script` writes to stdout, then exits with `code`.
+    """
+
+    def __init__(self, script, code=0):
+        DumpDB.__init__(self, 'localhost', 'db', 'user')
+        self.script = script
+        self.code = code
+
+    def command(self, *options):
+        return [sys.executable, '-c', 'import sys; %s; sys.exit(%d)' % (
+            self.script, self.code)]
+
+
+class TestArchiveStream(unittest.TestCase):
+
+    script = "sys.stdout.write('x' * (12 * 1024 * 1024 + 3))"
+
+    def test_stream(self):
+        s3_bucket = FakeBucket()
+        key_name = archive_stream(
+            s3_bucket, ScriptDump(self.script), part_size=5 * MB, workers=2)
+        self.assertEqual(s3_bucket.contents[key_name], 'x' * (12 * MB + 3))
+        self.assertEqual(len(s3_bucket.uploads[0].parts), 3)
+
+    def test_empty(self):
+        s3_bucket = FakeBucket()
+        key_name = archive_stream(s3_bucket, ScriptDump('pass'))
+        self.assertEqual(s3_bucket.contents[key_name], '')
+
+    def test_failed_dump(self):
+        s3_bucket = FakeBucket()
+        self.assertRaises(
+            RuntimeError, archive_stream, s3_bucket,
+            ScriptDump(self.script, code=1), part_size=5 * MB)
+        self.assertTrue(s3_bucket.uploads[0].cancelled)
+        self.assertEqual(s3_bucket.contents, {})
+
+
+class TestRestore(unittest.TestCase):
+
+    keys = [
+        FakeKey('20140301_000000.sql', '2014-03-01T00:10:00.000Z'),
+        FakeKey('20140302_000000.sql', '2014-03-02T00:15:00.000Z'),
+        FakeKey('20140302_000000/1.dat', '2014-03-02T00:10:00.000Z'),
+        FakeKey('20140302_000000/MANIFEST.json', '2014-03-02T00:20:00.000Z'),
+    ]
+
+    def restore(self, jobs=1):
+        s3_bucket = mock.Mock()
+        s3_bucket.name = 'bucket'
+        s3_bucket.list.side_effect = lambda prefix: [
+            key for key in self.keys if key.name.startswith(prefix)]
+        return Restore(s3_bucket, 'localhost', 'db', 'user', jobs)
+
+    def test_find_latest(self):
+        with mock.patch.object(
+                backup_db, 'BucketListResultSet', lambda bucket: self.keys):
+            backup = self.restore().find()
+        self.assertEqual(backup.name, '20140302_000000')
+        self.assertEqual(backup.key_names, [
+            '20140302_000000/1.dat', '20140302_000000/MANIFEST.json'])
+
+    def test_find_latest_complete(self):
+        # a directory dump still being uploaded has no manifest yet
+        keys = self.keys + [
+            FakeKey('20140303_000000/1.dat', '2014-03-03T00:10:00.000Z')]
+        with mock.patch.object(
+                backup_db, 'BucketListResultSet', lambda bucket: keys):
+            self.assertEqual(self.restore().find().name, '20140302_000000')
+        with mock.patch.object(
+                backup_db, 'BucketListResultSet', lambda bucket: keys[-1:]):
+            self.assertRaises(LookupError, self.restore().find)
+
+    def test_find(self):
+        backup = self.restore().find('20140302_000000.sql')
+        self.assertEqual(backup.key_names, ['20140302_000000.sql'])
+        # any key of a directory dump names it
+        backup = self.restore().find('20140302_000000/1.dat')
+        self.assertEqual(backup.name, '20140302_000000')
+        self.assertEqual(len(backup.key_names), 2)
+        self.assertRaises(LookupError, self.restore().find, '20140303')
+
+    def test_find_empty(self):
+        with mock.patch.object(
+                backup_db, 'BucketListResultSet', lambda bucket: []):
+            self.assertRaises(LookupError, self.restore().find)
+
+    def test_command(self):
+        self.assertEqual(self.restore().command('dump'), [
+            'pg_restore', '--user=user', '--host=localhost', '--dbname=db',
+            'dump'])
+        self.assertEqual(
+            self.restore(jobs=4).command()[-1], '--jobs=4')
@@ -0,0 +1,90 @@
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+import mock
+
+from infra.compression import EXTENSIONS, get_codec, tar_pipeline, wait
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_command(self):
+        self.assertEqual(get_codec('gzip').command(), ['gzip', '-c'])
+        self.assertEqual(
+            get_codec('zstd', level=3, threads=0).command(),
+            ['zstd', '-c', '-q', '-3', '-T0'])
+        self.assertEqual(
+            get_codec('pigz', level=9, threads=4).shell_command(),
+            'pigz -c -9 -p4')
+
+    def test_threads_per_core(self):
+        with mock.patch('multiprocessing.cpu_count', lambda: 6):
+            # pigz rejects -p0
+            self.assertEqual(
+                get_codec('pigz', threads=0).command(),
+                ['pigz', '-c', '-p6'])
+            # zstd and xz take 0 as one thread per core themselves
+            self.assertEqual(
+                get_codec('zstd', threads=0).command()[-1], '-T0')
+            self.assertEqual(get_codec('xz', threads=0).command()[-1], '-T0')
+
+    def test_no_threads_flag(self):
+        # gzip is single threaded, threads are ignored
+        self.assertEqual(
+            get_codec('gzip', level=1, threads=4).command(),
+            ['gzip', '-c', '-1'])
+
+    def test_configure_copies(self):
+        codec = get_codec('xz', level=6)
+        self.assertEqual(codec.configure(threads=2).command(),
+                         ['xz', '-c', '-6', '-T2'])
+        self.assertEqual(codec.command(), ['xz', '-c', '-6'])
+        self.assertEqual(get_codec('xz').command(), ['xz', '-c'])
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, get_codec, 'lz4')
+
+    def test_extensions(self):
+        self.assertEqual(EXTENSIONS, ['.tar.gz', '.tar.xz', '.tar.zst'])
+
+
+class TestTarPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.dir_path, '2014-06-01')
+        os.mkdir(self.log_path)
+        with open(os.path.join(self.log_path, 'app.log'), 'w') as fo:
+            fo.write('line\n' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def test_gzip(self):
+        archive_path = os.path.join(self.dir_path, 'archive.tar.gz')
+        with open(archive_path, 'wb') as fo:
+            wait(tar_pipeline(self.log_path, get_codec('gzip', 1), fo))
+        with tarfile.open(archive_path) as archive:
+            self.assertEqual(
+                archive.extractfile('2014-06-01/app.log').read(),
+                'line\n' * 1000)
+
+    def test_pipe(self):
+        tar, compressor = tar_pipeline(
+            self.log_path, get_codec('gzip'), subprocess.PIPE)
+        data = compressor.stdout.read()
+        wait([tar, compressor])
+        self.assertEqual(data[:2], '\x1f\x8b')
+
+    def test_failed(self):
+        missing_path = os.path.join(self.dir_path, 'missing')
+        with open(os.devnull, 'w') as devnull:
+            # keeps tar's complaint out of the test output
+            with mock.patch('sys.stderr', devnull):
+                procs = tar_pipeline(
+                    missing_path, get_codec('gzip'), devnull)
+            self.assertRaises(RuntimeError, wait, procs)
@@ -0,0 +1,57 @@
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# fab -l runs in about 0.2s, this only catches gross regressions; eagerly
+# imported task modules are caught by test_lazy_imports
+LIST_SECONDS = 1.0
+
+# as `fab -l`, reporting the heavy modules imported on the way
+LIST_SCRIPT = """
+import sys
+from fabric.main import main
+sys.argv = ['fab', '-l']
+try:
+    main()
+except SystemExit:
+    pass
+print ' '.join(
+    name for name in ('boto', 'fabric_rundeck', 'requests')
+    if name in sys.modules)
+"""
+
+
+def fab_list():
+    started_at = time.time()
+    process = subprocess.Popen(
+        [sys.executable, '-c', LIST_SCRIPT], cwd=ROOT_DIR,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise AssertionError('fab -l failed:\n%s' % stderr)
+    return time.time() - started_at, stdout.splitlines()
+
+
+class TestTaskListing(unittest.TestCase):
+
+    def test_lists_tasks(self):
+        _, lines = fab_list()
+        tasks = [line.split()[0] for line in lines[:-1] if line.strip()]
+        self.assertTrue('logs.archive_all' in tasks)
+        self.assertTrue('refresh_inventory' in tasks)
+
+    def test_lazy_imports(self):
+        _, lines = fab_list()
+        self.assertEqual(lines[-1], '')
+
+    def test_startup_time(self):
+        # best of a few, the first run may be compiling
+        elapsed = min(fab_list()[0] for _ in xrange(3))
+        self.assertTrue(
+            elapsed < LIST_SECONDS,
+            'fab -l took %.2fs, over %.2fs' % (elapsed, LIST_SECONDS))
@@ -0,0 +1,19 @@
+import importlib
+import unittest
+
+import mock
+
+# fabfile.logs itself is a stub of lazy tasks
+logs = importlib.import_module('fabfile.logs')
+
+
+class TestArchiveAll(unittest.TestCase):
+
+    @mock.patch('fabfile.logs.find_hosts', lambda pattern: ['a', 'b'])
+    @mock.patch('fabfile.logs.execute_parallel')
+    def test_passes_jobs_through(self, execute_parallel):
+        execute_parallel.return_value.failed = []
+        logs.archive_all.wrapped(workers='4', jobs='3', codec='zstd')
+        execute_parallel.assert_called_with(
+            logs.archive, ['a', 'b'], workers=4, timeout=7200,
+            kwargs={'jobs': '3', 'codec': 'zstd'})
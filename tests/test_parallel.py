@@ -0,0 +1,76 @@
+import os
+import time
+import unittest
+
+from fabric.api import abort, env, hide, task
+
+from infra.parallel import HostResult, ParallelReport, execute_parallel
+
+
+@task
+def host_task(delay='0'):
+    if env.host == 'bad':
+        abort('bad host')
+    if env.host == 'quits':
+        # leaves without sending a result
+        os._exit(0)
+    time.sleep(float(delay))
+    return env.host.upper()
+
+
+class TestParallelReport(unittest.TestCase):
+
+    def test_summary(self):
+        report = ParallelReport('archive', ['a', 'b', 'c'])
+        report.add(HostResult('b', False, error='Traceback\n  boom\n',
+                              duration=2.0))
+        report.add(HostResult('a', True, result=1, duration=1.0))
+        report.finished_at = report.started_at + 3
+        self.assertEqual([r.host for r in report.succeeded], ['a'])
+        self.assertEqual([r.host for r in report.failed], ['b'])
+        self.assertEqual(report.summary(), '\n'.join([
+            'archive on 3 host(s): 1 ok, 1 failed in 3.0s',
+            '  a: ok (1.0s)',
+            '  b: failed (2.0s)',
+            '    Traceback',
+            '      boom',
+            '  c: not run',
+        ]))
+
+
+class TestExecuteParallel(unittest.TestCase):
+
+    def test_results(self):
+        with hide('aborts'):
+            report = execute_parallel(
+                host_task, ['a', 'bad', 'c', 'd'], workers=2)
+        self.assertEqual(
+            dict((r.host, r.result) for r in report.succeeded),
+            {'a': 'A', 'c': 'C', 'd': 'D'})
+        [failed] = report.failed
+        self.assertEqual(failed.host, 'bad')
+        self.assertTrue('bad host' in failed.error)
+
+    def test_workers(self):
+        # 4 hosts of 0.5s, 2 at a time
+        started_at = time.time()
+        report = execute_parallel(
+            host_task, ['a', 'b', 'c', 'd'], workers=2,
+            kwargs={'delay': '0.5'})
+        self.assertEqual(len(report.succeeded), 4)
+        self.assertTrue(1.0 <= time.time() - started_at < 1.9)
+
+    def test_timeout(self):
+        report = execute_parallel(
+            host_task, ['a'], timeout=0.5, kwargs={'delay': '5'})
+        [failed] = report.failed
+        self.assertTrue(failed.timed_out)
+        self.assertEqual(failed.status, 'timed out')
+
+    def test_exit_without_result(self):
+        report = execute_parallel(host_task, ['a', 'quits'], timeout=10)
+        self.assertEqual([r.host for r in report.succeeded], ['a'])
+        [failed] = report.failed
+        self.assertEqual(failed.host, 'quits')
+        self.assertFalse(failed.timed_out)
+        self.assertEqual(failed.error, 'exited without a result')
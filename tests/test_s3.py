@@ -0,0 +1,258 @@
+import hashlib
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
+import unittest
+
+from infra.s3 import (
+    MB, AWS_CLI_PART_SIZE, MAX_PARTS, MIN_PART_SIZE, ETagHasher, KeyIndex,
+    MultipartUploader, check_etag, part_ranges)
+from tests.fakes import CompletedUpload, FakeBucket
+
+
+def data_of(size):
+    return ('0123456789abcdef' * (size // 16 + 1))[:size]
+
+
+def multipart_etag(data, part_size):
+    # as S3 computes it for an upload in part_ranges parts
+    digests = [
+        hashlib.md5(data[offset:offset + length]).digest()
+        for _, offset, length in part_ranges(len(data), part_size)]
+    return '"%s-%d"' % (hashlib.md5(''.join(digests)).hexdigest(),
+                        len(digests))
+
+
+class TestPartRanges(unittest.TestCase):
+
+    def test_parts(self):
+        self.assertEqual(list(part_ranges(12 * MB, 5 * MB)), [
+            (1, 0, 5 * MB), (2, 5 * MB, 5 * MB), (3, 10 * MB, 2 * MB)])
+        self.assertEqual(list(part_ranges(10 * MB, 5 * MB)), [
+            (1, 0, 5 * MB), (2, 5 * MB, 5 * MB)])
+
+    def test_empty(self):
+        # an empty upload still needs one part
+        self.assertEqual(list(part_ranges(0, 5 * MB)), [(1, 0, 0)])
+
+    def test_min_part_size(self):
+        self.assertEqual(
+            list(part_ranges(6 * MB, MB)),
+            [(1, 0, MIN_PART_SIZE), (2, MIN_PART_SIZE, MB)])
+
+    def test_max_parts(self):
+        size = MAX_PARTS * 6 * MB + 1
+        ranges = list(part_ranges(size, 5 * MB))
+        self.assertTrue(len(ranges) <= MAX_PARTS)
+        self.assertEqual(ranges[-1][0], len(ranges))
+        self.assertEqual(sum(length for _, _, length in ranges), size)
+        for (_, offset, length), (_, next_offset, _) in zip(
+                ranges, ranges[1:]):
+            self.assertEqual(offset + length, next_offset)
+
+
+class TestCheckETag(unittest.TestCase):
+
+    def setUp(self):
+        self.data = data_of(12 * MB)
+        self.digests = dict(
+            (part_num, hashlib.md5(self.data[offset:offset + length]).digest())
+            for part_num, offset, length in part_ranges(len(self.data),
+                                                        5 * MB))
+
+    def test_match(self):
+        check_etag(CompletedUpload(
+            'key', multipart_etag(self.data, 5 * MB)), self.digests)
+
+    def test_mismatch(self):
+        self.digests[2] = hashlib.md5('other').digest()
+        self.assertRaises(RuntimeError, check_etag, CompletedUpload(
+            'key', multipart_etag(self.data, 5 * MB)), self.digests)
+
+    def test_missing_part(self):
+        del self.digests[3]
+        self.assertRaises(RuntimeError, check_etag, CompletedUpload(
+            'key', multipart_etag(self.data, 5 * MB)), self.digests)
+
+
+class TestMultipartUploader(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir_path, 'data')
+        self.data = data_of(12 * MB + 3)
+        with open(self.path, 'wb') as fo:
+            fo.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def test_upload_file(self):
+        s3_bucket = FakeBucket()
+        completed = MultipartUploader(
+            s3_bucket, 'key', part_size=5 * MB, workers=2).upload_file(
+                self.path)
+        self.assertEqual(s3_bucket.contents['key'], self.data)
+        self.assertEqual(len(s3_bucket.uploads[0].parts), 3)
+        self.assertEqual(completed.etag, multipart_etag(self.data, 5 * MB))
+
+    def test_retried_part(self):
+        s3_bucket = FakeBucket(failures={2: 2})
+        MultipartUploader(
+            s3_bucket, 'key', part_size=5 * MB, backoff=0).upload_file(
+                self.path)
+        self.assertEqual(s3_bucket.contents['key'], self.data)
+
+    def test_retried_put(self):
+        # boto retries a PUT answered with a 500 from the same sender
+        s3_bucket = FakeBucket(errors=2)
+        completed = MultipartUploader(
+            s3_bucket, 'key', part_size=5 * MB).upload_file(self.path)
+        self.assertEqual(s3_bucket.connection.attempts, 5)
+        self.assertEqual(s3_bucket.contents['key'], self.data)
+        self.assertEqual(completed.etag, multipart_etag(self.data, 5 * MB))
+
+    def test_upload_stream(self):
+        s3_bucket = FakeBucket()
+        # parts below S3's minimum are grown to it
+        completed = MultipartUploader(
+            s3_bucket, 'key', part_size=MB, workers=2).upload_stream(
+                StringIO(self.data))
+        self.assertEqual(s3_bucket.contents['key'], self.data)
+        self.assertEqual(
+            [len(part) for _, part in
+             sorted(s3_bucket.uploads[0].parts.iteritems())],
+            [5 * MB, 5 * MB, 2 * MB + 3])
+        self.assertEqual(completed.etag, multipart_etag(self.data, 5 * MB))
+
+    def test_failed_part(self):
+        s3_bucket = FakeBucket(failures={2: 4})
+        uploader = MultipartUploader(
+            s3_bucket, 'key', part_size=5 * MB, backoff=0)
+        self.assertRaises(IOError, uploader.upload_file, self.path)
+        self.assertTrue(s3_bucket.uploads[0].cancelled)
+        self.assertFalse('key' in s3_bucket.contents)
+
+
+class TestETagHasher(unittest.TestCase):
+
+    def hasher(self, etag, data, **kwargs):
+        hasher = ETagHasher(etag, len(data), **kwargs)
+        for offset in xrange(0, len(data), 3 * MB):
+            hasher.write(data[offset:offset + 3 * MB])
+        return hasher
+
+    def test_single_part(self):
+        data = data_of(3 * MB + 5)
+        hasher = self.hasher('"%s"' % hashlib.md5(data).hexdigest(), data)
+        self.assertTrue(hasher.verifiable)
+        self.assertTrue(hasher.check('key'))
+
+    def test_single_part_mismatch(self):
+        data = data_of(1000)
+        hasher = self.hasher('"%s"' % hashlib.md5('other').hexdigest(), data)
+        self.assertRaises(IOError, hasher.check, 'key')
+
+    def test_default_part_size(self):
+        # as uploaded by MultipartUploader
+        data = data_of(100 * MB)
+        hasher = self.hasher(multipart_etag(data, 64 * MB), data)
+        self.assertTrue(hasher.verifiable)
+        self.assertTrue(hasher.check('key'))
+
+    def test_aws_cli_part_size(self):
+        data = data_of(20 * MB)
+        hasher = self.hasher(multipart_etag(data, AWS_CLI_PART_SIZE), data)
+        self.assertTrue(hasher.check('key'))
+
+    def test_given_part_size(self):
+        data = data_of(40 * MB)
+        etag = multipart_etag(data, 16 * MB)
+        self.assertFalse(self.hasher(etag, data).verifiable)
+        hasher = self.hasher(etag, data, part_sizes=[16 * MB])
+        self.assertTrue(hasher.verifiable)
+        self.assertTrue(hasher.check('key'))
+
+    def test_unknown_part_size_same_count(self):
+        # 7MB parts give as many as 8MB ones, which must not fail
+        data = data_of(20 * MB)
+        hasher = self.hasher(multipart_etag(data, 7 * MB), data)
+        self.assertTrue(hasher.verifiable)
+        self.assertFalse(hasher.matches())
+        self.assertFalse(hasher.check('key'))
+
+    def test_unknown_part_size(self):
+        data = data_of(20 * MB)
+        hasher = self.hasher(multipart_etag(data, 5 * MB), data)
+        self.assertFalse(hasher.verifiable)
+        self.assertFalse(hasher.check('key'))
+
+    def test_corrupt_multipart(self):
+        data = data_of(20 * MB)
+        etag = multipart_etag(data, AWS_CLI_PART_SIZE)
+        hasher = self.hasher(etag, data[:-1] + 'x')
+        self.assertFalse(hasher.matches())
+
+    def test_hash_file_and_fo(self):
+        data = data_of(2 * MB + 1)
+        dir_path = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dir_path, 'data')
+            with open(path, 'wb') as fo:
+                fo.write(data)
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+            self.assertTrue(
+                ETagHasher(etag, len(data)).hash_file(path).check('key'))
+            with open(path + '.copy', 'wb') as fo:
+                ETagHasher(etag, len(data), fo).hash_file(path)
+            with open(path + '.copy', 'rb') as fo:
+                self.assertEqual(fo.read(), data)
+        finally:
+            shutil.rmtree(dir_path)
+
+
+class TestKeyIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = ['20140301_a', '20140301_b', '20140302_a', 'other']
+        self.listed = []
+
+    def list_keys(self, prefix):
+        self.listed.append(prefix)
+        return [name for name in self.keys if name.startswith(prefix)]
+
+    def test_prefixes(self):
+        index = KeyIndex(self.list_keys, prefix_len=8)
+        self.assertTrue('20140301_a' in index)
+        self.assertTrue('20140301_b' in index)
+        self.assertFalse('20140301_c' in index)
+        self.assertTrue('20140302_a' in index)
+        self.assertFalse('20140303_a' in index)
+        # one listing per prefix asked about
+        self.assertEqual(self.listed, ['20140301', '20140302', '20140303'])
+
+    def test_whole_bucket(self):
+        index = KeyIndex(self.list_keys)
+        self.assertTrue('other' in index)
+        self.assertTrue('20140302_a' in index)
+        self.assertFalse('missing' in index)
+        self.assertEqual(self.listed, [''])
+
+    def test_add_discard(self):
+        index = KeyIndex(self.list_keys, prefix_len=8)
+        self.assertFalse('20140301_c' in index)
+        index.add('20140301_c')
+        self.assertTrue('20140301_c' in index)
+        index.discard('20140301_a')
+        self.assertFalse('20140301_a' in index)
+        self.assertEqual(self.listed, ['20140301'])
+
+    def test_refresh(self):
+        index = KeyIndex(self.list_keys, prefix_len=8)
+        self.assertTrue('20140301_a' in index)
+        self.keys.remove('20140301_a')
+        self.assertTrue('20140301_a' in index)
+        index.refresh('20140301')
+        self.assertFalse('20140301_a' in index)
+        self.assertTrue('20140301_b' in index)
@@ -0,0 +1,134 @@
+import socket
+import threading
+import time
+import unittest
+
+from boto.exception import BotoServerError, PleaseRetryException
+import mock
+
+from infra.s3_client import Latencies, PooledS3Connection
+
+
+def error_body(code):
+    return '<Error><Code>%s</Code><Message>x</Message></Error>' % code
+
+
+class TestRetries(unittest.TestCase):
+
+    def setUp(self):
+        self.s3_cxn = PooledS3Connection(
+            'key', 'secret', backoff=0.1, max_backoff=0.5)
+
+    def test_retryable(self):
+        retryable = self.s3_cxn.retryable
+        self.assertTrue(retryable(BotoServerError(500, 'Internal')))
+        self.assertTrue(retryable(BotoServerError(
+            400, 'Bad Request', error_body('RequestTimeout'))))
+        self.assertTrue(retryable(socket.error(104, 'reset')))
+        self.assertFalse(retryable(BotoServerError(
+            403, 'Forbidden', error_body('AccessDenied'))))
+        self.assertFalse(retryable(BotoServerError(400, 'Bad Request')))
+        self.assertFalse(retryable(ValueError()))
+
+    def test_delay(self):
+        for attempt in xrange(10):
+            delay = self.s3_cxn.delay(attempt)
+            self.assertTrue(
+                0.5 * min(0.1 * 2 ** attempt, 0.5) <= delay <=
+                1.5 * min(0.1 * 2 ** attempt, 0.5))
+
+    def test_sender_error_body(self):
+        response = mock.Mock()
+        response.status = 400
+        response.reason = 'Bad Request'
+        response.read.return_value = error_body('RequestTimeout')
+        sender = mock.Mock(
+            side_effect=PleaseRetryException('timeout', response=response))
+        send = PooledS3Connection._error_body_sender(sender)
+        try:
+            send(None, 'PUT', '/', '', {})
+        except BotoServerError, ex:
+            self.assertEqual(ex.error_code, 'RequestTimeout')
+            self.assertTrue(self.s3_cxn.retryable(ex))
+        else:
+            self.fail('not raised')
+
+
+class TestLatencies(unittest.TestCase):
+
+    def test_percentile(self):
+        latencies = Latencies(size=100)
+        for latency in xrange(1, 20):
+            latencies.add(latency)
+        # too few samples
+        self.assertEqual(latencies.percentile(95), None)
+        latencies.add(20)
+        self.assertEqual(latencies.percentile(50), 11)
+        self.assertEqual(latencies.percentile(95), 20)
+        self.assertEqual(latencies.percentile(100), 20)
+
+    def test_window(self):
+        latencies = Latencies(size=20)
+        for latency in xrange(100):
+            latencies.add(latency)
+        self.assertEqual(latencies.percentile(0), 80)
+
+
+class TestHedging(unittest.TestCase):
+
+    def setUp(self):
+        self.s3_cxn = PooledS3Connection(
+            'key', 'secret', hedge=True, hedge_percentile=90, deadline=1.0)
+        for _ in xrange(20):
+            self.s3_cxn.latencies['HEAD'].add(0.05)
+        self.attempts = 0
+        self.responses = []
+        self.lock = threading.Lock()
+
+    def head(self, delays):
+        # each attempt takes the next of `delays` seconds, and answers with
+        # a response of its own
+        def make_request(s3_cxn, *args):
+            with self.lock:
+                delay = delays[self.attempts]
+                self.attempts += 1
+                response = mock.Mock()
+                self.responses.append(response)
+            time.sleep(delay)
+            return response
+
+        with mock.patch(
+                'infra.s3_client.S3Connection.make_request', make_request):
+            return self.s3_cxn.make_request('HEAD', 'bucket', 'key')
+
+    def test_fast(self):
+        self.head([0.0])
+        self.assertEqual(self.attempts, 1)
+        self.assertEqual(self.s3_cxn.stats['hedged'], 0)
+
+    def test_hedge_wins(self):
+        started_at = time.time()
+        response = self.head([0.5, 0.0, 0.0])
+        self.assertTrue(time.time() - started_at < 0.4)
+        self.assertEqual(self.attempts, 2)
+        self.assertTrue(response is self.responses[1])
+        self.assertEqual(self.s3_cxn.stats['hedged'], 1)
+        self.assertEqual(self.s3_cxn.stats['hedge_wins'], 1)
+        # the slow first response is dropped once it lands, the next
+        # request gets its own
+        time.sleep(0.5)
+        self.assertTrue(self.responses[0].read.called)
+        response = self.head([0.5, 0.0, 0.0])
+        self.assertTrue(response is self.responses[2])
+        self.assertEqual(self.s3_cxn.stats['hedge_wins'], 1)
+
+    def test_deadline(self):
+        self.assertRaises(IOError, self.head, [2.0, 2.0])
+        self.assertEqual(self.s3_cxn.stats['past_deadline'], 1)
+
+    def test_not_hedged(self):
+        with mock.patch(
+                'infra.s3_client.S3Connection.make_request') as make_request:
+            self.s3_cxn.make_request('PUT', 'bucket', 'key')
+        self.assertEqual(make_request.call_count, 1)
+        self.assertEqual(self.s3_cxn.stats['hedged'], 0)
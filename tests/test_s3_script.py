@@ -0,0 +1,345 @@
+import collections
+import hashlib
+import os
+import shutil
+from StringIO import StringIO
+import sys
+import tempfile
+import unittest
+
+from boto.s3.key import Key
+import mock
+
+# on sys.path through tests/__init__.py
+import s3
+from infra.s3 import MB
+from tests.fakes import FakeBucket
+
+
+FakeKey = collections.namedtuple('FakeKey', 'name size etag last_modified')
+
+DeleteResult = collections.namedtuple('DeleteResult', 'errors')
+
+DeleteError = collections.namedtuple('DeleteError', 'key code message')
+
+OLD = '2014-06-01T00:00:00.000Z'
+
+FUTURE = '2999-01-01T00:00:00.000Z'
+
+
+class TempDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir_path, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fo:
+            fo.write(data)
+
+
+class TestWalkSorted(TempDirTestCase):
+
+    def test_key_order(self):
+        # 'a-b' sorts before 'a/' as a key, though the directory 'a' sorts
+        # before 'a-b' as a name
+        for name in ['a/x', 'a/b/y', 'a-b/z', 'top', 'a0']:
+            self.write(name, name)
+        os.mkdir(os.path.join(self.dir_path, 'empty'))
+        names = [name for name, _ in s3.walk_sorted(self.dir_path)]
+        self.assertEqual(names, ['a-b/z', 'a/b/y', 'a/x', 'a0', 'top'])
+        self.assertEqual(names, sorted(names))
+
+    def test_stat(self):
+        self.write('x', 'four')
+        [(name, st)] = list(s3.walk_sorted(self.dir_path))
+        self.assertEqual(st.st_size, 4)
+
+
+class TestMergeJoin(unittest.TestCase):
+
+    def test_join(self):
+        left = iter([('a', 1), ('b', 2), ('d', 4)])
+        right = iter([('b', 'B'), ('c', 'C'), ('e', 'E')])
+        self.assertEqual(list(s3.merge_join(left, right)), [
+            ('a', 1, None), ('b', 2, 'B'), ('c', None, 'C'),
+            ('d', 4, None), ('e', None, 'E')])
+
+    def test_empty(self):
+        self.assertEqual(list(s3.merge_join(iter([]), iter([]))), [])
+        self.assertEqual(
+            list(s3.merge_join(iter([('a', 1)]), iter([]))),
+            [('a', 1, None)])
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_order_and_failures(self):
+        def func(item):
+            if item % 3 == 0:
+                raise ValueError(item)
+            return item * 2
+
+        done = []
+        batch = s3.Batch('double', concurrency=4).run(
+            func, iter(xrange(1, 11)), lambda item, value: done.append(
+                (item, value)))
+        self.assertEqual(done, [
+            (1, 2), (2, 4), (4, 8), (5, 10), (7, 14), (8, 16), (10, 20)])
+        self.assertEqual(batch.succeeded, 7)
+        self.assertEqual(batch.failed, ['3', '6', '9'])
+        self.assertTrue(batch.summary().startswith(
+            'double: 7 ok, 3 failed in '))
+
+    def test_reads_as_consumed(self):
+        read = []
+
+        def items():
+            for item in xrange(100):
+                read.append(item)
+                yield item
+
+        ahead = []
+
+        def done(item, value):
+            ahead.append(len(read) - item - 1)
+
+        s3.Batch('read', concurrency=2).run(lambda item: item, items(), done)
+        self.assertEqual(len(read), 100)
+        # at most twice the concurrency is queued
+        self.assertTrue(max(ahead) <= 2 * 2)
+
+    def test_expand(self):
+        # items standing for several lines, done returning failed ones
+        batch = s3.Batch('lines', expand=list).run(
+            lambda lines: lines, [['a', 'b'], ['c'], ['d', 'e']],
+            lambda lines, value: [line for line in value if line == 'd'])
+        self.assertEqual(batch.succeeded, 4)
+        self.assertEqual(batch.failed, ['d'])
+        self.assertTrue(batch.summary().endswith(', 3 batch(es)'))
+
+
+class TestDelete(unittest.TestCase):
+
+    def delete(self, lines, errors, *argv):
+        args = s3.create_arg_parser().parse_args(
+            ['delete', 'bucket'] + list(argv))
+        args.input = StringIO(lines)
+        s3_bucket = mock.Mock()
+        s3_bucket.name = 'bucket'
+
+        def delete_keys(key_names, quiet=False):
+            return DeleteResult([
+                DeleteError(key_name, 'AccessDenied', 'Access Denied')
+                for key_name in key_names if key_name in errors])
+
+        s3_bucket.delete_keys.side_effect = delete_keys
+        batch = s3.delete_command(s3_bucket, args)
+        return batch, [
+            call[0][0] for call in s3_bucket.delete_keys.call_args_list]
+
+    def test_chunks(self):
+        self.assertEqual(
+            list(s3.chunks(iter('abcde'), 2)), [['a', 'b'], ['c', 'd'], ['e']])
+        self.assertEqual(list(s3.chunks(iter(''), 2)), [])
+
+    def test_batches(self):
+        batch, requests = self.delete(
+            'a\nb\n\nc\nd\ne\n', ['d'], '--batch-size', '2')
+        self.assertEqual(requests, [['a', 'b'], ['c', 'd'], ['e']])
+        self.assertEqual(batch.succeeded, 4)
+        self.assertEqual(batch.failed, ['d'])
+
+    def test_max_batch_size(self):
+        lines = ''.join('%d\n' % i for i in xrange(2500))
+        batch, requests = self.delete(lines, [], '--batch-size', '5000')
+        self.assertEqual([len(key_names) for key_names in requests],
+                         [1000, 1000, 500])
+        self.assertEqual(batch.succeeded, 2500)
+
+    def test_dry(self):
+        batch, requests = self.delete('a\nb\n', [], '--dry')
+        self.assertEqual(requests, [])
+        self.assertEqual(batch.succeeded, 2)
+
+    def test_requests_per_key(self):
+        s3_bucket = FakeBucket()
+        for i in xrange(2500):
+            s3_bucket.contents['key-%d' % i] = 'data'
+        args = s3.create_arg_parser().parse_args(['delete', 'bucket'])
+        # a missing key is deleted all the same
+        args.input = StringIO(
+            ''.join('key-%d\n' % i for i in xrange(2501)))
+        batch = s3.delete_command(s3_bucket, args)
+        # one request per 1000 keys, and no HEADs
+        self.assertEqual(s3_bucket.requests, {'delete_keys': 3})
+        self.assertEqual(batch.succeeded, 2501)
+        self.assertEqual(s3_bucket.contents, {})
+
+
+class TestRename(unittest.TestCase):
+
+    def rename(self, lines, delete_keys):
+        args = s3.create_arg_parser().parse_args(['rename', 'bucket'])
+        args.input = StringIO(lines)
+        s3_bucket = mock.Mock()
+        s3_bucket.name = 'bucket'
+        s3_bucket.get_key.return_value.size = 1
+        s3_bucket.delete_keys.side_effect = delete_keys
+        # no backoff between delete retries
+        with mock.patch('infra.s3.random.uniform', lambda a, b: 0):
+            return s3.rename_command(s3_bucket, args)
+
+    def test_renamed(self):
+        batch = self.rename('a x\nb y\n', lambda names, quiet: DeleteResult(
+            []))
+        self.assertEqual(batch.succeeded, 2)
+        self.assertEqual(batch.failed, [])
+
+    def test_source_not_deleted(self):
+        batch = self.rename('a x\nb y\n', lambda names, quiet: DeleteResult(
+            [DeleteError('b', 'AccessDenied', 'Access Denied')]))
+        self.assertEqual(batch.succeeded, 1)
+        self.assertEqual(batch.failed, ['b (copied, not deleted)'])
+
+    def test_delete_request_fails(self):
+        # every source of the failed batch counts as failed, nothing raises
+        def delete_keys(names, quiet):
+            raise IOError('connection reset')
+
+        batch = self.rename('a x\nb y\nc z\n', delete_keys)
+        self.assertEqual(batch.succeeded, 0)
+        self.assertEqual(batch.failed, [
+            'a (copied, not deleted)', 'b (copied, not deleted)',
+            'c (copied, not deleted)'])
+
+
+class CountingFile(file):
+    """
+    File counting the bytes read from every instance in `bytes_read`.
+    """
+
+    bytes_read = 0
+
+    @classmethod
+    def open(cls, *args):
+        return cls(*args)
+
+    def read(self, *args):
+        data = file.read(self, *args)
+        CountingFile.bytes_read += len(data)
+        return data
+
+
+class TestUploadFile(TempDirTestCase):
+
+    def upload(self, s3_bucket, name, *argv):
+        args = s3.create_arg_parser().parse_args(
+            ['upload', 'bucket'] + list(argv))
+        return s3.upload_file(
+            s3_bucket, os.path.join(self.dir_path, name), name, args)
+
+    def test_multipart(self):
+        data = 'x' * (6 * MB)
+        self.write('big.txt', data)
+        s3_bucket = FakeBucket()
+        size = self.upload(
+            s3_bucket, 'big.txt', '--multipart-threshold', '5',
+            '--part-size', '5', '--public')
+        self.assertEqual(size, len(data))
+        self.assertEqual(s3_bucket.contents['big.txt'], data)
+        self.assertEqual(len(s3_bucket.uploads[0].parts), 2)
+        self.assertEqual(s3_bucket.uploads[0].headers, {
+            'Content-Type': 'text/plain', 'x-amz-acl': 'public-read'})
+
+    def test_small(self):
+        self.write('small.txt', 'data')
+        s3_bucket = FakeBucket()
+        self.assertEqual(self.upload(s3_bucket, 'small.txt', '--public'), 4)
+        self.assertEqual(s3_bucket.contents['small.txt'], 'data')
+        headers = s3_bucket.headers['small.txt']
+        self.assertEqual(headers['Content-Type'], 'text/plain')
+        self.assertEqual(headers['x-amz-acl'], 'public-read')
+        self.assertEqual(headers['Content-Length'], '4')
+
+    def test_retried(self):
+        # the file is read once per attempt, and retries still verify
+        data = os.urandom(100 * 1024)
+        self.write('small.bin', data)
+        s3_bucket = FakeBucket(errors=2)
+        with mock.patch('__builtin__.open', CountingFile.open):
+            CountingFile.bytes_read = 0
+            self.upload(s3_bucket, 'small.bin')
+        self.assertEqual(s3_bucket.contents['small.bin'], data)
+        self.assertEqual(s3_bucket.connection.attempts, 3)
+        self.assertEqual(CountingFile.bytes_read, 3 * len(data))
+
+
+class TestSync(TempDirTestCase):
+
+    def sync(self, keys, *argv):
+        args = s3.create_arg_parser().parse_args(
+            ['sync', self.dir_path, 'bucket', '--dry'] + list(argv))
+        args.prefix = ''
+        s3_bucket = mock.Mock()
+        s3_bucket.name = 'bucket'
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            with mock.patch('s3.bucket_lister', lambda *a, **kw: keys):
+                s3.sync_command(s3_bucket, args)
+            return sorted(sys.stdout.getvalue().splitlines())
+        finally:
+            sys.stdout = stdout
+
+    def test_failed_deletes(self):
+        self.write('same', 'same data')
+        keys = [
+            FakeKey('gone', 1, '"x"', OLD),
+            FakeKey('same', 9, '"%s"' % hashlib.md5('same data').hexdigest(),
+                    OLD),
+            FakeKey('vanished', 1, '"x"', OLD),
+        ]
+        args = s3.create_arg_parser().parse_args(
+            ['sync', self.dir_path, 'bucket', '--delete'])
+        args.prefix = ''
+        s3_bucket = mock.Mock()
+        s3_bucket.name = 'bucket'
+
+        def delete_keys(names, quiet):
+            raise IOError('connection reset')
+
+        s3_bucket.delete_keys.side_effect = delete_keys
+        with mock.patch('s3.bucket_lister', lambda *a, **kw: keys):
+            with mock.patch('infra.s3.random.uniform', lambda a, b: 0):
+                batch = s3.sync_command(s3_bucket, args)
+        self.assertEqual(batch.succeeded, 1)
+        self.assertEqual(batch.failed, ['delete gone', 'delete vanished'])
+
+    def test_plan(self):
+        for name in ['changed', 'missing', 'multi_newer', 'multi_older',
+                     'same']:
+            self.write(name, name + ' data')
+        md5 = lambda name: '"%s"' % hashlib.md5(name + ' data').hexdigest()
+        keys = [
+            FakeKey('changed', 12, md5('other'), OLD),
+            FakeKey('gone', 1, md5('gone'), OLD),
+            FakeKey('multi_newer', 16, '"0123-1"', OLD),
+            FakeKey('multi_older', 16, '"0123-1"', FUTURE),
+            FakeKey('same', 9, md5('same'), OLD),
+        ]
+        self.assertEqual(self.sync(keys, '--delete', '--checksum'), [
+            'delete gone',
+            'upload changed',
+            'upload missing',
+            'upload multi_newer',
+        ])
+        self.assertEqual(self.sync(keys), [
+            'upload changed',
+            'upload missing',
+            'upload multi_newer',
+        ])
@@ -0,0 +1,297 @@
+import errno
+import os
+import socket
+import threading
+import time
+import unittest
+
+import mock
+
+from infra.tunnel import TunnelPool, TunnelThread
+
+
+class FakeChannel(object):
+    """
+    Paramiko channel stand-in over one end of a socket pair.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def _nonblocking(self, method, *args):
+        # paramiko raises socket.timeout where a socket would EAGAIN
+        try:
+            return method(*args)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise socket.timeout()
+            raise
+
+    def send(self, data):
+        # like paramiko, at most one packet per send
+        return self._nonblocking(self.sock.send, data[:32 * 1024])
+
+    def recv(self, size):
+        return self._nonblocking(self.sock.recv, size)
+
+    def send_ready(self):
+        return True
+
+    def shutdown_write(self):
+        self.sock.shutdown(socket.SHUT_WR)
+
+    def getpeername(self):
+        return ('remote', 22)
+
+
+def echo(sock):
+    while True:
+        data = sock.recv(64 * 1024)
+        if not data:
+            break
+        sock.sendall(data)
+    sock.close()
+
+
+def sink(sock):
+    received = 0
+    while True:
+        data = sock.recv(64 * 1024)
+        if not data:
+            break
+        received += len(data)
+    sock.sendall(str(received))
+    sock.close()
+
+
+class FakeTransport(object):
+    """
+    Opens channels to `server`, an echo by default. Each open first waits
+    the next of `delays`, None rejects it.
+    """
+
+    def __init__(self, delays=(), server=echo):
+        self.delays = list(delays)
+        self.server = server
+        self.lock = threading.Lock()
+
+    def open_channel(self, kind, dest_addr, src_addr):
+        with self.lock:
+            delay = self.delays.pop(0) if self.delays else 0
+        if delay is None:
+            return None
+        time.sleep(delay)
+        local, remote = socket.socketpair()
+        thread = threading.Thread(target=self.server, args=(remote,))
+        thread.daemon = True
+        thread.start()
+        return FakeChannel(local)
+
+
+def read_all(sock):
+    chunks = []
+    while True:
+        data = sock.recv(64 * 1024)
+        if not data:
+            return ''.join(chunks)
+        chunks.append(data)
+
+
+class TunnelTestCase(object):
+
+    backend = None
+
+    def start(self, transport):
+        self.tunnel = TunnelThread(
+            'db', '5432', 0, transport, backend=self.backend)
+        self.tunnel.daemon = True
+        self.tunnel.start()
+
+    def tearDown(self):
+        self.tunnel.server.shutdown()
+
+    def connect(self):
+        return socket.create_connection(('127.0.0.1', self.tunnel.local_port))
+
+    def test_relay(self):
+        self.start(FakeTransport())
+        data = os.urandom(4 * 1024 * 1024)
+        client = self.connect()
+
+        def write():
+            client.sendall(data)
+            # the half-close is forwarded, and the echo's close back
+            client.shutdown(socket.SHUT_WR)
+
+        # written from another thread, the echo is read meanwhile
+        writer = threading.Thread(target=write)
+        writer.start()
+        self.assertEqual(read_all(client), data)
+        writer.join()
+        client.close()
+        for _ in xrange(100):
+            if self.tunnel.server.connections:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.tunnel.server.connections, 1)
+        self.assertEqual(self.tunnel.server.bytes_sent, len(data))
+        self.assertEqual(self.tunnel.server.bytes_received, len(data))
+
+    def test_throughput(self):
+        # one way, so only the local side wakes the relay up
+        self.start(FakeTransport(server=sink))
+        data = os.urandom(16 * 1024 * 1024)
+        client = self.connect()
+        started_at = time.time()
+        client.sendall(data)
+        client.shutdown(socket.SHUT_WR)
+        self.assertEqual(read_all(client), str(len(data)))
+        elapsed = time.time() - started_at
+        client.close()
+        # a loopback relay should manage well over 8MB/s
+        self.assertTrue(elapsed < 2.0, '%.1fMB/s' % (16 / elapsed))
+
+    def test_rejected(self):
+        self.start(FakeTransport([None]))
+        client = self.connect()
+        self.assertEqual(read_all(client), '')
+        # later connections are still served
+        client = self.connect()
+        client.sendall('ping')
+        client.shutdown(socket.SHUT_WR)
+        self.assertEqual(read_all(client), 'ping')
+
+
+class TestThreadedTunnel(TunnelTestCase, unittest.TestCase):
+
+    backend = 'threads'
+
+
+class TestEventTunnel(TunnelTestCase, unittest.TestCase):
+
+    backend = 'events'
+
+    def test_slow_open(self):
+        # the second channel takes a second to open
+        self.start(FakeTransport([0, 1.0]))
+        client = self.connect()
+        client.sendall('ping')
+        self.assertEqual(client.recv(4), 'ping')
+        slow = self.connect()
+        slow.sendall('slow')
+        time.sleep(0.1)
+        started_at = time.time()
+        for _ in xrange(10):
+            client.sendall('ping')
+            self.assertEqual(client.recv(4), 'ping')
+        # relayed while the other channel is still opening
+        self.assertTrue(time.time() - started_at < 0.5)
+        self.assertEqual(slow.recv(4), 'slow')
+
+
+class FakeTunnelThread(object):
+
+    def __init__(self, tunnel_hoststring):
+        self.tunnel_hoststring = tunnel_hoststring
+        self.transport = mock.Mock()
+        self.transport.is_active.return_value = True
+        self.local_port = 10022
+        self.closed = False
+
+    def start(self):
+        pass
+
+    def is_alive(self):
+        return not self.closed
+
+    def close(self):
+        self.closed = True
+
+
+class TestTunnelPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = TunnelPool()
+        self.opened = []
+        # opening a tunnel through a bastion takes this many seconds
+        self.delays = {}
+        patcher = mock.patch('infra.tunnel.make_tunnel', self.make_tunnel)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_tunnel(self, tunnel_hoststring, remote, **kwargs):
+        time.sleep(self.delays.get(tunnel_hoststring, 0))
+        tunnel_thread = FakeTunnelThread(tunnel_hoststring)
+        self.opened.append(tunnel_thread)
+        return tunnel_thread
+
+    def acquire_later(self, tunnel_hoststring):
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(
+                self.pool.acquire(tunnel_hoststring, 'db')))
+        thread.start()
+        return thread, acquired
+
+    def test_reused(self):
+        pooled = self.pool.acquire('bastion', 'db')
+        self.pool.release(pooled)
+        self.assertTrue(self.pool.acquire('bastion', 'db') is pooled)
+        self.assertEqual(pooled.refs, 1)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_slow_open(self):
+        self.delays['slow'] = 0.5
+        thread, acquired = self.acquire_later('slow')
+        time.sleep(0.1)
+        # tunnels through other bastions are handed out and released
+        # meanwhile
+        started_at = time.time()
+        self.pool.release(self.pool.acquire('bastion', 'db'))
+        self.assertTrue(time.time() - started_at < 0.2)
+        # callers for the same tunnel wait for it to be opened once
+        pooled = self.pool.acquire('slow', 'db')
+        thread.join()
+        self.assertTrue(acquired[0] is pooled)
+        self.assertEqual(pooled.refs, 2)
+        self.assertEqual(
+            [tunnel_thread.tunnel_hoststring
+             for tunnel_thread in self.opened],
+            ['bastion', 'slow'])
+
+    def test_failed_open(self):
+        with mock.patch('infra.tunnel.make_tunnel',
+                        mock.Mock(side_effect=IOError('no route'))):
+            self.assertRaises(IOError, self.pool.acquire, 'bastion', 'db')
+        self.assertEqual(self.pool.opening, {})
+        self.assertEqual(self.pool.acquire('bastion', 'db').refs, 1)
+
+    def test_unhealthy_in_use(self):
+        pooled = self.pool.acquire('bastion', 'db')
+        pooled.tunnel.transport.is_active.return_value = False
+        reopened = self.pool.acquire('bastion', 'db')
+        self.assertFalse(reopened is pooled)
+        # still in use, so only closed once released
+        self.assertFalse(pooled.tunnel.closed)
+        self.pool.release(pooled)
+        self.assertTrue(pooled.tunnel.closed)
+        self.assertFalse(reopened.tunnel.closed)
+
+    def test_unhealthy_unused(self):
+        pooled = self.pool.acquire('bastion', 'db')
+        self.pool.release(pooled)
+        pooled.tunnel.transport.is_active.return_value = False
+        self.assertFalse(self.pool.acquire('bastion', 'db') is pooled)
+        self.assertTrue(pooled.tunnel.closed)
+
+    def test_close_all(self):
+        pooled = self.pool.acquire('bastion', 'db')
+        pooled.tunnel.transport.is_active.return_value = False
+        reopened = self.pool.acquire('bastion', 'db')
+        self.pool.close_all()
+        self.assertTrue(pooled.tunnel.closed)
+        self.assertTrue(reopened.tunnel.closed)
+        self.assertEqual(self.pool.tunnels, {})